@@ -1,17 +1,59 @@
 #!/usr/bin/python3.12
+from __future__ import annotations
+import time
+# for --profile-startup, the cpu time until here is the interpreter starting and compiling or loading this module
+_startup_started = time.perf_counter()
+_startup_cpu_seconds = time.process_time()
 import argparse
 import os
 import sys
-import subprocess
 import re
-from typing import List
-import tempfile
+from typing import List, NamedTuple, Iterable, Iterator
 import stat
 from pathlib import Path
-from uuid import uuid4
 import json
 import datetime
-import socket
+import threading
+import heapq
+import itertools
+import fnmatch
+import errno
+import contextvars
+import functools
+import atexit
+import importlib
+import mmap
+from contextlib import closing, contextmanager, nullcontext
+from collections import deque, Counter
+
+# seconds every module imported on first use took to import
+_lazy_import_seconds = {}
+
+class _LazyModule:
+    ''' stands in for a module until its first use, so commands that dont need it dont pay for importing it '''
+    def __init__(self, module_name: str, global_name: str):
+        self._module_name = module_name
+        self._global_name = global_name
+
+    def __getattr__(self, attr):
+        start = time.perf_counter()
+        module = importlib.import_module(self._module_name)
+        _lazy_import_seconds.setdefault(self._module_name, time.perf_counter() - start)
+        # later uses find the module itself
+        globals()[self._global_name] = module
+        return getattr(module, attr)
+
+# asyncio alone takes longer to import than everything else together
+asyncio = _LazyModule('asyncio', 'asyncio')
+futures = _LazyModule('concurrent.futures', 'futures')
+subprocess = _LazyModule('subprocess', 'subprocess')
+sqlite3 = _LazyModule('sqlite3', 'sqlite3')
+socket = _LazyModule('socket', 'socket')
+hashlib = _LazyModule('hashlib', 'hashlib')
+tempfile = _LazyModule('tempfile', 'tempfile')
+shutil = _LazyModule('shutil', 'shutil')
+uuid = _LazyModule('uuid', 'uuid')
+_imports_done = time.perf_counter()
 
 # this tool is very very strict to remove as many error cases as possible
 # it tracks metadata more redundantly
@@ -29,28 +71,338 @@ MAX_FILENAME_LEN = 255
 MAX_DEPTH = 16
 MAX_TOTAL_LEN = 512
 
-session_uuid = (uuid4())
-session_hostname = socket.getfqdn()
-session_hosttime = str(datetime.datetime.now().isoformat())
+# in-process hashing engine settings
+HASH_WORKERS = os.cpu_count() or 1
+HASH_BUFFER_SIZE = 16 * 1024 * 1024 # 16 MiB, large reads keep syscall overhead low on big files
+# reads of the next blocks kept in flight while a block is hashed, parallel filesystems only reach their bandwidth with several outstanding reads
+HASH_READ_AHEAD = 2
+# hash with O_DIRECT, bypassing the page cache, so hashing big files doesnt evict the cache of everything else
+hash_direct_io = False
+# digests stored in the stubfile besides sha256, computed in the same read pass, retrieves verify with the fastest stored one.
+# None picks xxh3_128 if the xxhash package is installed, otherwise blake2b if it is faster than sha256 on this host,
+# which it isnt on cpus with sha extensions
+extra_digests = None
+# bytes hashed once per algorithm to measure how fast this host computes it
+DIGEST_CALIBRATION_BYTES = 4 * 1024 * 1024
+# with --pipelined, how much hashed data may sit in the page cache waiting for dsmc, keep it below the free memory
+PAGECACHE_BUDGET_BYTES = 16 * 1024**3 # 16 GiB
+# how often a file that is being retrieved is checked for new bytes to hash
+VERIFY_POLL_INTERVAL = 0.5
+
+# upper limit for the data a single dsmc archive session uploads, a failed session only has to be repeated for this much
+MAX_BATCH_BYTES = 2 * 1024**4 # 2 TiB
+# throughput of one dsmc session, only used to estimate durations for archive --dry-run
+ESTIMATED_SESSION_BYTES_PER_SEC = 300 * 1024**2
+# files checked in parallel before archiving, the checks are mostly waiting for the filesystem
+PREFLIGHT_WORKERS = 32
+# parallel directory workers for scanning trees for stubfiles
+SCAN_WORKERS = 16
+# persistent cache of checksums, keyed by the identity of the file, so unchanged files arent hashed again
+CHECKSUM_CACHE_PATH = os.environ.get('ARCHIVE_TOOL_CHECKSUM_CACHE', str(Path.home() / '.cache' / 'archive_tool' / 'checksums.sqlite3'))
+CHECKSUM_CACHE_MAX_ENTRIES = 100_000
+XATTR_CHECKSUM_NAME = 'user.sha256'
+# reuse cached checksums, set to false to hash everything again (the fresh checksums are still cached)
+trust_checksum_cache = True
+# also keep checksums in an extended attribute of the file, it survives renames and a lost cache database
+use_xattr_checksums = False
+# where archive batches journal their progress, so they can be resumed
+JOURNAL_DIR = os.environ.get('ARCHIVE_TOOL_JOURNAL_DIR', str(Path.home() / '.cache' / 'archive_tool' / 'journals'))
+
+# local catalog of archived objects, so listing doesnt have to query the server
+CATALOG_PATH = os.environ.get('ARCHIVE_TOOL_CATALOG', str(Path.home() / '.cache' / 'archive_tool' / 'catalog.sqlite3'))
+# a refresh commits after this many objects, so archiving and listing arent locked out while a big listing streams in
+CATALOG_COMMIT_ROWS = 10_000
+
+_session_started = time.time()
+
+@functools.cache
+def session_id() -> str:
+    return str(uuid.uuid4())
+
+@functools.cache
+def session_metadata() -> dict:
+    ''' resolved on first use, getfqdn can block for seconds on a reverse dns timeout '''
+    return {'session_uuid': session_id(), 'session_hostname': socket.getfqdn(),
+            'session_hosttime': datetime.datetime.fromtimestamp(_session_started).isoformat()}
+
+def __getattr__(name: str):
+    # the session metadata used to be module attributes computed at import
+    if name in ('session_uuid', 'session_hostname', 'session_hosttime'):
+        return session_metadata()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # only set this to true if you have permanent sudo
 # otherwise your credentical cache timing out could fail the tool
 add_dsmc_sudo = False
 
+# every timed phase is appended as a json line to this file, and the totals per phase are written
+# for the prometheus node exporter textfile collector to this file, None disables them
+METRICS_PATH = os.environ.get('ARCHIVE_TOOL_METRICS')
+PROMETHEUS_TEXTFILE_PATH = os.environ.get('ARCHIVE_TOOL_PROMETHEUS_TEXTFILE')
+
+# runs, seconds, bytes and errors per phase since the process started
+_span_totals = {}
+_metrics_lock = threading.Lock()
+_process_start_time = time.time()
+
+def metrics_enabled() -> bool:
+    return METRICS_PATH is not None or PROMETHEUS_TEXTFILE_PATH is not None
+
+@contextmanager
+def span(name: str, **attrs) -> Iterator[dict]:
+    ''' time a phase, the caller can add attributes, like the bytes it processed, to the yielded dict while it runs '''
+    if not metrics_enabled():
+        yield attrs
+        return
+    started, start = time.time(), time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _record_span(name, started, time.perf_counter() - start, error, attrs)
+
+def _record_span(name: str, started: float, seconds: float, error: str, attrs: dict):
+    record = {'span': name, 'start': datetime.datetime.fromtimestamp(started).isoformat(), 'seconds': round(seconds, 6), **attrs}
+    if attrs.get('bytes') and seconds > 0:
+        record['bytes_per_sec'] = attrs['bytes'] / seconds
+    record.update(status='error' if error else 'ok', session=session_id(), host=os.uname().nodename, pid=os.getpid())
+    if error:
+        record['error'] = error
+    with _metrics_lock:
+        totals = _span_totals.setdefault(name, {'runs': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+        totals['runs'] += 1
+        totals['seconds'] += seconds
+        totals['bytes'] += attrs.get('bytes') or 0
+        totals['errors'] += error is not None
+        if METRICS_PATH is not None:
+            with open(METRICS_PATH, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+
+PROMETHEUS_METRICS = [
+    ('archive_tool_phase_runs_total', 'runs', 'Phases run since the process started'),
+    ('archive_tool_phase_seconds_total', 'seconds', 'Seconds spent in the phase since the process started'),
+    ('archive_tool_phase_bytes_total', 'bytes', 'Bytes the phase processed since the process started'),
+    ('archive_tool_phase_errors_total', 'errors', 'Phases that failed since the process started'),
+]
+
+def write_prometheus_textfile(path: str = None):
+    ''' write the totals per phase, atomically, the collector reads the file at any time '''
+    path = path or PROMETHEUS_TEXTFILE_PATH
+    if path is None:
+        return
+    with _metrics_lock:
+        totals = {name: dict(phase) for name, phase in _span_totals.items()}
+    lines = []
+    for metric, key, description in PROMETHEUS_METRICS:
+        lines += [f'# HELP {metric} {description}', f'# TYPE {metric} counter']
+        lines += [f'{metric}{{phase="{name}"}} {phase[key]}' for name, phase in sorted(totals.items())]
+    lines += ['# HELP archive_tool_start_time_seconds Start time of the process since unix epoch in seconds',
+              '# TYPE archive_tool_start_time_seconds gauge',
+              f'archive_tool_start_time_seconds {_process_start_time}']
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    Path(tmp_path).write_text('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+def _command_name(cmd: List[str]) -> str:
+    ''' the command without its options and paths, like 'dsmc query archive' '''
+    return ' '.join(word for word in cmd[:4] if re.fullmatch(r'[a-z][a-z0-9_]*', word))
+
+class PartialFailure(RuntimeError):
+    ''' an operation on many objects failed for some of them, names are the ones that failed '''
+    def __init__(self, message: str, names: list[str]):
+        super().__init__(message)
+        self.names = list(names)
+
+# the JobControl of the job running in the current thread, None outside of jobs
+_current_job = contextvars.ContextVar('current_job', default=None)
+# seconds between checks whether a waiting job was cancelled
+JOB_POLL_INTERVAL = 0.1
+
+def _check_job_cancelled(step: str):
+    control = _current_job.get()
+    if control is not None:
+        control.check_cancelled(step)
+
+class JobControl:
+    ''' the processes a running job started, so cancelling the job or running into its timeout can stop them
+
+    jobs share the sessions semaphore, it limits how many dsmc sessions they have open at the same time
+    '''
+    def __init__(self, sessions: threading.Semaphore = None):
+        self.sessions = sessions
+        self.cancelled = False
+        self._processes = set()
+        self._lock = threading.Lock()
+
+    def check_cancelled(self, step: str):
+        if self.cancelled:
+            raise RuntimeError(f"job was cancelled, {step}")
+
+    @contextmanager
+    def _session(self, cmd: List[str]):
+        # waits in short steps, so a job waiting for a session still notices being cancelled
+        while not self.sessions.acquire(timeout=JOB_POLL_INTERVAL):
+            self.check_cancelled(f"not starting: {' '.join(cmd)}")
+        try:
+            yield
+        finally:
+            self.sessions.release()
+
+    @contextmanager
+    def running(self, cmd: List[str], **kwargs) -> Iterator[subprocess.Popen]:
+        is_dsmc_session = self.sessions is not None and 'dsmc' in cmd[:2]
+        with self._session(cmd) if is_dsmc_session else nullcontext():
+            with self._lock:
+                self.check_cancelled(f"not starting: {' '.join(cmd)}")
+                proc = subprocess.Popen(cmd, **kwargs)
+                self._processes.add(proc)
+            try:
+                with proc:
+                    yield proc
+            finally:
+                with self._lock:
+                    self._processes.discard(proc)
+
+    def cancel(self):
+        ''' stop the running processes of the job and refuse to start new ones, the job then fails at its current step '''
+        with self._lock:
+            self.cancelled = True
+            for proc in self._processes:
+                # terminate instead of kill, sudo relays it to dsmc, which then ends its session cleanly
+                proc.terminate()
+
+@contextmanager
+def _job_process(cmd: List[str], **kwargs) -> Iterator[subprocess.Popen]:
+    ''' start a command as part of the current job, if there is one '''
+    control = _current_job.get()
+    if control is None:
+        with subprocess.Popen(cmd, **kwargs) as proc:
+            yield proc
+    else:
+        with control.running(cmd, **kwargs) as proc:
+            yield proc
+
 def subproc(cmd: List[str], with_sudo=False):
     ''' subprocess wrap function for better monkeypatching and better argument control '''
     if with_sudo or add_dsmc_sudo and cmd[0]=='dsmc':
         cmd = ['sudo'] + cmd
-    result = subprocess.run(
-        cmd,
-        check=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        encoding='utf-8',
-        errors='strict'
-    )
-    return result
+    with span('subprocess', command=_command_name(cmd)), \
+         _job_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                      encoding='utf-8', errors='strict') as proc:
+        stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+# how many of the last output lines a failed streamed command reports
+SUBPROC_OUTPUT_TAIL_LINES = 200
+
+def subproc_lines(cmd: List[str], with_sudo=False) -> Iterator[str]:
+    ''' like subproc, but yield stdout line by line while the command runs, so long outputs arent held in memory
+
+    raises CalledProcessError after the last line, if the command failed, with the tail of the output
+    '''
+    if with_sudo or add_dsmc_sudo and cmd[0]=='dsmc':
+        cmd = ['sudo'] + cmd
+    tail = deque(maxlen=SUBPROC_OUTPUT_TAIL_LINES)
+    # stderr goes to a file, a second pipe could fill up and deadlock while stdout is read
+    with span('subprocess', command=_command_name(cmd), lines=0) as phase, \
+         tempfile.TemporaryFile(mode='w+t', encoding='utf-8') as stderr_file:
+        with _job_process(cmd, stdout=subprocess.PIPE, stderr=stderr_file, text=True,
+                          encoding='utf-8', errors='strict') as proc:
+            try:
+                for line in proc.stdout:
+                    tail.append(line)
+                    phase['lines'] += 1
+                    yield line
+            except BaseException:
+                # the caller stopped reading, dont leave the command running
+                proc.kill()
+                raise
+            returncode = proc.wait()
+        if returncode != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(returncode, cmd, output=''.join(tail), stderr=stderr_file.read())
+
+# per file lines dsmc prints while archiving or retrieving, like:
+# Normal File-->     1,073,741,824 /data/file.bin [Sent]
+# Retrieving     1,073,741,824 /data/file.bin --> /tmp/file.bin [Done]
+DSMC_TRANSFER_PATTERN = re.compile(r"^\s*(?:Normal File-->|Retrieving|Archiving)\s+(?P<size>[\d,]+)\s+(?P<path>/.*?)(?:\s+-->\s+(?P<destination>.*?))?\s+\[(?P<status>[\w ]+)\]\s*$")
+# and the rates in its summary, like: Network data transfer rate:  112,345.67 KB/sec
+DSMC_RATE_PATTERN = re.compile(r"^\s*(?P<name>(?:Network |Aggregate )?[Dd]ata transfer rate):\s+(?P<rate>[\d,.]+)\s+(?P<unit>KB|MB|GB)/sec")
+
+# callables that get every ProgressEvent of long running dsmc sessions
+progress_callbacks = []
+# print progress of long running dsmc sessions to the console
+print_progress = True
+
+class ProgressEvent(NamedTuple):
+    ''' progress of a dsmc session, kind is 'file' when dsmc finished a file and 'rate' for the rates it reports at the end '''
+    kind: str
+    path: str
+    size: int
+    status: str
+    done_bytes: int
+    total_bytes: int
+    elapsed: float
+    throughput: float # bytes per second, measured since the session started
+    eta: float # seconds, None if the total is unknown
+    reported_rate: float # bytes per second, as reported by dsmc for 'rate' events
+
+def parse_progress_line(line: str):
+    ''' parse one line of dsmc output into ('file', path, size, status) or ('rate', name, bytes_per_second) or None '''
+    match = DSMC_TRANSFER_PATTERN.match(line)
+    if match:
+        return ('file', match.group('path'), int(match.group('size').replace(',', '')), match.group('status'))
+    match = DSMC_RATE_PATTERN.match(line)
+    if match:
+        unit = {'KB': 1024, 'MB': 1024**2, 'GB': 1024**3}[match.group('unit')]
+        return ('rate', match.group('name'), float(match.group('rate').replace(',', '')) * unit)
+    return None
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def print_progress_event(event: ProgressEvent):
+    if event.kind == 'rate':
+        print(f"  {event.status}: {event.reported_rate / 1024**2:.1f} MiB/s")
+        return
+    done = f"{event.done_bytes / 1024**3:.2f} GiB"
+    if event.total_bytes:
+        done += f" / {event.total_bytes / 1024**3:.2f} GiB ({min(event.done_bytes / event.total_bytes, 1):.0%})"
+    eta = f", ETA {_format_duration(event.eta)}" if event.eta is not None else ''
+    print(f"  [{event.status}] {event.path}: {done}, {event.throughput / 1024**2:.1f} MiB/s{eta}")
+
+def run_dsmc_with_progress(cmd: List[str], total_bytes: int = None, callback=None):
+    ''' run a long dsmc session, streaming its output and turning it into progress events, memory use stays constant '''
+    callbacks = list(progress_callbacks) + ([callback] if callback else [])
+    if print_progress:
+        callbacks.append(print_progress_event)
+    start = time.monotonic()
+    done_bytes = 0
+    for line in subproc_lines(cmd):
+        parsed = parse_progress_line(line)
+        if parsed is None:
+            continue
+        elapsed = time.monotonic() - start
+        if parsed[0] == 'file':
+            _, path, size, status = parsed
+            done_bytes += size
+            throughput = done_bytes / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if total_bytes and throughput > 0:
+                eta = max(total_bytes - done_bytes, 0) / throughput
+            event = ProgressEvent('file', path, size, status, done_bytes, total_bytes, elapsed, throughput, eta, None)
+        else:
+            _, name, rate = parsed
+            event = ProgressEvent('rate', None, 0, name, done_bytes, total_bytes, elapsed,
+                                  done_bytes / elapsed if elapsed > 0 else 0.0, None, rate)
+        for cb in callbacks:
+            cb(event)
 
 # AI-generated by Qwen3-235B-A22B-Instruct-2507
 
@@ -110,6 +462,9 @@ def parse_file_space_names(text: str) -> List[str]:
     return file_spaces
 
 
+SAFE_FILENAME_PATTERN = re.compile(r'^[a-zA-Z0-9._][a-zA-Z0-9._-]+')
+RESERVED_FILENAMES = frozenset({'CON', 'PRN', 'AUX', 'NUL', 'COM1', 'LPT1'})
+
 def validate_filepath(filepath: str, ) -> None:
     """
     Validate filepath for length, depth, and character safety.
@@ -140,7 +495,7 @@ def validate_filepath(filepath: str, ) -> None:
 
     # Check for unsafe characters (allow letters, digits, underscore, dash, dot)
     # also now, files cant start with '-'
-    if not re.fullmatch(r'^[a-zA-Z0-9._][a-zA-Z0-9._-]+', filename):
+    if not SAFE_FILENAME_PATTERN.fullmatch(filename):
         raise ValueError("Filename contains invalid characters (allowed: a-z, A-Z, 0-9, _, -, .)")
 
     # Check for null bytes or control chars
@@ -148,42 +503,17 @@ def validate_filepath(filepath: str, ) -> None:
         raise ValueError("Path contains null or control characters")
 
     # Reserved names on some systems (Windows)
-    reserved = {'CON', 'PRN', 'AUX', 'NUL', 'COM1', 'LPT1'}
-    if filename.split('.')[0].upper() in reserved:
+    if filename.split('.')[0].upper() in RESERVED_FILENAMES:
         raise ValueError(f"Filename '{filename}' is a reserved name")
 
 
-def is_normal_file(filepath: str) -> bool:
-    """
-    Check if file is 'normal': exists, regular file, not symlink, not device, not broken.
-    """
-    try:
-        # Resolve symlinks and get final stat
-        #real_path = os.path.realpath(filepath)
-        real_path = os.path.realpath(filepath)
-        st = os.stat(real_path)
-
-        # Must be a regular file
-        if not stat.S_ISREG(st.st_mode):
-            return False
-
-        # Path must still point to same inode (prevent symlink race)
-        st_final = os.stat(filepath)
-        if st.st_ino != st_final.st_ino or st.st_dev != st_final.st_dev:
-            return False
-
-        return True
-
-    except (OSError, ValueError):
-        return False
-
-
 def sha256sum(filepath: str) -> str:
     """Compute SHA256 sum of a file using the `sha256sum` subprocess to ensure compatibilty with users using the command."""
     assert isinstance(filepath, str)
     try:
         # BUGFIX: add -- or otherwise cant hash files that begin with '-'
-        result = subproc(['sha256sum', '--', filepath])
+        with span('sha256sum', path=filepath):
+            result = subproc(['sha256sum', '--', filepath])
         # Output: "<hex>  <filename>"
         checksum = result.stdout.split(None, 1)[0]
         return checksum.lower()
@@ -196,12 +526,542 @@ def sha256sum(filepath: str) -> str:
 
 # end generated by AI
 
+# dsmc messages look like ANS1345E, the last letter is the severity, I(nformational) isnt a problem
+DSMC_PROBLEM_MESSAGE_PATTERN = re.compile(r'\bANS\d{4}[EWS]\b')
+OUTPUT_PATH_PATTERN = re.compile(r"(/[^\s'\"\[\]]*)")
+
+def _fadvise(fd: int, advice: int, offset: int = 0, length: int = 0):
+    ''' best effort page cache hint, not every platform or filesystem supports it '''
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def evict_from_page_cache(paths: list[str]):
+    ''' tell the kernel the cached pages of these files are not needed anymore '''
+    if not hasattr(os, 'POSIX_FADV_DONTNEED'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            _fadvise(fd, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+_hash_buffers = threading.local()
+
+def _get_hash_buffer(size: int) -> bytearray:
+    ''' get a reusable read buffer per thread, so hashing many files doesnt allocate a new buffer per file '''
+    buf = getattr(_hash_buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = bytearray(size)
+        _hash_buffers.buf = buf
+    return buf
+
+def _get_aligned_buffers(size: int, count: int) -> list[mmap.mmap]:
+    ''' reusable page aligned read buffers per thread, O_DIRECT needs aligned memory, anonymous mmaps always are '''
+    buffers = getattr(_hash_buffers, 'aligned', None)
+    if buffers is None or len(buffers) < count or len(buffers[0]) != size:
+        buffers = [mmap.mmap(-1, size) for _ in range(count)]
+        _hash_buffers.aligned = buffers
+    return buffers[:count]
+
+def _open_for_hashing(filepath: str, direct_io: bool) -> tuple[int, bool]:
+    ''' open read only, with O_DIRECT if asked for and the filesystem supports it, returns the fd and whether it is direct '''
+    if direct_io and hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(filepath, os.O_RDONLY | os.O_DIRECT), True
+        except OSError as e:
+            # tmpfs and some fuse filesystems refuse O_DIRECT, hash through the page cache there
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(filepath, os.O_RDONLY), False
+
+def _read_blocks(fd: int, buffers: list[mmap.mmap], pool) -> Iterator[memoryview]:
+    ''' yield the file block by block, with a pool the reads of the next blocks are in flight while a block is hashed
+
+    a buffer is only read into again after its block was consumed, so the caller must be done with a block before the next one
+    '''
+    block_size = len(buffers[0])
+    offset = 0
+
+    def at_end(block_offset, n):
+        if n == block_size:
+            return False
+        # with O_DIRECT, reading on from an unaligned offset fails, so a short read has to be the end of the file
+        if block_offset + n < os.fstat(fd).st_size:
+            raise OSError(errno.EIO, f"short read of {n} bytes at offset {block_offset}")
+        return True
+
+    if pool is None:
+        while n := os.preadv(fd, [buffers[0]], offset):
+            yield memoryview(buffers[0])[:n]
+            if at_end(offset, n):
+                break
+            offset += n
+        return
+    pending = deque()
+    for buf in buffers:
+        pending.append((offset, pool.submit(os.preadv, fd, [buf], offset), buf))
+        offset += block_size
+    try:
+        while pending:
+            block_offset, read, buf = pending.popleft()
+            n = read.result()
+            if n:
+                yield memoryview(buf)[:n]
+            if at_end(block_offset, n):
+                break
+            pending.append((offset, pool.submit(os.preadv, fd, [buf], offset), buf))
+            offset += block_size
+    finally:
+        # the buffers are reused, no read may still write into them
+        for _, read, _ in pending:
+            read.cancel()
+        futures.wait([read for _, read, _ in pending])
+
+def new_hasher(algorithm: str):
+    ''' a hashlib style object for a hashlib algorithm, or xxh3_64 and xxh3_128 of the optional xxhash package '''
+    if algorithm.startswith('xxh'):
+        try:
+            import xxhash
+        except ImportError:
+            raise RuntimeError(f"digest {algorithm} needs the xxhash package") from None
+        if not hasattr(xxhash, algorithm):
+            raise RuntimeError(f"unknown digest {algorithm}")
+        return getattr(xxhash, algorithm)()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise RuntimeError(f"unknown digest {algorithm}") from None
+
+def digest_available(algorithm: str) -> bool:
+    try:
+        new_hasher(algorithm)
+    except RuntimeError:
+        return False
+    return True
+
+@functools.cache
+def digest_speed(algorithm: str) -> float:
+    ''' bytes per second this host hashes with algorithm, measured once per process '''
+    data = bytes(DIGEST_CALIBRATION_BYTES)
+    h = new_hasher(algorithm)
+    start = time.perf_counter()
+    h.update(data)
+    return len(data) / max(time.perf_counter() - start, 1e-9)
+
+def digest_algorithms() -> list[str]:
+    ''' the digests computed when archiving, sha256 first '''
+    if extra_digests is not None:
+        algorithms = ['sha256'] + [algorithm for algorithm in extra_digests if algorithm != 'sha256']
+        # fail on unknown digests before anything is hashed
+        for algorithm in algorithms:
+            new_hasher(algorithm)
+        return algorithms
+    if digest_available('xxh3_128'):
+        return ['sha256', 'xxh3_128']
+    if digest_speed('blake2b') > digest_speed('sha256'):
+        return ['sha256', 'blake2b']
+    return ['sha256']
+
+def verify_algorithm(digests: dict[str, str]) -> str:
+    ''' the digest of an object that this host computes fastest '''
+    candidates = [algorithm for algorithm in digests if digest_available(algorithm)]
+    if not candidates:
+        raise RuntimeError(f"none of the digests {', '.join(digests)} can be computed here")
+    if len(candidates) == 1:
+        return candidates[0]
+    return max(candidates, key=digest_speed)
+
+def hash_file_digests(filepath: str, algorithms: Iterable[str] = ('sha256',), buffer_size: int = HASH_BUFFER_SIZE,
+                      direct_io: bool = None, read_ahead: int = None, inode: tuple[int, int] = None) -> dict[str, str]:
+    """Compute several digests of a file in a single read pass, as lowercase hex digests like the `sha256sum` output.
+
+    direct_io and read_ahead default to hash_direct_io and HASH_READ_AHEAD,
+    with inode, the (st_dev, st_ino) the file had when it was checked, a file replaced since then isnt hashed
+    """
+    assert isinstance(filepath, str)
+    direct_io = hash_direct_io if direct_io is None else direct_io
+    read_ahead = HASH_READ_AHEAD if read_ahead is None else read_ahead
+    # O_DIRECT reads must be a multiple of the block size of the device, the page size is one
+    block_size = -(-buffer_size // mmap.PAGESIZE) * mmap.PAGESIZE
+    hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+    try:
+        with span('hash_file', path=filepath, bytes=0) as phase:
+            fd, phase['direct_io'] = _open_for_hashing(filepath, direct_io)
+            try:
+                if inode is not None and _inode(os.fstat(fd)) != tuple(inode):
+                    raise RuntimeError(f"hashing failed: {filepath} was replaced since it was checked")
+                if not phase['direct_io'] and hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+                    # larger readahead, the whole file is read front to back
+                    _fadvise(fd, os.POSIX_FADV_SEQUENTIAL)
+                # small files fit into one block, a read pool wouldnt have anything to read ahead
+                big = os.fstat(fd).st_size > block_size
+                if read_ahead > 0 and big:
+                    pool = futures.ThreadPoolExecutor(max_workers=read_ahead)
+                else:
+                    pool, read_ahead = None, 0
+                # the digests of a block are computed at the same time, hashlib releases the GIL while hashing
+                updaters = futures.ThreadPoolExecutor(max_workers=len(hashers)) if len(hashers) > 1 and big else None
+                with pool or nullcontext(), updaters or nullcontext():
+                    for block in _read_blocks(fd, _get_aligned_buffers(block_size, read_ahead + 1), pool):
+                        _check_job_cancelled(f"stopped hashing {filepath}")
+                        if updaters:
+                            list(updaters.map(lambda h: h.update(block), hashers.values()))
+                        else:
+                            for h in hashers.values():
+                                h.update(block)
+                        phase['bytes'] += len(block)
+            finally:
+                os.close(fd)
+    except OSError as e:
+        raise RuntimeError(f"hashing failed: {filepath}: {e}") from e
+    return {algorithm: h.hexdigest() for algorithm, h in hashers.items()}
+
+def hash_file(filepath: str, buffer_size: int = HASH_BUFFER_SIZE, direct_io: bool = None, read_ahead: int = None) -> str:
+    """Compute the SHA256 sum of a file in-process, the lowercase hex digest is identical to the `sha256sum` output."""
+    return hash_file_digests(filepath, ('sha256',), buffer_size, direct_io, read_ahead)['sha256']
+
+CHECKSUM_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS checksums (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256checksum TEXT NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns)
+);
+CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used);
+CREATE TABLE IF NOT EXISTS digests (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns, algorithm)
+);
+'''
+
+def _inode(st: os.stat_result) -> tuple[int, int]:
+    return (st.st_dev, st.st_ino)
+
+def _stat_identity(path: str) -> tuple[int, int, int, int]:
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+def open_checksum_cache() -> sqlite3.Connection:
+    Path(CHECKSUM_CACHE_PATH).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(CHECKSUM_CACHE_PATH, timeout=60)
+    conn.executescript(CHECKSUM_CACHE_SCHEMA)
+    return conn
+
+def _read_xattr_checksum(path: str, identity: tuple) -> str:
+    try:
+        value = json.loads(os.getxattr(path, XATTR_CHECKSUM_NAME))
+    except (OSError, ValueError, AttributeError):
+        return None
+    # the attribute belongs to the inode, but it stays when the content changes
+    if [value.get('size'), value.get('mtime_ns')] != [identity[2], identity[3]]:
+        return None
+    return value.get('sha256')
+
+def _write_xattr_checksum(path: str, identity: tuple, checksum: str):
+    try:
+        os.setxattr(path, XATTR_CHECKSUM_NAME, json.dumps({'sha256': checksum, 'size': identity[2], 'mtime_ns': identity[3]}).encode())
+    except (OSError, AttributeError) as e:
+        print(f"warning, could not store the checksum of {path} in an extended attribute: {e}")
+
+def cached_hash_files(paths: list[str], workers: int = None, use_processes=False, direct_io: bool = None,
+                      algorithms: list[str] = None, inodes: dict[str, tuple[int, int]] = None) -> dict:
+    ''' like hash_files, but reuse the checksums of files whose (dev, inode, size, mtime_ns) didnt change since they were hashed
+
+    a file is only taken from the cache if all its requested digests are cached
+    '''
+    wanted = algorithms or ['sha256']
+    identities = {path: _stat_identity(path) for path in paths}
+    for path, identity in identities.items():
+        if inodes and path in inodes and identity[:2] != tuple(inodes[path]):
+            raise RuntimeError(f"hashing failed: {path} was replaced since it was checked")
+    digests = {}
+    try:
+        with closing(open_checksum_cache()) as conn, conn:
+            if trust_checksum_cache:
+                now = time.time()
+                for path, identity in identities.items():
+                    row = conn.execute("SELECT sha256checksum FROM checksums WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                                       identity).fetchone()
+                    checksum = row[0] if row else (_read_xattr_checksum(path, identity) if use_xattr_checksums else None)
+                    if not checksum:
+                        continue
+                    known = dict(conn.execute("SELECT algorithm, digest FROM digests WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                                              identity).fetchall(), sha256=checksum)
+                    if all(algorithm in known for algorithm in wanted):
+                        digests[path] = {algorithm: known[algorithm] for algorithm in wanted}
+                        conn.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)", (*identity, checksum, now))
+    except sqlite3.Error as e:
+        print(f"warning, could not read the checksum cache {CHECKSUM_CACHE_PATH}: {e}")
+    if digests:
+        print(f"reusing cached checksums of {len(digests)} unchanged files")
+
+    missing = [path for path in paths if path not in digests]
+    if missing:
+        fresh = hash_files(missing, workers=workers, use_processes=use_processes, direct_io=direct_io, algorithms=wanted, inodes=inodes)
+        digests.update(fresh)
+
+        # only cache what didnt change while it was hashed
+        unchanged = {path: fresh[path] for path in missing if _stat_identity(path) == identities[path]}
+        if use_xattr_checksums:
+            for path, file_digests in unchanged.items():
+                _write_xattr_checksum(path, identities[path], file_digests['sha256'])
+        try:
+            with closing(open_checksum_cache()) as conn, conn:
+                now = time.time()
+                conn.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(*identities[path], file_digests['sha256'], now) for path, file_digests in unchanged.items()])
+                conn.executemany("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(*identities[path], algorithm, digest) for path, file_digests in unchanged.items()
+                                  for algorithm, digest in file_digests.items() if algorithm != 'sha256'])
+                # size bound, the least recently used checksums go first, and the other digests of their files with them
+                conn.execute("DELETE FROM checksums WHERE rowid IN (SELECT rowid FROM checksums ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                             (CHECKSUM_CACHE_MAX_ENTRIES,))
+                conn.execute("DELETE FROM digests WHERE NOT EXISTS (SELECT 1 FROM checksums c WHERE c.dev = digests.dev AND c.ino = digests.ino "
+                             "AND c.size = digests.size AND c.mtime_ns = digests.mtime_ns)")
+        except sqlite3.Error as e:
+            print(f"warning, could not update the checksum cache {CHECKSUM_CACHE_PATH}: {e}")
+    if algorithms is None:
+        return {path: file_digests['sha256'] for path, file_digests in digests.items()}
+    return digests
+
+def hash_growing_file(filepath: str, writer_done: threading.Event, poll_interval: float = VERIFY_POLL_INTERVAL,
+                      buffer_size: int = HASH_BUFFER_SIZE, algorithm: str = 'sha256') -> str:
+    ''' compute the sha256, or another digest, of a file while another process is still writing it
+
+    the file is followed by polling its growing size, bytes are hashed as they land,
+    once writer_done is set, the rest is hashed and the digest returned.
+    raises RuntimeError when the file was replaced or truncated while following it
+    '''
+    buf = _get_hash_buffer(buffer_size)
+    view = memoryview(buf)
+    h = new_hasher(algorithm)
+    f = None
+    hashed_bytes = 0
+    try:
+        while True:
+            # check before reading, everything written before the writer finished is read in this round
+            done = writer_done.is_set()
+            if f is None:
+                try:
+                    f = open(filepath, 'rb', buffering=0)
+                except FileNotFoundError:
+                    if done:
+                        raise RuntimeError(f"{filepath} was not created")
+                    writer_done.wait(poll_interval)
+                    continue
+                st = os.fstat(f.fileno())
+                followed_file = (st.st_dev, st.st_ino)
+
+            while n := f.readinto(buf):
+                _check_job_cancelled(f"stopped following {filepath}")
+                h.update(view[:n])
+                hashed_bytes += n
+            if done:
+                break
+            writer_done.wait(poll_interval)
+
+        st = os.stat(filepath)
+        if (st.st_dev, st.st_ino) != followed_file:
+            raise RuntimeError(f"{filepath} was replaced while following it")
+        if st.st_size != hashed_bytes:
+            raise RuntimeError(f"{filepath} changed size while following it")
+    except OSError as e:
+        raise RuntimeError(f"following {filepath} failed: {e}") from e
+    finally:
+        if f is not None:
+            f.close()
+    return h.hexdigest()
+
+def hash_files(paths: list[str], workers: int = None, use_processes=False, buffer_size: int = HASH_BUFFER_SIZE,
+                direct_io: bool = None, algorithms: list[str] = None, inodes: dict[str, tuple[int, int]] = None) -> dict:
+    ''' hash many files concurrently and return a dict of path to sha256 hex digest,
+    or with algorithms, a dict of path to a dict of algorithm to hex digest.
+    inodes are the (st_dev, st_ino) of the files when they were checked, see hash_file_digests
+
+    hashlib releases the GIL while hashing large buffers, so threads already scale over many cores,
+    use_processes=True is there for interpreters or setups where that doesnt hold
+    '''
+    if not paths:
+        return {}
+    if workers is None:
+        workers = HASH_WORKERS
+    workers = max(1, min(workers, len(paths)))
+    executor_cls = futures.ProcessPoolExecutor if use_processes else futures.ThreadPoolExecutor
+    with span('hash', files=len(paths)) as phase, executor_cls(max_workers=workers) as executor:
+        if metrics_enabled():
+            phase['bytes'] = sum(get_filesize(path) for path in paths)
+        # resolved here, worker processes dont see flags set after they were started
+        direct_io = hash_direct_io if direct_io is None else direct_io
+        file_args = [(path, tuple(algorithms or ['sha256']), buffer_size, direct_io, HASH_READ_AHEAD, (inodes or {}).get(path)) for path in paths]
+        if use_processes:
+            pending = [executor.submit(hash_file_digests, *args) for args in file_args]
+        else:
+            # every thread hashes in its own copy of the context, so it sees whether the job it belongs to was cancelled
+            pending = [executor.submit(contextvars.copy_context().run, hash_file_digests, *args) for args in file_args]
+        digests = [future.result() for future in pending]
+    if algorithms is None:
+        return {path: file_digests['sha256'] for path, file_digests in zip(paths, digests)}
+    return dict(zip(paths, digests))
+
 def parse_stubfile(filepath) -> list[dict]:
     with Path(filepath).open('rt') as f:
-        records = [json.loads(x) for x in list(f.readlines())]
+        records = [json.loads(x) for x in f]
 
     return records
 
+# stubfiles are small, the last record is almost always within this many bytes of the end
+STUB_TAIL_READ_SIZE = 4096
+
+def read_stub_ends(filepath) -> tuple[dict, dict]:
+    ''' read only the first and the last record of a stubfile, without parsing the records in between '''
+    with open(filepath, 'rb') as f:
+        first_line = f.readline()
+        end = f.seek(0, os.SEEK_END)
+        if end == len(first_line):
+            first = json.loads(first_line)
+            return first, first
+        # read backwards until the start of the last line is found
+        read_size = STUB_TAIL_READ_SIZE
+        while True:
+            start = max(end - read_size, len(first_line))
+            f.seek(start)
+            tail = f.read(end - start).rstrip(b'\n')
+            newline = tail.rfind(b'\n')
+            if newline >= 0 or start == len(first_line):
+                last_line = tail[newline + 1:]
+                break
+            read_size *= 2
+    return json.loads(first_line), json.loads(last_line)
+
+# compact stubfiles start with the pre_archive_check record plus the current state as a json line,
+# padded with spaces for the longest state, so it is read with a single pread and its state is rewritten in place.
+# everything that reads stubfiles line by line keeps working
+STUB_VERSION = 3
+# stubfiles of version 2 had headers padded to 4096 bytes, they are still read and updated
+STUB_COMPACT_VERSIONS = (2, 3)
+# room reserved in the header for the state, the longest state is 38 characters
+STUB_STATE_WIDTH = 48
+# upper limit of a header, paths are at most MAX_TOTAL_LEN long, the checksums and metadata need much less than the rest
+STUB_HEADER_MAX_SIZE = 2048
+# write new stubfiles in the compact format
+compact_stubs = False
+
+def _stub_header_line(record: dict, state: str = 'pre_archive_check', length: int = None) -> bytes:
+    ''' the header line, padded to length, or to fit every other state if length is None '''
+    if len(state) > STUB_STATE_WIDTH:
+        raise RuntimeError(f"stubfile state {state} is longer than {STUB_STATE_WIDTH} characters")
+    header = dict(record, stub_version=record.get('stub_version', STUB_VERSION), state=state)
+    line = json.dumps(header).encode()
+    if length is None:
+        length = len(line) + STUB_STATE_WIDTH - len(state) + 1
+    if len(line) >= min(length, STUB_HEADER_MAX_SIZE):
+        raise RuntimeError(f"stubfile header for {record.get('path')} doesnt fit into {min(length, STUB_HEADER_MAX_SIZE)} bytes")
+    return line.ljust(length - 1) + b'\n'
+
+def _read_compact_header(fd: int) -> tuple[dict, int]:
+    ''' the header of a compact stubfile and the length of its line, (None, 0) for stubfiles in the json lines format '''
+    data = os.pread(fd, STUB_HEADER_MAX_SIZE, 0)
+    end = data.find(b'\n')
+    if end < 0 or b'"stub_version"' not in data[:end]:
+        return None, 0
+    header = json.loads(data[:end])
+    if header.get('stub_version') not in STUB_COMPACT_VERSIONS:
+        return None, 0
+    return header, end + 1
+
+def read_stub_header(filepath) -> dict:
+    ''' path, checksum, size, metadata and current state of a stubfile, with one read for compact stubfiles '''
+    fd = os.open(filepath, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        header, _ = _read_compact_header(fd)
+    finally:
+        os.close(fd)
+    if header is not None:
+        return header
+    first, last = read_stub_ends(filepath)
+    return dict(first, state=last.get('state', last.get('entry_type')))
+
+def append_stub_state(path: str, state: str):
+    ''' append a state to the event log of the stubfile of path, and to the header of a compact stubfile
+
+    the header is rewritten after the event is appended, the event log stays authoritative
+    '''
+    with span('stub_state', state=state):
+        with open(stubname(path), 'ab') as f:
+            f.write((json.dumps({'entry_type':"state", "state":state, "path":str(path)}) + '\n').encode())
+        with open(stubname(path), 'r+b') as f:
+            header, length = _read_compact_header(f.fileno())
+            if header is not None:
+                # through a descriptor without O_APPEND, pwrite on one with it appends on linux
+                os.pwrite(f.fileno(), _stub_header_line(header, state, length), 0)
+
+def convert_stubfile(stub_path: str) -> bool:
+    ''' rewrite a json lines stubfile into the compact format, returns False if it already is compact '''
+    fd = os.open(stub_path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        if _read_compact_header(fd)[0] is not None:
+            return False
+    finally:
+        os.close(fd)
+    records = parse_stubfile(stub_path)
+    if not records or records[0]['entry_type'] != 'pre_archive_check':
+        raise RuntimeError(f'error parsing stubfile {stub_path}, first record isnt a pre_archive_check')
+    last = records[-1]
+    header = _stub_header_line(records[0], last.get('state', last.get('entry_type')))
+    with open(stub_path, 'rb') as f:
+        f.readline()
+        log = f.read()
+    st = os.stat(stub_path)
+    tmp_path = f"{stub_path}.{uuid.uuid4().hex[:8]}.converting"
+    try:
+        with open(tmp_path, 'xb') as f:
+            f.write(header + log)
+            f.flush()
+            os.fsync(f.fileno())
+            # the owner of the stubfile has to be able to append its states, also when root converts it
+            tmp_st = os.fstat(f.fileno())
+            if (tmp_st.st_uid, tmp_st.st_gid) != (st.st_uid, st.st_gid):
+                try:
+                    os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                except PermissionError as e:
+                    raise RuntimeError(f"cant convert {stub_path} without changing its owner: {e}") from e
+        shutil.copystat(stub_path, tmp_path)
+        os.replace(tmp_path, stub_path)
+    finally:
+        Path(tmp_path).unlink(missing_ok=True)
+    return True
+
+def convert_stubfiles(paths: list[str]) -> tuple[int, int]:
+    ''' convert the given stubfiles and all stubfiles under the given directories, returns (converted, already compact) '''
+    converted = compact = 0
+    for path in paths:
+        if Path(path).is_dir():
+            stubs = [os.path.join(root, name) for root, _, files in os.walk(path) for name in files if name.endswith(STUBFILE_SUFFIX)]
+        else:
+            stubs = [path]
+        for stub in stubs:
+            if convert_stubfile(stub):
+                converted += 1
+            else:
+                compact += 1
+    return converted, compact
+
 def stubname(path: str):
     ''' get the stubname of a file '''
     assert isinstance(path, str)
@@ -209,64 +1069,493 @@ def stubname(path: str):
 
 def get_object_metadata(path):
     """ optional, calculate additional metadata for the object here """
-    return {'secondary_obj_id':str(uuid4())}
+    return {'secondary_obj_id':str(uuid.uuid4())}
 
 
-def archiving_pre_check(paths: list[str]):
-    # preflight checks:
-    if len(paths) > 1 and list(sorted(set(paths))) != list(sorted(paths)):
-        raise RuntimeError(f'object can only be specified and archived once')
-
-    for path in paths:
-        if not Path(path).exists():
-            raise RuntimeError(f"cant archive nonexistent file: {path}")
-        if not is_normal_file(path):
-            raise RuntimeError(f'error, refusing special files: {path}')
-        if get_filesize(path) < MIN_FILESIZE_BYTES:
-            raise RuntimeError(f'error, refusing to archive small files to tape: {path}')
-
-        if Path(stubname(path)).exists():
-            raise RuntimeError(f'''error, archive stubfile: {stubname(path)} already exists, the file likely has already been archived
-                                refusing to archive again''')
-        if not Path(path).is_file():
-            raise RuntimeError(f"object path is not a file, use '-r' with caution to archive directories")
+class PreflightReport(NamedTuple):
+    ''' result of checking a whole archive batch, stats of the files that passed and (path, reason) of all that didnt '''
+    stats: dict[str, os.stat_result]
+    failures: list[tuple[str, str]]
 
+def _preflight_file(path: str, own_stub: bool, known_stat: os.stat_result = None) -> tuple[os.stat_result, str]:
+    ''' check a single file, returns its stat result or the reason it cant be archived '''
+    try:
         validate_filepath(path)
-
-
-def archive_objects(paths: list[str]):
-    if not isinstance(paths, list): raise RuntimeError('paths must be list')
-    archiving_pre_check(paths)
-            
+    except ValueError as e:
+        return None, f'{e}: {path}'
+    # all checks are done on the opened inode, so the path cant be swapped between them.
+    # O_PATH only resolves the inode, so device nodes arent opened (closing a tape device rewinds it) and fifos dont block,
+    # with O_NOFOLLOW a symlink is opened itself and refused below
+    flags = os.O_PATH if hasattr(os, 'O_PATH') else os.O_RDONLY | os.O_NONBLOCK
+    try:
+        fd = os.open(path, flags | os.O_NOFOLLOW | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return None, f"cant archive nonexistent file: {path}"
+    except OSError as e:
+        if e.errno == errno.ELOOP:
+            return None, f'error, refusing special files: {path}'
+        return None, f"cant open {path}: {e}"
+    try:
+        st = os.fstat(fd)
+    finally:
+        os.close(fd)
+    if known_stat is not None and _inode(st) != _inode(known_stat):
+        return None, f"file was replaced since it was discovered: {path}"
+    if stat.S_ISDIR(st.st_mode):
+        return None, f"object path is not a file, use '-r' with caution to archive directories: {path}"
+    if not stat.S_ISREG(st.st_mode):
+        return None, f'error, refusing special files: {path}'
+    if st.st_size < MIN_FILESIZE_BYTES:
+        return None, f'error, refusing to archive small files to tape: {path}'
+    if not own_stub and os.path.lexists(stubname(path)):
+        return None, f'''error, archive stubfile: {stubname(path)} already exists, the file likely has already been archived
+                                refusing to archive again'''
+    return st, None
+
+def preflight_check(paths: list[str], own_stubs=frozenset(), stats: dict[str, os.stat_result] = None,
+                    workers: int = PREFLIGHT_WORKERS) -> PreflightReport:
+    ''' check a whole archive batch in parallel and report every file that cant be archived, instead of stopping at the first
+
+    own_stubs are paths whose stubfiles were written by an interrupted run of the same batch, that is resumed now.
+    stats are lstat results from discovering the paths, a file that was replaced since then fails
+    '''
+    stats = stats or {}
+    failures = [(path, f'object can only be specified and archived once: {path}')
+                for path, count in Counter(paths).items() if count > 1]
+    unique = list(dict.fromkeys(paths))
+    checked = {}
+    with span('preflight', files=len(paths)) as phase, \
+         futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(unique) or 1))) as executor:
+        results = executor.map(lambda p: _preflight_file(p, p in own_stubs, stats.get(p)), unique)
+        for path, (st, reason) in zip(unique, results):
+            if reason is None:
+                checked[path] = st
+            else:
+                failures.append((path, reason))
+        phase.update(bytes=sum(st.st_size for st in checked.values()), failures=len(failures))
+    return PreflightReport(checked, failures)
+
+def archiving_pre_check(paths: list[str], own_stubs=frozenset(), stats: dict[str, os.stat_result] = None) -> dict[str, os.stat_result]:
+    ''' preflight checks, raises with all problems of the batch, returns the stat results of the files '''
+    report = preflight_check(paths, own_stubs=own_stubs, stats=stats)
+    if report.failures:
+        raise RuntimeError(f"{len(report.failures)} of {len(paths)} files cant be archived:\n" +
+                           '\n'.join(reason for _, reason in report.failures))
+    return report.stats
+
+
+def _write_pre_archive_stubs(paths: list[str], checksums: dict[str, str], keep_existing=frozenset(),
+                             digests: dict[str, dict[str, str]] = None) -> list[str]:
     stubfiles = []
-    for path in paths:
-        assert isinstance(path, str)
-        print(f"Archiving {path}")
-        file_checksum = sha256sum(path)
-        metadata = get_object_metadata(path)
-        with open(path + '.archive_stub', 'wt') as f:
-            f.write(json.dumps({"entry_type":"pre_archive_check", "path":str(path), "sha256checksum":file_checksum, "metadata": metadata}) + '\n')
-        stubfiles.append(stubname(path))
-
-
+    with span('stub_write', files=len(paths)):
+        for path in paths:
+            assert isinstance(path, str)
+            print(f"Archiving {path}")
+            if path in keep_existing and Path(stubname(path)).exists():
+                # resuming, the stubfile of the interrupted run already has the checksum
+                append_stub_state(path, 'resumed_archiving')
+                stubfiles.append(stubname(path))
+                continue
+            file_checksum = checksums[path]
+            metadata = get_object_metadata(path)
+            record = {"entry_type":"pre_archive_check", "path":str(path), "sha256checksum":file_checksum, "size":get_filesize(path), "metadata": metadata}
+            # the faster digests to verify retrieves with, sha256checksum stays the reference
+            others = {algorithm: digest for algorithm, digest in (digests or {}).get(path, {}).items() if algorithm != 'sha256'}
+            if others:
+                record['digests'] = others
+            with open(path + '.archive_stub', 'wb') as f:
+                f.write(_stub_header_line(record) if compact_stubs else (json.dumps(record) + '\n').encode())
+            stubfiles.append(stubname(path))
+    return stubfiles
+
+def _upload_batch(paths: list[str], stubfiles: list[str]):
     # use a filelist to batch archive, this uses a single session instead of closing and opening as a plain loop would do
-    # importantly, sort the files, such that they're possibly more efficiently written
-    filelist = list(sorted(paths + stubfiles))
+    # importantly, sort the files, such that they're possibly more efficiently written, and keep every stubfile right after its object
+    assert set(stubfiles) == {stubname(path) for path in paths}
+    filelist = [name for path in sorted(paths) for name in (path, stubname(path))]
     with tempfile.NamedTemporaryFile(mode='w+', suffix='.txt', prefix='archive_upload_filelist_') as tmpfile:
         tmpfile.write('\n'.join(filelist))
         tmpfile.seek(0)
         cmd = ['dsmc', 'archive', f'-filelist={tmpfile.name}', '-changingretries=0', '-filesonly']
-        subproc(cmd)
-
+        total_bytes = sum(get_filesize(p) for p in filelist)
+        try:
+            with span('upload', files=len(paths), bytes=total_bytes):
+                run_dsmc_with_progress(cmd, total_bytes=total_bytes)
+        except BaseException:
+            for path in paths:
+                append_stub_state(path, 'archive_session_failed')
+            raise
+
+def _finish_archived(paths: list[str], checksums: dict[str, str], journal: 'ArchiveJournal' = None,
+                     inodes: dict[str, tuple[int, int]] = None):
     for path in paths:
-        with open(path + '.archive_stub', 'at') as f:
-            f.write(json.dumps({'entry_type':"state", "state":"successfully_archived", "path":str(path)}) + '\n')
+        append_stub_state(path, 'successfully_archived')
         print(f"successfully archived {path}")
 
+    catalog_add_archived([{'path': path, 'size': get_filesize(path), 'sha256checksum': checksums[path]} for path in paths])
+    if journal:
+        journal.record(paths, 'verified')
+
+    _unlink_archived(paths, journal, inodes=inodes)
+
+def _unlink_archived(paths: list[str], journal: 'ArchiveJournal' = None, missing_ok=False, inodes: dict[str, tuple[int, int]] = None):
+    ''' remove the archived originals, journaling every file right after it is gone, so an interrupted run resumes at the next file
+    missing_ok is for resuming, a file journaled as verified may already be removed.
+    inodes are the (st_dev, st_ino) of the files that were hashed, a file replaced since then is kept '''
+    with span('unlink', files=len(paths)):
+        for path in paths:
+            try:
+                if inodes and path in inodes and _inode(os.lstat(path)) != tuple(inodes[path]):
+                    print(f"warning, not removing {path}, it was replaced since it was archived")
+                    continue
+                Path(path).unlink()
+                print(f"successfully removed {path}")
+            except FileNotFoundError:
+                if not missing_ok:
+                    raise
+                print(f"{path} was already removed")
+            if journal:
+                journal.record([path], 'unlinked')
+
+def plan_cache_chunks(paths: list[str], sizes: dict[str, int], budget: int) -> list[list[str]]:
+    ''' split paths, in order, into consecutive chunks whose total size fits into budget
+    a single file bigger than the budget gets a chunk of its own '''
+    chunks = []
+    chunk, chunk_bytes = [], 0
     for path in paths:
-        Path(path).unlink(missing_ok=False)
-        print(f"successfully removed {path}")
-
+        if chunk and chunk_bytes + sizes[path] > budget:
+            chunks.append(chunk)
+            chunk, chunk_bytes = [], 0
+        chunk.append(path)
+        chunk_bytes += sizes[path]
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def partition_by_size(paths: list[str], sizes: dict[str, int], count: int) -> list[list[str]]:
+    ''' split paths into at most count partitions of about equal total size, biggest files are placed first '''
+    count = max(1, min(count, len(paths)))
+    heap = [(0, i) for i in range(count)]
+    partitions = [[] for _ in range(count)]
+    for path in sorted(paths, key=lambda p: (-sizes[p], p)):
+        load, i = heapq.heappop(heap)
+        partitions[i].append(path)
+        heapq.heappush(heap, (load + sizes[path], i))
+    return [list(sorted(partition)) for partition in partitions]
+
+def plan_archive_batches(paths: list[str], sizes: dict[str, int], sessions: int = 1,
+                         max_batch_bytes: int = MAX_BATCH_BYTES) -> list[list[list[str]]]:
+    ''' plan which session uploads which files in which batches, returns a list of batches per session
+
+    the sessions get about equal volumes, so the last one finishes as early as possible,
+    each session uploads its files in name order, in batches of at most max_batch_bytes (except for single bigger files),
+    so a failing dsmc session only has to be repeated for its own batch
+    '''
+    return [plan_cache_chunks(partition, sizes, max_batch_bytes)
+            for partition in partition_by_size(paths, sizes, sessions)]
+
+def print_archive_plan(plan: list[list[list[str]]], sizes: dict[str, int], session_rate: float = ESTIMATED_SESSION_BYTES_PER_SEC):
+    ''' print planned sessions and batches, with durations estimated from the throughput of a single session '''
+    makespan = 0.0
+    for i, batches in enumerate(plan):
+        session_bytes = sum(sizes[path] for batch in batches for path in batch)
+        makespan = max(makespan, session_bytes / session_rate)
+        print(f"session {i + 1}: {len(batches)} batches, {session_bytes / 1024**3:.2f} GiB, ~{_format_duration(session_bytes / session_rate)}")
+        for j, batch in enumerate(batches):
+            batch_bytes = sum(sizes[path] for path in batch)
+            print(f"  batch {j + 1}: {len(batch)} files, {batch_bytes / 1024**3:.2f} GiB, ~{_format_duration(batch_bytes / session_rate)}")
+            for path in batch:
+                print(f"    {sizes[path]:>16} {path}")
+    print(f"estimated total duration: ~{_format_duration(makespan)} at {session_rate / 1024**2:.0f} MiB/s per session")
+
+def _discover_dir(directory: str, min_size: int, min_age_seconds: float, excludes: list[str], now: float):
+    ''' list one directory, returns its subdirectories and the matching files with their lstat results '''
+    subdirs, candidates = [], {}
+    try:
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError as e:
+        print(f"warning, could not scan {directory}: {e}")
+        return subdirs, candidates
+    # the names in the listing tell which files already have a stubfile, without stat-ing for it
+    names = {entry.name for entry in entries}
+    for entry in entries:
+        if any(fnmatch.fnmatchcase(entry.path, pattern) or fnmatch.fnmatchcase(entry.name, pattern) for pattern in excludes):
+            continue
+        # the file type comes from the directory listing, no stat needed
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+            continue
+        if entry.name.endswith(STUBFILE_SUFFIX) or entry.name + STUBFILE_SUFFIX in names:
+            continue
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        try:
+            st = entry.stat(follow_symlinks=False) # the single lstat of the file
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode) or st.st_size < min_size:
+            continue
+        if now - max(st.st_mtime, st.st_atime) < min_age_seconds:
+            continue
+        try:
+            validate_filepath(entry.path)
+        except ValueError as e:
+            print(f"warning, skipping {entry.path}: {e}")
+            continue
+        candidates[entry.path] = st
+    return subdirs, candidates
+
+def discover_candidates(roots: list[str], min_size: int = None, min_age_days: float = 0, excludes: list[str] = (),
+                        workers: int = SCAN_WORKERS) -> dict[str, os.stat_result]:
+    ''' find files to archive under roots, returns their paths with their lstat results
+
+    files qualify if they are regular files of at least min_size bytes (never below MIN_FILESIZE_BYTES),
+    were neither modified nor accessed in the last min_age_days and have no stubfile yet.
+    excludes are glob patterns, matched against the full path and the name, excluded directories are not entered
+    '''
+    min_size = max(min_size or 0, MIN_FILESIZE_BYTES)
+    now = time.time()
+    candidates = {}
+    level = [os.path.abspath(root) for root in roots]
+    with futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        while level:
+            next_level = []
+            for subdirs, found in executor.map(lambda d: _discover_dir(d, min_size, min_age_days * 86400, list(excludes), now), level):
+                next_level += subdirs
+                candidates.update(found)
+            level = next_level
+    return dict(sorted(candidates.items()))
+
+def archive_objects(paths: list[str], hash_workers: int = None, hash_processes=False, pipelined=False, cache_budget: int = PAGECACHE_BUDGET_BYTES,
+                    sessions: int = 1, max_batch_bytes: int = MAX_BATCH_BYTES, dry_run=False,
+                    journal: 'ArchiveJournal' = None, known_checksums: dict[str, str] = None, stats: dict[str, os.stat_result] = None):
+    ''' known_checksums are the checksums in the stubfiles of an interrupted run of the same journal, they arent computed again
+    stats are lstat results from discover_candidates, files replaced since then are refused '''
+    if not isinstance(paths, list): raise RuntimeError('paths must be list')
+    known_checksums = known_checksums or {}
+    stats = archiving_pre_check(paths, own_stubs=frozenset(known_checksums), stats=stats)
+    if not paths:
+        return []
+
+    sizes = {path: stats[path].st_size for path in paths}
+    if pipelined:
+        # hashing the next batch overlaps with uploading the current one, both have to fit into the cache
+        oversize = [path for path in paths if sizes[path] > cache_budget // 2]
+        if oversize:
+            # every such file would get a dsmc session of its own, and still be read from disk twice
+            print(f"warning, {len(oversize)} files are bigger than half the cache budget of {cache_budget} bytes, "
+                  f"archiving without --pipelined in batches of up to {max_batch_bytes} bytes")
+            pipelined = False
+        else:
+            max_batch_bytes = min(max_batch_bytes, max(1, cache_budget // 2))
+    plan = plan_archive_batches(paths, sizes, sessions, max_batch_bytes)
+    if dry_run:
+        print_archive_plan(plan, sizes)
+        return plan
+
+    if journal is None:
+        journal = ArchiveJournal.create(paths)
+    print(f"journal of this batch: {journal.path}, resume an interrupted run with: archive --resume {journal.path}")
+
+    # the files are hashed and removed only while they are still the inodes that were checked
+    inodes = {path: _inode(st) for path, st in stats.items()}
+    with span('archive', files=len(paths), bytes=sum(sizes.values()), sessions=len(plan)):
+        failed = _run_archive_sessions(plan, hash_workers, hash_processes, pipelined, journal, known_checksums, inodes)
+    if failed:
+        raise PartialFailure(f'archiving failed for: {", ".join(failed)}, resume with: archive --resume {journal.path}', failed)
+    if journal.is_complete():
+        journal.remove()
+    return plan
+
+def _run_archive_sessions(plan: list[list[list[str]]], hash_workers, hash_processes, pipelined,
+                          journal: 'ArchiveJournal', known_checksums: dict[str, str], inodes: dict[str, tuple[int, int]]) -> list[str]:
+    if len(plan) == 1:
+        failed = _archive_session(plan[0], hash_workers, hash_processes, pipelined, journal, known_checksums, inodes)
+    else:
+        # several dsmc sessions at the same time, each with its own share of the batch, to use more than one drive
+        print(f"archiving {sum(len(batch) for batches in plan for batch in batches)} files in {len(plan)} concurrent sessions")
+        # the sessions hash at the same time, so they share the hash workers
+        session_hash_workers = max(1, (hash_workers or HASH_WORKERS) // len(plan))
+        with futures.ThreadPoolExecutor(max_workers=len(plan)) as executor:
+            # every session thread runs in a copy of the context, so its dsmc processes belong to the current job
+            sessions = [executor.submit(contextvars.copy_context().run, _archive_session, batches, session_hash_workers, hash_processes, pipelined, journal, known_checksums, inodes)
+                       for batches in plan]
+        failed = [path for future in sessions for path in future.result()]
+    return failed
+
+def _archive_session(batches: list[list[str]], hash_workers, hash_processes, pipelined,
+                     journal: 'ArchiveJournal', known_checksums: dict[str, str], inodes: dict[str, tuple[int, int]] = None) -> list[str]:
+    ''' archive batches one dsmc session after another, returns the paths of failed batches
+
+    without pipelining, all batches are hashed up front.
+    with pipelining, the checksum pass of a batch pulls it into the page cache and its dsmc session then reads it from there,
+    while one batch uploads, the next one is already hashed, so every byte is read from disk only once
+    '''
+    algorithms = digest_algorithms()
+    def hash_batch(batch):
+        missing = [path for path in batch if path not in known_checksums]
+        print(f"hashing {len(missing)} files")
+        # pipelining hashes to fill the page cache for dsmc, direct io would bypass it
+        digests = cached_hash_files(missing, workers=hash_workers, use_processes=hash_processes, direct_io=False if pipelined else None,
+                                    algorithms=algorithms, inodes=inodes)
+        # resumed files keep their stubfile, only its checksum is needed
+        return {path: {'sha256': known_checksums[path]} if path in known_checksums else digests[path] for path in batch}
+
+    failed = []
+    with futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+        if pipelined:
+            pending = prefetcher.submit(hash_batch, batches[0])
+        else:
+            all_digests = hash_batch([path for batch in batches for path in batch])
+        for i, batch in enumerate(batches):
+            if pipelined:
+                digests = pending.result()
+                if i + 1 < len(batches):
+                    # overlap hashing the next batch with the upload of this one
+                    pending = prefetcher.submit(hash_batch, batches[i + 1])
+            else:
+                digests = {path: all_digests[path] for path in batch}
+            checksums = {path: file_digests['sha256'] for path, file_digests in digests.items()}
+            with span('archive_batch', files=len(batch)) as phase:
+                if metrics_enabled():
+                    phase['bytes'] = sum(get_filesize(path) for path in batch)
+                stubfiles = _write_pre_archive_stubs(batch, checksums, keep_existing=frozenset(known_checksums), digests=digests)
+                journal.record(batch, 'hashed', checksums)
+                try:
+                    _upload_batch(batch, stubfiles)
+                except Exception as e:
+                    print(f"archive session for {len(batch)} files failed: {e}")
+                    phase['failed'] = True
+                    failed += batch
+                    continue
+                journal.record(batch, 'uploaded')
+                if pipelined:
+                    # the batch is on tape now, free the cache for the batches still to come
+                    evict_from_page_cache(batch)
+                _finish_archived(batch, checksums, journal, inodes)
+    return failed
+
+
+ARCHIVE_PHASES = ('hashed', 'uploaded', 'verified', 'unlinked')
+
+class ArchiveJournal:
+    ''' append-only record of the phase every file of an archive batch reached, so an interrupted batch can be resumed
+
+    hashed: the stubfile with the checksum is written, uploaded: the dsmc session of the file succeeded,
+    verified: the stubfile is marked as successfully archived, unlinked: the original file is removed
+    '''
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, paths: list[str]) -> 'ArchiveJournal':
+        Path(JOURNAL_DIR).mkdir(parents=True, exist_ok=True)
+        batch_id = f"{datetime.datetime.now().strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        journal = cls(Path(JOURNAL_DIR) / f"archive_{batch_id}.journal")
+        with open(journal.path, 'xt') as f:
+            f.write(json.dumps({'entry_type':"batch", 'batch_id':batch_id, 'paths':list(paths)}) + '\n')
+        return journal
+
+    def record(self, paths: list[str], phase: str, checksums: dict[str, str] = None):
+        assert phase in ARCHIVE_PHASES
+        entries = []
+        for path in paths:
+            entry = {'entry_type':"phase", 'phase':phase, 'path':str(path)}
+            if phase == 'hashed':
+                st = os.stat(path)
+                entry.update({'sha256checksum':checksums[path], 'size':st.st_size, 'mtime_ns':st.st_mtime_ns, 'dev':st.st_dev, 'ino':st.st_ino})
+            entries.append(json.dumps(entry) + '\n')
+        with self._lock, open(self.path, 'at') as f:
+            f.write(''.join(entries))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self) -> tuple[list[str], dict[str, dict]]:
+        ''' returns the paths of the batch and the latest phase entry of every path that reached one,
+        with the checksum and stat of its hashed entry '''
+        records = parse_stubfile(self.path)
+        if not records or records[0]['entry_type'] != 'batch':
+            raise RuntimeError(f'error parsing journal {self.path}, first record isnt a batch')
+        phases = {}
+        for record in records[1:]:
+            phases[record['path']] = dict(phases.get(record['path'], {}), **record)
+        return records[0]['paths'], phases
+
+    def is_complete(self) -> bool:
+        paths, phases = self.read()
+        return all(phases.get(path, {}).get('phase') == 'unlinked' for path in paths)
+
+    def remove(self):
+        Path(self.path).unlink(missing_ok=True)
+
+def query_uploaded(paths: list[str]) -> set[str]:
+    ''' the paths whose object, with its current size, and stubfile are both in the archive, from one dsmc session '''
+    if not paths:
+        return set()
+    found = {}
+    with tempfile.NamedTemporaryFile(mode='w+', suffix='.txt', prefix='archive_query_filelist_') as tmpfile:
+        tmpfile.write('\n'.join(name for path in paths for name in (path, stubname(path))))
+        tmpfile.seek(0)
+        try:
+            for entry in iter_archive_entries(subproc_lines(['dsmc', 'query', 'archive', f'-filelist={tmpfile.name}'])):
+                found[entry.path] = entry.size
+        except subprocess.CalledProcessError as e:
+            # ANS1092W: none of them is archived
+            if 'ANS1092W' not in str(e.output) + str(e.stderr):
+                raise
+    return {path for path in paths if found.get(path) == get_filesize(path) and stubname(path) in found}
+
+def resume_archive(journal_path: str, **options):
+    ''' continue an interrupted archive batch, skipping hashing and uploads that already completed '''
+    journal = ArchiveJournal(journal_path)
+    paths, phases = journal.read()
+    remaining, known_checksums = [], {}
+    # whether the hashed files were uploaded before the interruption, asked for all of them at once
+    hashed = [path for path in paths if phases.get(path, {}).get('phase') == 'hashed' and Path(stubname(path)).exists()]
+    uploaded = set() if options.get('dry_run') else query_uploaded(hashed)
+    for path in paths:
+        entry = phases.get(path, {})
+        phase = entry.get('phase')
+        if phase == 'unlinked':
+            continue
+        if options.get('dry_run'):
+            print(f"{path}: {phase or 'not hashed yet'}")
+            if phase in (None, 'hashed'):
+                remaining.append(path)
+                if phase == 'hashed':
+                    known_checksums[path] = entry['sha256checksum']
+            continue
+        # journals of older versions dont have the inode
+        inodes = {path: (entry['dev'], entry['ino'])} if 'ino' in entry else None
+        if phase == 'verified':
+            _unlink_archived([path], journal, missing_ok=True, inodes=inodes)
+            continue
+        if phase == 'uploaded':
+            _finish_archived([path], {path: get_original_checksum(path)}, journal, inodes)
+            continue
+        if phase == 'hashed' and Path(stubname(path)).exists():
+            st = os.stat(path)
+            if (st.st_size, st.st_mtime_ns) == (entry['size'], entry['mtime_ns']):
+                if path in uploaded:
+                    print(f"{path} was already uploaded")
+                    journal.record([path], 'uploaded')
+                    _finish_archived([path], {path: entry['sha256checksum']}, journal, inodes)
+                    continue
+                known_checksums[path] = entry['sha256checksum']
+            else:
+                print(f"{path} changed since it was hashed, hashing it again")
+                Path(stubname(path)).unlink()
+        elif Path(stubname(path)).exists():
+            # the run was interrupted between writing the stubfile and journaling it, the batch was prechecked without stubfiles
+            Path(stubname(path)).unlink()
+        remaining.append(path)
+
+    print(f"resuming {journal.path}: {len(paths) - len(remaining)} of {len(paths)} files are done, {len(known_checksums)} are already hashed")
+    archive_objects(remaining, journal=journal, known_checksums=known_checksums, **options)
+    if Path(journal.path).exists() and not options.get('dry_run') and journal.is_complete():
+        journal.remove()
 
 def get_filesize(path) -> int:
     stat = os.stat(path) # returns size in bytes
@@ -304,6 +1593,464 @@ def list_archived_objects(paths, ignore_missing):
         result = list_archived_objects_under_path(p, ignore_error=ignore_missing)
         print(f"archives under {p}: {result}")
 
+ARCHIVE_QUERY_HEADER_PATTERN = re.compile(r"^\s*Size\s+Archive\s+Date\s+-\s+Time\s+File\s+-\s+Expires\s+on\s+-\s+Description\s*$")
+ARCHIVE_QUERY_ENTRY_PATTERN = re.compile(
+    r"^\s*(?P<size>[\d,.]+)\s+(?P<unit>B|KB|MB|GB|TB)\s+(?P<date>\d{2}/\d{2}/\d{2,4})\s+(?P<time>\d{2}:\d{2}:\d{2})\s+"
+    r"(?P<path>/.*?)\s+(?P<expires>Never|\d{2}/\d{2}/\d{2,4})(?:\s+(?P<description>.*?))?\s*$")
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024**2, 'GB': 1024**3, 'TB': 1024**4}
+
+def parse_dsmc_datetime(date: str, time: str = '00:00:00') -> str:
+    ''' convert a dsmc date like 08/15/2025 into a sortable iso timestamp, unknown formats are kept as they are '''
+    for fmt in ('%m/%d/%Y %H:%M:%S', '%m/%d/%y %H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(f"{date} {time}", fmt).isoformat()
+        except ValueError:
+            pass
+    return f"{date} {time}"
+
+class ArchiveEntry(NamedTuple):
+    ''' one archived object, as listed by dsmc query archive '''
+    size: int
+    archive_date: str
+    path: str
+    expires: str
+    description: str
+
+def iter_archive_entries(lines: Iterable[str]) -> Iterator[ArchiveEntry]:
+    '''
+    parse the output of dsmc query archive line by line and yield its entries as soon as they are read.
+    fail hard on lines that cant be parsed, like parse_file_space_names
+    '''
+    state = 'banner'
+    for i, line in enumerate(lines):
+        line = line.rstrip('\n')
+        if state == 'banner':
+            if ARCHIVE_QUERY_HEADER_PATTERN.match(line):
+                state = 'separator'
+            continue
+        if state == 'separator':
+            if not re.match(r"^[-\s]+$", line):
+                raise ValueError(f"Separator line not found or invalid: '{line}'")
+            state = 'entries'
+            continue
+
+        if not line.strip() or line.lstrip().startswith('ANS'):
+            continue
+        match = ARCHIVE_QUERY_ENTRY_PATTERN.match(line)
+        if not match:
+            raise ValueError(f"Failed to parse line {i+1}: '{line}'")
+        size = float(match.group('size').replace(',', '')) * SIZE_UNITS[match.group('unit')]
+        expires = match.group('expires')
+        yield ArchiveEntry(
+            size=int(size),
+            archive_date=parse_dsmc_datetime(match.group('date'), match.group('time')),
+            path=match.group('path'),
+            expires=expires if expires == 'Never' else parse_dsmc_datetime(expires),
+            description=match.group('description') or '',
+        )
+    if state != 'entries':
+        raise ValueError("Header not found")
+
+def parse_archive_query(text: str) -> list[ArchiveEntry]:
+    return list(iter_archive_entries(text.splitlines()))
+
+def iter_archived_objects_under_path(path: str) -> Iterator[ArchiveEntry]:
+    ''' stream the archived objects under path from the server, without holding the whole listing in memory '''
+    try:
+        yield from iter_archive_entries(subproc_lines(['dsmc', 'query', 'archive', '-subdir=yes', path]))
+    except subprocess.CalledProcessError as e:
+        # ANS1092W: no files matching the search criteria, thats an empty listing and not an error
+        if 'ANS1092W' not in str(e.output) + str(e.stderr):
+            raise
+
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    archive_date TEXT,
+    expires TEXT,
+    description TEXT,
+    sha256checksum TEXT,
+    source TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_size ON objects (size);
+CREATE INDEX IF NOT EXISTS objects_archive_date ON objects (archive_date);
+CREATE INDEX IF NOT EXISTS objects_sha256checksum ON objects (sha256checksum);
+CREATE TABLE IF NOT EXISTS stubs (
+    stub_path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    path TEXT,
+    state TEXT,
+    sha256checksum TEXT,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS stubs_dir ON stubs (dir);
+CREATE TABLE IF NOT EXISTS scanned_dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tape_locations (
+    path TEXT PRIMARY KEY,
+    volume TEXT,
+    restore_order TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS synced_patterns (
+    pattern TEXT PRIMARY KEY,
+    synced_at TEXT NOT NULL
+);
+'''
+
+def open_catalog(path: str = None) -> sqlite3.Connection:
+    ''' open the local catalog, create it if it doesnt exist yet '''
+    path = path or CATALOG_PATH
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(CATALOG_SCHEMA)
+    return conn
+
+def _prefix_range(prefix: str) -> tuple[str, str]:
+    ''' bounds for an indexed prefix search, all strings starting with prefix are >= low and < high '''
+    if not prefix:
+        return '', chr(0x10ffff)
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def catalog_add_archived(entries: list[dict]):
+    ''' record freshly archived objects, the catalog is a cache, so failing to update it only warns '''
+    now = datetime.datetime.now().replace(microsecond=0).isoformat()
+    try:
+        with closing(open_catalog()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO objects (path, size, archive_date, expires, description, sha256checksum, source) "
+                "VALUES (:path, :size, :archive_date, NULL, '', :sha256checksum, 'stub')",
+                [{'archive_date': now, **entry} for entry in entries])
+    except sqlite3.Error as e:
+        print(f"warning, could not update the local catalog {CATALOG_PATH}: {e}")
+
+def catalog_remove(names: list[str]):
+    try:
+        with closing(open_catalog()) as conn, conn:
+            conn.executemany("DELETE FROM objects WHERE path = ?", [(name,) for name in names])
+            conn.executemany("DELETE FROM tape_locations WHERE path = ?", [(name,) for name in names])
+    except sqlite3.Error as e:
+        print(f"warning, could not update the local catalog {CATALOG_PATH}: {e}")
+
+def refresh_catalog(paths: list[str], ignore_missing=False):
+    ''' resync the local catalog with the archive server, for all paths or all filespaces if no paths are given '''
+    if paths == []:
+        filespaces = get_all_filespaces()
+        patterns = [p.removesuffix('/') + '/*' for p in filespaces]
+    else:
+        patterns = paths
+
+    with closing(open_catalog()) as conn:
+        # the paths the server listed, only this connection sees them
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS listed (path TEXT PRIMARY KEY)")
+        for pattern in patterns:
+            if pattern.endswith('*') or pattern.endswith('/'):
+                low, high = _prefix_range(pattern.removesuffix('*'))
+                where, params = "path >= ? AND path < ?", (low, high)
+            else:
+                where, params = "path = ?", (pattern,)
+            # stubfiles are archived next to their objects but arent objects themselves
+            entries = (e._asdict() for e in iter_archived_objects_under_path(pattern) if not e.path.endswith(STUBFILE_SUFFIX))
+            try:
+                # upsert what the server lists while streaming, in chunks, then sweep what it didnt list, known checksums are kept.
+                # an interrupted refresh leaves only upserts of objects the server listed
+                with conn:
+                    conn.execute("DELETE FROM temp.listed")
+                while chunk := list(itertools.islice(entries, CATALOG_COMMIT_ROWS)):
+                    with conn:
+                        conn.executemany(
+                            "INSERT INTO objects (path, size, archive_date, expires, description, sha256checksum, source) "
+                            "VALUES (:path, :size, :archive_date, :expires, :description, NULL, 'server') "
+                            "ON CONFLICT (path) DO UPDATE SET size = excluded.size, archive_date = excluded.archive_date, "
+                            "expires = excluded.expires, description = excluded.description, source = 'server'",
+                            chunk)
+                        conn.executemany("INSERT OR IGNORE INTO temp.listed (path) VALUES (:path)", chunk)
+                with conn:
+                    conn.execute(f"DELETE FROM objects WHERE {where} AND path NOT IN (SELECT path FROM temp.listed)", params)
+                    conn.execute("INSERT OR REPLACE INTO synced_patterns (pattern, synced_at) VALUES (?, ?)",
+                                 (pattern, datetime.datetime.now().replace(microsecond=0).isoformat()))
+            except subprocess.CalledProcessError as e:
+                if not ignore_missing:
+                    raise
+                print(f"Query archive operation failed: {e}")
+                continue
+            count = conn.execute(f"SELECT count(*) FROM objects WHERE {where}", params).fetchone()[0]
+            print(f"catalog synced {count} objects under {pattern}")
+
+def unsynced_prefixes(prefixes: list[str] = ()) -> list[str]:
+    ''' the prefixes the local catalog was never synced with the server for, [''] if it never was synced at all '''
+    with closing(open_catalog()) as conn:
+        synced = [row['pattern'] for row in conn.execute("SELECT pattern FROM synced_patterns")]
+
+    def covered(prefix, pattern):
+        if pattern.endswith('*') or pattern.endswith('/'):
+            return prefix.removesuffix('*').startswith(pattern.removesuffix('*'))
+        return prefix == pattern
+
+    if not prefixes:
+        return [] if synced else ['']
+    return [prefix for prefix in prefixes if not any(covered(prefix, pattern) for pattern in synced)]
+
+def query_catalog(prefixes: list[str] = (), min_size: int = None, max_size: int = None,
+                  since: str = None, until: str = None, checksum: str = None) -> list[sqlite3.Row]:
+    ''' query the local catalog, dates are iso formatted strings, since is inclusive and until exclusive '''
+    clauses, params = [], []
+    if prefixes:
+        prefix_clauses = []
+        for prefix in prefixes:
+            low, high = _prefix_range(prefix.removesuffix('*'))
+            prefix_clauses.append("(path >= ? AND path < ?)")
+            params += [low, high]
+        clauses.append('(' + ' OR '.join(prefix_clauses) + ')')
+    for clause, value in [("size >= ?", min_size), ("size <= ?", max_size), ("archive_date >= ?", since),
+                          ("archive_date < ?", until), ("sha256checksum = ?", checksum and checksum.lower())]:
+        if value is not None:
+            clauses.append(clause)
+            params.append(value)
+    sql = "SELECT * FROM objects"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    with closing(open_catalog()) as conn:
+        return conn.execute(sql + " ORDER BY path", params).fetchall()
+
+def print_catalog(rows: list[sqlite3.Row]):
+    for row in rows:
+        print(f"{row['size'] if row['size'] is not None else '?':>16}  {row['archive_date'] or '?':19}  {row['sha256checksum'] or '-':64}  {row['path']}")
+    print(f"{len(rows)} archived objects")
+
+def _stub_index_entry(stub_path: str, directory: str) -> dict:
+    try:
+        header = read_stub_header(stub_path)
+    except (OSError, ValueError) as e:
+        print(f"warning, could not read stubfile {stub_path}: {e}")
+        return {'stub_path': stub_path, 'dir': directory, 'path': None, 'state': 'unreadable', 'sha256checksum': None, 'size': None}
+    return {
+        'stub_path': stub_path,
+        'dir': directory,
+        'path': header.get('path'),
+        'state': header['state'],
+        'sha256checksum': header.get('sha256checksum'),
+        'size': header.get('size'),
+    }
+
+def _scan_stub_dir(directory: str, known_mtime_ns: int, known_subdirs: list[str]):
+    ''' scan one directory for stubfiles, returns (mtime_ns, subdirs, stub entries)
+    the entries are None, if the directory didnt change since the last scan, then its old index entries are still valid '''
+    try:
+        mtime_ns = os.stat(directory, follow_symlinks=False).st_mtime_ns
+    except OSError:
+        return None, [], []
+    if mtime_ns == known_mtime_ns:
+        return mtime_ns, known_subdirs, None
+
+    subdirs, stubs = [], []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(STUBFILE_SUFFIX) and entry.is_file(follow_symlinks=False):
+                    stubs.append(_stub_index_entry(entry.path, directory))
+    except OSError as e:
+        print(f"warning, could not scan {directory}: {e}")
+        return None, [], []
+    return mtime_ns, subdirs, stubs
+
+def scan_stubs(root: str, workers: int = SCAN_WORKERS, full=False) -> dict[str, int]:
+    ''' index all stubfiles under root into the local catalog, returns the number of indexed stubfiles per state
+
+    directories are scanned in parallel, level by level.
+    directories whose mtime didnt change since the last scan are not read again, together with their stubfiles,
+    their subdirectories are still visited. a stubfile that only got a new record appended doesnt change the mtime
+    of its directory, use full to read everything again
+    '''
+    root = os.path.abspath(root)
+    low, high = _prefix_range(root.removesuffix('/') + '/')
+    with closing(open_catalog()) as conn:
+        if full:
+            known = {}
+        else:
+            known = {row['path']: (row['mtime_ns'], json.loads(row['subdirs'])) for row in
+                     conn.execute("SELECT * FROM scanned_dirs WHERE path = ? OR (path >= ? AND path < ?)", (root, low, high))}
+        visited = set()
+        level = [root]
+        scanned = reused = 0
+        with futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            while level:
+                results = executor.map(lambda d: _scan_stub_dir(d, *known.get(d, (None, []))), level)
+                next_level = []
+                with conn:
+                    for directory, (mtime_ns, subdirs, stubs) in zip(level, results):
+                        if mtime_ns is None:
+                            continue
+                        visited.add(directory)
+                        next_level += subdirs
+                        if stubs is None:
+                            reused += 1
+                            continue
+                        scanned += 1
+                        conn.execute("INSERT OR REPLACE INTO scanned_dirs (path, mtime_ns, subdirs) VALUES (?, ?, ?)",
+                                     (directory, mtime_ns, json.dumps(subdirs)))
+                        conn.execute("DELETE FROM stubs WHERE dir = ?", (directory,))
+                        conn.executemany("INSERT OR REPLACE INTO stubs (stub_path, dir, path, state, sha256checksum, size) "
+                                         "VALUES (:stub_path, :dir, :path, :state, :sha256checksum, :size)", stubs)
+                level = next_level
+
+        # forget directories that are gone
+        with conn:
+            gone = [(d[0],) for d in conn.execute("SELECT path FROM scanned_dirs WHERE path = ? OR (path >= ? AND path < ?)",
+                                                (root, low, high)).fetchall() if d[0] not in visited]
+            conn.executemany("DELETE FROM stubs WHERE dir = ?", gone)
+            conn.executemany("DELETE FROM scanned_dirs WHERE path = ?", gone)
+        counts = dict(conn.execute("SELECT state, count(*) FROM stubs WHERE dir = ? OR (dir >= ? AND dir < ?) GROUP BY state",
+                                   (root, low, high)).fetchall())
+    print(f"scanned {scanned} directories, {reused} unchanged directories reused from the index")
+    return counts
+
+
+
+# with -detail, dsmc query archive prints where every object is stored below its entry, like:
+#   Media Class: Library  Volume ID: 000123  Restore Order: 00000000-00000021-00000000-0BEFAA8D
+DSMC_VOLUME_ID_PATTERN = re.compile(r'\bVolume ID:\s*(?P<volume>\S+)')
+DSMC_RESTORE_ORDER_PATTERN = re.compile(r'\bRestore Order:\s*(?P<order>[0-9A-Fa-f]+(?:-[0-9A-Fa-f]+)*)')
+
+class TapeLocation(NamedTuple):
+    volume: str
+    restore_order: tuple[int, ...] # objects read in this order come off the media front to back
+
+def _tape_location(volume: str, restore_order: str) -> TapeLocation:
+    order = tuple(int(part, 16) for part in restore_order.split('-'))
+    # without a volume id, the leading part of the restore order still tells the volumes apart
+    return TapeLocation(volume or restore_order.rsplit('-', 2)[0], order)
+
+def iter_archive_locations(lines: Iterable[str]) -> Iterator[tuple[str, TapeLocation]]:
+    ''' parse the output of dsmc query archive -detail, yields (path, location) of the objects it reports a restore order for '''
+    path = volume = None
+    for line in lines:
+        match = ARCHIVE_QUERY_ENTRY_PATTERN.match(line)
+        if match:
+            path, volume = match.group('path'), None
+            continue
+        if path is None:
+            continue
+        volume_match = DSMC_VOLUME_ID_PATTERN.search(line)
+        if volume_match:
+            volume = volume_match.group('volume')
+        order_match = DSMC_RESTORE_ORDER_PATTERN.search(line)
+        if order_match:
+            yield path, _tape_location(volume, order_match.group('order'))
+            path = None
+
+def query_tape_locations(names: list[str]) -> dict[str, TapeLocation]:
+    ''' where the objects are stored, from the catalog, or from one dsmc session for the ones it doesnt know yet
+
+    objects dsmc doesnt report a location for are left out, the locations are only used for ordering
+    '''
+    locations = {}
+    try:
+        with closing(open_catalog()) as conn:
+            for name in names:
+                row = conn.execute("SELECT volume, restore_order FROM tape_locations WHERE path = ?", (name,)).fetchone()
+                if row is not None:
+                    locations[name] = _tape_location(row['volume'], row['restore_order'])
+    except sqlite3.Error as e:
+        print(f"warning, could not read the local catalog {CATALOG_PATH}: {e}")
+    missing = [name for name in names if name not in locations]
+    if not missing:
+        return locations
+
+    found = {}
+    with tempfile.NamedTemporaryFile(mode='w+', suffix='.txt', prefix='archive_query_filelist_') as tmpfile:
+        tmpfile.write('\n'.join(missing))
+        tmpfile.seek(0)
+        try:
+            lines = subproc_lines(['dsmc', 'query', 'archive', '-detail', f'-filelist={tmpfile.name}'])
+            for path, location in iter_archive_locations(lines):
+                found[path] = location
+        except subprocess.CalledProcessError as e:
+            print(f"warning, could not query the tape locations, continuing without: {e}")
+    wanted = set(missing)
+    found = {path: location for path, location in found.items() if path in wanted}
+    try:
+        with closing(open_catalog()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO tape_locations (path, volume, restore_order) VALUES (?, ?, ?)",
+                             [(path, location.volume, '-'.join(f'{part:08X}' for part in location.restore_order))
+                              for path, location in found.items()])
+    except sqlite3.Error as e:
+        print(f"warning, could not update the local catalog {CATALOG_PATH}: {e}")
+    locations.update(found)
+    return locations
+
+def group_by_volume(names: list[str], locations: dict[str, TapeLocation]) -> list[list[str]]:
+    ''' one group per volume, in restore order, objects with an unknown location come last, by name '''
+    volumes = {}
+    for name in names:
+        if name in locations:
+            volumes.setdefault(locations[name].volume, []).append(name)
+    groups = [sorted(group, key=lambda name: locations[name].restore_order) for group in volumes.values()]
+    groups.sort(key=lambda group: locations[group[0]].restore_order)
+    unknown = sorted(name for name in names if name not in locations)
+    return groups + ([unknown] if unknown else [])
+
+
+def count_mounts(order: list[str], locations: dict[str, TapeLocation]) -> int:
+    ''' tape mounts reading the objects in this order takes, every change of the volume is another mount '''
+    mounts, volume = 0, None
+    for name in order:
+        if name in locations and locations[name].volume != volume:
+            mounts += 1
+            volume = locations[name].volume
+    return mounts
+
+class RetrievePlan(NamedTuple):
+    order: list[str] # the filelist, every volume front to back, objects with an unknown location last
+    locations: dict[str, TapeLocation]
+    mounts: int
+    unsorted_mounts: int # mounts reading the same objects in name order takes
+
+def plan_retrieve(names: list[str]) -> RetrievePlan:
+    ''' order the objects so every volume is mounted once and read front to back, and estimate the tape mounts '''
+    locations = query_tape_locations(names)
+    order = [name for group in group_by_volume(names, locations) for name in group]
+    return RetrievePlan(order, locations, count_mounts(order, locations), count_mounts(sorted(names), locations))
+
+def print_retrieve_plan(plan: RetrievePlan):
+    volume = ''
+    for name in plan.order:
+        location = plan.locations.get(name)
+        if (location.volume if location else None) != volume:
+            volume = location.volume if location else None
+            print(f"volume {volume}:" if location else "unknown location:")
+        print(f"    {name}")
+    unknown = len(plan.order) - len(plan.locations)
+    print(f"estimated tape mounts: {plan.mounts}, instead of {plan.unsorted_mounts} in name order" +
+          (f", plus up to {unknown} for the objects with an unknown location" if unknown else ''))
+
+
+def _get_pre_archive_record(name: str) -> dict:
+    record = read_stub_header(stubname(name))
+    if not record['entry_type'] == 'pre_archive_check':
+        raise RuntimeError(f'error parsing stubfile, first records isnt a pre_archive_check')
+    return record
+
+def get_original_checksum(name: str) -> str:
+    ''' get the checksum of an object, as recorded in its stubfile before archiving '''
+    return _get_pre_archive_record(name)['sha256checksum']
+
+def get_original_digests(name: str) -> dict[str, str]:
+    ''' all digests of an object recorded in its stubfile, by algorithm, older stubfiles only have sha256 '''
+    record = _get_pre_archive_record(name)
+    return {'sha256': record['sha256checksum'], **record.get('digests', {})}
+
+def get_original_size(name: str) -> int:
+    ''' get the size of an object as recorded in its stubfile, None for stubfiles written before sizes were recorded '''
+    return _get_pre_archive_record(name).get('size')
+
 def get_from_archive(name: str, destination: str):
     print(f"getting {name} to {destination}")
     if name.endswith('.archive_stub'):
@@ -316,18 +2063,108 @@ def get_from_archive(name: str, destination: str):
     if Path(destination).exists():
         raise RuntimeError(f"destination path is not free, there is already a file or folder: {destination}")
 
-    stubfile_records = parse_stubfile(stubname(name))
-    if not stubfile_records[0]['entry_type'] == 'pre_archive_check':
-        raise RuntimeError(f'error parsing stubfile, first records isnt a pre_archive_check')
-    original_checksum = stubfile_records[0]['sha256checksum']
+    original_digests = get_original_digests(name)
+    algorithm = verify_algorithm(original_digests)
+    original_checksum = original_digests[algorithm]
 
-    subproc(['dsmc', 'retrieve', '-replace=no', '-subdir=no', name, destination])
-    print(f"{name} retrieved, now verifying")
-    file_checksum = sha256sum(destination)
+    # hash the destination while dsmc is still writing it, instead of re-reading it after the retrieve
+    retrieve_done = threading.Event()
+    def retrieve():
+        try:
+            with span('retrieve', files=1, bytes=get_original_size(name)):
+                run_dsmc_with_progress(['dsmc', 'retrieve', '-replace=no', '-subdir=no', name, destination],
+                                       total_bytes=get_original_size(name))
+        finally:
+            retrieve_done.set()
+
+    with futures.ThreadPoolExecutor(max_workers=1) as executor:
+        retrieval = executor.submit(contextvars.copy_context().run, retrieve)
+        print(f"retrieving {name} and verifying it on the fly")
+        try:
+            streamed_checksum = hash_growing_file(destination, retrieve_done, algorithm=algorithm)
+        except RuntimeError as e:
+            print(f"could not verify {destination} while retrieving: {e}")
+            streamed_checksum = None
+        retrieval.result()
+
+    print(f"{name} retrieved")
+    file_checksum = streamed_checksum
+    if not original_checksum == file_checksum:
+        # dsmc might not have written the file strictly front to back, so be sure with a full read
+        print(f"{name} verifying by reading {destination} again")
+        file_checksum = hash_file_digests(destination, [algorithm])[algorithm]
     if not original_checksum == file_checksum:
         raise RuntimeError(f'got file from archive but checksum verification failed: archive path: {name}, destination {destination}')
     print(f"{name} successfully verified")
 
+def get_many_from_archive(names: list[str], destination_dir: str = None, hash_workers: int = None, ordered=False):
+    ''' retrieve many objects in a single dsmc session, then verify all of them in parallel
+
+    with destination_dir None, every object is retrieved to its original path, as for a recall.
+    ordered keeps the order of names in the filelist, for names already sorted by their position on tape
+    '''
+    if not isinstance(names, list): raise RuntimeError('names must be list')
+    if len(set(names)) != len(names):
+        raise RuntimeError(f'object can only be specified and retrieved once')
+
+    destinations = {}
+    for name in names:
+        if name.endswith('.archive_stub'):
+            raise RuntimeError(f"name looks like a stubfile, use the actual objectname instead: {name}")
+        if not Path(stubname(name)).exists():
+            raise RuntimeError(f"stubfile {stubname(name)} for {name} not found")
+        if destination_dir is None:
+            destination = name
+        else:
+            destination = str(Path(destination_dir) / Path(name).name)
+        if Path(destination).exists():
+            raise RuntimeError(f"destination path is not free, there is already a file or folder: {destination}")
+        destinations[name] = destination
+    if len(set(destinations.values())) != len(destinations):
+        raise RuntimeError(f'multiple objects would be retrieved to the same destination, retrieve them separately')
+
+    original_digests = {name: get_original_digests(name) for name in names}
+    # every object is verified with the fastest of its digests
+    algorithms = {name: verify_algorithm(digests) for name, digests in original_digests.items()}
+
+    # one session for all objects instead of one session and tape mount per object, in tape order
+    if ordered:
+        filelist = list(names)
+    else:
+        plan = plan_retrieve(names)
+        filelist = plan.order
+        if plan.locations:
+            print(f"estimated tape mounts: {plan.mounts}, instead of {plan.unsorted_mounts} in name order")
+    print(f"getting {len(filelist)} objects")
+    with tempfile.NamedTemporaryFile(mode='w+', suffix='.txt', prefix='archive_retrieve_filelist_') as tmpfile:
+        tmpfile.write('\n'.join(filelist))
+        tmpfile.seek(0)
+        cmd = ['dsmc', 'retrieve', '-replace=no', f'-filelist={tmpfile.name}']
+        if destination_dir is not None:
+            cmd += ['-preservepath=none', str(destination_dir).removesuffix('/') + '/']
+        sizes = [get_original_size(name) for name in names]
+        total_bytes = None if None in sizes else sum(sizes)
+        with span('retrieve', files=len(filelist), bytes=total_bytes):
+            run_dsmc_with_progress(cmd, total_bytes=total_bytes)
+
+    print(f"{len(filelist)} objects retrieved, now verifying")
+    missing = [name for name, destination in destinations.items() if not Path(destination).exists()]
+    for name in missing:
+        print(f'got objects from archive but {name} is missing at its destination {destinations[name]}')
+    failed = []
+    for algorithm in sorted(set(algorithms.values())):
+        group = [name for name in names if algorithms[name] == algorithm and name not in missing]
+        with span('verify', files=len(group), algorithm=algorithm):
+            file_digests = hash_files([destinations[name] for name in group], workers=hash_workers, algorithms=[algorithm])
+            failed += [name for name in group if original_digests[name][algorithm] != file_digests[destinations[name]][algorithm]]
+    if missing:
+        raise PartialFailure(f'got objects from archive but missing at their destination: {", ".join(missing)}'
+                             + (f', checksum verification failed for: {", ".join(failed)}' if failed else ''), missing + failed)
+    if failed:
+        raise PartialFailure(f'got objects from archive but checksum verification failed for: {", ".join(failed)}', failed)
+    print(f"{len(filelist)} objects successfully verified")
+    return destinations
+
 def retrieve_object(name, destination):
     # dont retrieving when source and destination indicate a recall operation
     if (Path(name).is_absolute() and Path(name) == Path(destination).resolve()) \
@@ -335,29 +2172,451 @@ def retrieve_object(name, destination):
         raise RuntimeError("retrieving a object to its original path is not supported. use recall to move a file from the archive back to its original path")
     get_from_archive(name, destination)
 
+def retrieve_objects(names: list[str], destination_dir: str):
+    ''' retrieve copies of many objects into destination_dir '''
+    for name in names:
+        destination = Path(destination_dir) / Path(name).name
+        if (Path(name).is_absolute() and Path(name) == destination.resolve()) \
+            or Path(stubname(str(destination))).exists():
+            raise RuntimeError("retrieving a object to its original path is not supported. use recall to move a file from the archive back to its original path")
+    return get_many_from_archive(names, destination_dir)
+
+def _finish_recall(names: list[str]):
+    ''' remove recalled and verified objects together with their stubfiles from the archive, then the local stubfiles '''
+    for name in names:
+        append_stub_state(name, 'verifieingrecalled_object_now_deleting')
+    # objects and their stubfiles go away in a single session
+    results = delete_objects(names + [stubname(name) for name in names], check=False)
+    failed = []
+    for name in names:
+        if results[name] != 'deleted':
+            failed.append(name)
+            continue
+        append_stub_state(name, 'deleting_stubfile')
+        if results[stubname(name)] != 'deleted':
+            failed.append(stubname(name))
+            continue
+        # finally delete the local stubfile
+        Path(stubname(name)).unlink(missing_ok=False)
+    if failed:
+        raise PartialFailure(f'recalled objects, but deleting them from the archive failed for: {", ".join(failed)}',
+                             [name for name in names if name in failed or stubname(name) in failed])
+
+def recall_objects(names: list[str]):
+    ''' recall many objects with one retrieve session per tape volume, reading every volume front to back '''
+    for name in names:
+        if not Path(stubname(name)).exists():
+            raise RuntimeError(f"stubfile {stubname(name)} for {name} not found")
+    for name in names:
+        append_stub_state(name, 'started_recalling')
+    groups = group_by_volume(names, query_tape_locations(names))
+    if len(groups) > 1:
+        print(f"recalling {len(names)} objects from {len(groups)} volumes")
+    failed = []
+    for group in groups:
+        try:
+            try:
+                get_many_from_archive(group, ordered=True)
+            except PartialFailure as e:
+                # the objects that were retrieved and verified are recalled anyway
+                print(f"recalling {len(e.names)} of {len(group)} objects failed: {e}")
+                failed += e.names
+                group = [name for name in group if name not in e.names]
+            _finish_recall(group)
+        except PartialFailure as e:
+            print(f"recalling {len(e.names)} objects failed: {e}")
+            failed += e.names
+        except (RuntimeError, subprocess.CalledProcessError) as e:
+            # the other volumes are independent of this one
+            print(f"recalling {len(group)} objects failed: {e}")
+            failed += group
+    if failed:
+        raise PartialFailure(f'recalling failed for: {", ".join(failed)}', failed)
+
 def recall(name):
-    with Path(stubname(name)).open('at') as f:
-        f.write(json.dumps({'entry_type':"state", "state":"started_recalling", "path":str(name)}) + '\n')
+    append_stub_state(name, 'started_recalling')
     get_from_archive(name, name)
-    with Path(stubname(name)).open('at') as f:
-        f.write(json.dumps({'entry_type':"state", "state":"verifieingrecalled_object_now_deleting", "path":str(name)}) + '\n')
-    delete_object(name)
-    with Path(stubname(name)).open('at') as f:
-        f.write(json.dumps({'entry_type':"state", "state":"deleting_stubfile", "path":str(name)}) + '\n')
-    # now also delete stubfile from archive
-    delete_object(stubname(name))
-    # finally delete the local stubfile
-    Path(stubname(name)).unlink(missing_ok=False)
+    _finish_recall([name])
+
+
+def parse_delete_output(text: str, names: list[str], succeeded: bool) -> dict[str, str]:
+    ''' map every name to 'deleted' or 'failed' from the output of a dsmc delete archive session
+
+    names reported together with an error or warning message failed, names reported without one were deleted,
+    names dsmc doesnt mention at all take the result of the whole session
+    '''
+    wanted = set(names)
+    results = {}
+    for line in text.splitlines():
+        mentioned = [p for p in OUTPUT_PATH_PATTERN.findall(line) if p in wanted]
+        if not mentioned:
+            continue
+        failed = DSMC_PROBLEM_MESSAGE_PATTERN.search(line) is not None
+        for name in mentioned:
+            if failed:
+                results[name] = 'failed'
+            else:
+                results.setdefault(name, 'deleted')
+    for name in names:
+        results.setdefault(name, 'deleted' if succeeded else 'failed')
+    return results
+
+def delete_objects(names: list[str], check=True) -> dict[str, str]:
+    ''' delete many objects in a single dsmc session, returns a dict of name to 'deleted' or 'failed' '''
+    if not isinstance(names, list): raise RuntimeError('names must be list')
+    if not names:
+        return {}
+    for name in names:
+        if name.endswith('/'):
+            raise RuntimeError(f"refusing to plainly delete archive directory {name}, use '-r' with caution for directories")
+    if len(set(names)) != len(names):
+        raise RuntimeError(f'object can only be specified and deleted once')
+
+    print(f"Deleting {len(names)} objects from archives")
+    with tempfile.NamedTemporaryFile(mode='w+', suffix='.txt', prefix='archive_delete_filelist_') as tmpfile:
+        tmpfile.write('\n'.join(names))
+        tmpfile.seek(0)
+        try:
+            with span('delete', files=len(names)):
+                result = subproc(['dsmc', 'delete', 'archive', '-noprompt', f'-filelist={tmpfile.name}'])
+            output, succeeded = str(result.stdout) + str(result.stderr), True
+        except subprocess.CalledProcessError as e:
+            output, succeeded = str(e.stdout or '') + str(e.stderr or ''), False
 
+    results = parse_delete_output(output, names, succeeded)
+    for name in names:
+        if results[name] == 'deleted':
+            print(f"{name} successfully deleted from archive")
+        else:
+            print(f"deleting {name} from archive failed")
+    catalog_remove([name for name in names if results[name] == 'deleted'])
+    failed = [name for name in names if results[name] != 'deleted']
+    if check and failed:
+        raise PartialFailure(f'deleting from archive failed for: {", ".join(failed)}', failed)
+    return results
 
 def delete_object(name):
-    print(f"Deleting {name} from archives")
-    if name.endswith('/'):
-        print(f"refusing to plainly delete archive directory, use '-r' with caution for directories")
-        sys.exit(1)
+    delete_objects([name])
 
-    subproc(['dsmc', 'delete', 'archive', '-noprompt', name])
-    print(f"{name} successfully deleted from archive")
+def read_names_file(path: str) -> list[str]:
+    ''' read object names, one per line, from a file or stdin for '-' '''
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        lines = Path(path).read_text().splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+# jobs one invocation runs at the same time, and dsmc sessions all of them may have open together
+MAX_CONCURRENT_JOBS = 8
+MAX_DSMC_SESSIONS = 4
+
+class Job(NamedTuple):
+    ''' one archive, resume, retrieve, recall or delete operation, options are the keyword arguments of its function '''
+    kind: str
+    names: list[str]
+    options: dict = {}
+    timeout: float = None # seconds, None waits as long as the job takes
+
+def _retrieve_job(names: list[str], destination: str = None, dry_run=False):
+    if dry_run:
+        plan = plan_retrieve(names)
+        print_retrieve_plan(plan)
+        return plan
+    if len(names) > 1 or (destination is not None and Path(destination).is_dir()):
+        return retrieve_objects(names, destination or os.getcwd())
+    if destination is None:
+        destination = str(Path(os.getcwd()) / Path(names[0]).name)
+    return retrieve_object(names[0], destination)
+
+def _recall_job(names: list[str], dry_run=False):
+    if dry_run:
+        plan = plan_retrieve(names)
+        print_retrieve_plan(plan)
+        return plan
+    if len(names) > 1:
+        return recall_objects(names)
+    return recall(names[0])
+
+def validate_job(job: Job):
+    ''' raise RuntimeError for a job that cant succeed, before it is run or queued,
+    the daemon checks every submission on its own, so a bad one doesnt fail the others it would be coalesced with '''
+    if job.kind == 'delete':
+        for name in job.names:
+            if name.endswith('/'):
+                raise RuntimeError(f"refusing to plainly delete archive directory {name}, use '-r' with caution for directories")
+    elif job.kind in ('retrieve', 'recall'):
+        for name in job.names:
+            if name.endswith(STUBFILE_SUFFIX):
+                raise RuntimeError(f"name looks like a stubfile, use the actual objectname instead: {name}")
+            if not Path(stubname(name)).exists():
+                raise RuntimeError(f"stubfile {stubname(name)} for {name} not found")
+            if job.kind == 'recall' and not job.options.get('dry_run') and Path(name).exists():
+                raise RuntimeError(f"destination path is not free, there is already a file or folder: {name}")
+    elif job.kind == 'archive':
+        archiving_pre_check(list(job.names))
+    elif job.kind == 'resume':
+        if not Path(job.names[0]).is_file():
+            raise RuntimeError(f"journal {job.names[0]} not found")
+
+JOB_KINDS = {
+    'archive': archive_objects,
+    'resume': lambda names, **options: resume_archive(names[0], **options),
+    'retrieve': _retrieve_job,
+    'recall': _recall_job,
+    'delete': delete_objects,
+}
+
+async def run_job(job: Job, control: JobControl, executor: futures.ThreadPoolExecutor, slots: asyncio.Semaphore = None):
+    ''' run a job in a worker thread, cancelling the task or running into the timeout stops its dsmc sessions '''
+    if job.kind not in JOB_KINDS:
+        raise RuntimeError(f"unknown job kind {job.kind}, known are: {', '.join(JOB_KINDS)}")
+    async with slots or nullcontext():
+        context = contextvars.copy_context()
+        context.run(_current_job.set, control)
+        work = asyncio.get_running_loop().run_in_executor(
+            executor, context.run, functools.partial(JOB_KINDS[job.kind], list(job.names), **job.options))
+        try:
+            return await asyncio.wait_for(asyncio.shield(work), job.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # the job fails at its current step, its dsmc session, the next hashed block or while waiting for a session.
+            # the worker thread finishes that step on its own, the job is reported right away
+            control.cancel()
+            work.add_done_callback(lambda done: done.cancelled() or done.exception())
+            if isinstance(e, asyncio.TimeoutError):
+                raise RuntimeError(f"{job.kind} job timed out after {job.timeout}s: {', '.join(job.names)}") from None
+            raise
+
+async def run_jobs(jobs: list[Job], max_jobs: int = MAX_CONCURRENT_JOBS, max_sessions: int = MAX_DSMC_SESSIONS) -> list:
+    ''' run jobs concurrently, returns the result of every job, or the exception it failed with '''
+    slots = asyncio.Semaphore(max(1, max_jobs))
+    sessions = threading.BoundedSemaphore(max(1, max_sessions))
+    with futures.ThreadPoolExecutor(max_workers=max(1, max_jobs)) as executor:
+        return await asyncio.gather(*(run_job(job, JobControl(sessions), executor, slots) for job in jobs),
+                                    return_exceptions=True)
+
+def execute_jobs(jobs: list[Job], max_jobs: int = MAX_CONCURRENT_JOBS, max_sessions: int = MAX_DSMC_SESSIONS) -> list:
+    return asyncio.run(run_jobs(jobs, max_jobs=max_jobs, max_sessions=max_sessions))
+
+def execute_job(job: Job):
+    ''' run a single job, raising its exception '''
+    result, = execute_jobs([job])
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+def read_jobs_file(path: str, timeout: float = None) -> list[Job]:
+    ''' read jobs, one json object per line, from a file or stdin for '-'
+
+    like: {"kind": "retrieve", "names": ["/data/a.bin"], "destination": "/tmp", "timeout": 3600}
+    '''
+    jobs = []
+    for number, line in enumerate(read_names_file(path), start=1):
+        record = json.loads(line)
+        if record.get('kind') not in JOB_KINDS or not record.get('names'):
+            raise RuntimeError(f"job {number} in {path} needs a kind of {', '.join(JOB_KINDS)} and names")
+        kind, names = record.pop('kind'), record.pop('names')
+        jobs.append(Job(kind, names, record, record.pop('timeout', timeout)))
+    return jobs
+
+
+# unix socket the daemon takes jobs on
+DAEMON_SOCKET_PATH = os.environ.get('ARCHIVE_TOOL_SOCKET', str(Path.home() / '.cache' / 'archive_tool' / 'daemon.sock'))
+# how long the daemon waits for more jobs of the same kind, to run them together in one dsmc session
+DAEMON_COALESCE_SECONDS = 2.0
+# how long it collects recalls, so recalls of files on the same tape share one mount
+RECALL_COALESCE_SECONDS = 60.0
+# longest request line the daemon reads, bulk jobs list many thousands of paths
+DAEMON_REQUEST_LIMIT = 256 * 1024**2
+# lower runs first, users wait for recalls, nobody waits for archives
+JOB_PRIORITIES = {'recall': 0, 'retrieve': 1, 'delete': 2, 'resume': 3, 'archive': 4}
+
+def _coalesce_key(job: Job) -> tuple[str, str]:
+    ''' jobs with the same key can run in one session '''
+    return job.kind, json.dumps(job.options, sort_keys=True, default=str)
+
+class DaemonQueue:
+    ''' pending jobs of the daemon by priority, then by submission, with the futures their submitters wait on
+
+    every job has a collection window, it is only handed out once the window is over, so jobs submitted meanwhile can join it.
+    jobs that can run together share the window of the first of them, every kind and options has its own window
+    '''
+    def __init__(self):
+        self._heap = []
+        self._submitted = 0
+        self._ready_at = {}
+        self._added = asyncio.Event()
+
+    def put(self, job: Job, future: asyncio.Future, window: float = 0):
+        self._submitted += 1
+        key = _coalesce_key(job)
+        if key not in self._ready_at:
+            self._ready_at[key] = time.monotonic() + window
+        heapq.heappush(self._heap, (JOB_PRIORITIES[job.kind], self._submitted, job, future))
+        self._added.set()
+
+    async def get(self) -> tuple[Job, asyncio.Future]:
+        ''' the first job by priority whose window is over, waits for one '''
+        while True:
+            now = time.monotonic()
+            ready = [entry for entry in self._heap if self._ready_at[_coalesce_key(entry[2])] <= now]
+            if ready:
+                entry = min(ready)
+                self._heap.remove(entry)
+                heapq.heapify(self._heap)
+                self._forget_if_done(entry[2])
+                return entry[2], entry[3]
+            self._added.clear()
+            # until the next window is over, or a job is added that might be ready sooner
+            next_ready = min((self._ready_at[_coalesce_key(entry[2])] for entry in self._heap), default=None)
+            try:
+                await asyncio.wait_for(self._added.wait(), None if next_ready is None else next_ready - now)
+            except asyncio.TimeoutError:
+                pass
+
+    def take_matching(self, job: Job) -> list[tuple[Job, asyncio.Future]]:
+        ''' remove and return the pending jobs that can run in one session together with job '''
+        key = _coalesce_key(job)
+        matching = [(j, f) for _, _, j, f in self._heap if _coalesce_key(j) == key]
+        self._heap = [entry for entry in self._heap if _coalesce_key(entry[2]) != key]
+        heapq.heapify(self._heap)
+        self._forget_if_done(job)
+        return matching
+
+    def _forget_if_done(self, job: Job):
+        # the next job of this key opens a new window
+        key = _coalesce_key(job)
+        if not any(_coalesce_key(entry[2]) == key for entry in self._heap):
+            self._ready_at.pop(key, None)
+
+    def summary(self) -> dict[str, int]:
+        return dict(Counter(job.kind for _, _, job, _ in self._heap))
+
+def _merge_jobs(group: list[Job]) -> Job:
+    names = list(dict.fromkeys(name for job in group for name in job.names))
+    timeouts = [job.timeout for job in group]
+    return Job(group[0].kind, names, group[0].options, None if None in timeouts else max(timeouts))
+
+async def serve_daemon(socket_path: str = None, coalesce_seconds: float = DAEMON_COALESCE_SECONDS,
+                       max_jobs: int = MAX_CONCURRENT_JOBS, max_sessions: int = MAX_DSMC_SESSIONS,
+                       recall_window: float = RECALL_COALESCE_SECONDS):
+    ''' take jobs on a unix socket and run them, recalls first, jobs of the same kind are coalesced into one session,
+    recalls are collected for recall_window seconds, so recalls of the same tape share its mount
+
+    a request is one json line, like {"kind": "recall", "names": ["/data/a.bin"], "wait": true},
+    the daemon answers with {"job_id": 1, "state": "queued"} and, if the submitter waits, with the state the job ended in.
+    {"kind": "status"} answers with the number of queued and running jobs
+    '''
+    socket_path = socket_path or DAEMON_SOCKET_PATH
+    Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+    if Path(socket_path).exists():
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(socket_path)
+        except OSError:
+            # left behind by a daemon that didnt shut down cleanly
+            Path(socket_path).unlink()
+        else:
+            raise RuntimeError(f"a daemon is already running on {socket_path}")
+
+    queue = DaemonQueue()
+    slots = asyncio.Semaphore(max(1, max_jobs))
+    sessions = threading.BoundedSemaphore(max(1, max_sessions))
+    running = set()
+    job_ids = iter(range(1, sys.maxsize))
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def reply(message: dict):
+            writer.write((json.dumps(message) + '\n').encode())
+        try:
+            request = json.loads(await reader.readline())
+            if request.get('kind') == 'status':
+                reply({'state': 'status', 'queued': queue.summary(), 'running': len(running)})
+                return
+            kind, names = request.pop('kind', None), request.pop('names', None)
+            if kind not in JOB_KINDS or not names:
+                raise RuntimeError(f"a job needs a kind of {', '.join(JOB_KINDS)} and names")
+            wait, timeout = request.pop('wait', False), request.pop('timeout', None)
+            job = Job(kind, names, request, timeout)
+            # in the default executor, the job executor may be busy with long jobs for hours
+            await asyncio.get_running_loop().run_in_executor(None, validate_job, job)
+            job_id, future = next(job_ids), asyncio.get_running_loop().create_future()
+            # resumes run alone, right away
+            window = 0 if kind == 'resume' else recall_window if kind == 'recall' else coalesce_seconds
+            queue.put(job, future, window)
+            print(f"job {job_id}: {kind} of {len(names)} objects queued")
+            reply({'job_id': job_id, 'state': 'queued'})
+            if wait:
+                await writer.drain()
+                state, error = await future
+                reply({'job_id': job_id, 'state': state, 'error': error})
+        except (ValueError, RuntimeError) as e:
+            reply({'state': 'rejected', 'error': str(e)})
+        finally:
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass # the submitter went away, the job still runs
+            writer.close()
+
+    async def run_group(job: Job, group: list[tuple[Job, asyncio.Future]]):
+        error = 'the daemon shut down'
+        try:
+            await run_job(job, JobControl(sessions), executor)
+            error = None
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            # also a SystemExit or KeyboardInterrupt of a job only fails that job, not the daemon
+            print(f"{job.kind} of {len(job.names)} objects failed: {e!r}")
+            error = e
+        finally:
+            slots.release()
+            write_prometheus_textfile()
+            for submitted, future in group:
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(('done', None))
+                elif isinstance(error, PartialFailure):
+                    # every submitter only fails for its own names
+                    failed = [name for name in submitted.names if name in error.names]
+                    future.set_result(('failed', f"{job.kind} failed for: {', '.join(failed)}") if failed else ('done', None))
+                else:
+                    future.set_result(('failed', str(error) or type(error).__name__))
+
+    with futures.ThreadPoolExecutor(max_workers=max(1, max_jobs)) as executor:
+        server = await asyncio.start_unix_server(handle, path=socket_path, limit=DAEMON_REQUEST_LIMIT)
+        os.chmod(socket_path, 0o600)
+        print(f"daemon listening on {socket_path}")
+        try:
+            async with server:
+                while True:
+                    await slots.acquire()
+                    # the windows of all pending kinds run at the same time, a job is handed out once its window is over
+                    job, future = await queue.get()
+                    group = [(job, future)]
+                    if job.kind != 'resume':
+                        group += queue.take_matching(job)
+                    merged = _merge_jobs([j for j, _ in group])
+                    print(f"running {merged.kind} of {len(merged.names)} objects from {len(group)} submissions")
+                    task = asyncio.create_task(run_group(merged, group))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            Path(socket_path).unlink(missing_ok=True)
+
+def submit_to_daemon(request: dict, socket_path: str = None) -> Iterator[dict]:
+    ''' send one request to the daemon, yields its answers '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path or DAEMON_SOCKET_PATH)
+        sock.sendall((json.dumps(request) + '\n').encode())
+        with sock.makefile('r', encoding='utf-8') as answers:
+            for line in answers:
+                yield json.loads(line)
 
 
 def print_info():
@@ -372,55 +2631,223 @@ def print_info():
     print(result.stdout)
 
 
+def print_startup_profile():
+    ''' where the startup time went, printed to stderr to not mix with the output of the command '''
+    now = time.perf_counter()
+    lines = [f"{'interpreter and compile':<24}{_startup_cpu_seconds * 1000:9.1f} ms (cpu)",
+             f"{'eager imports':<24}{(_imports_done - _startup_started) * 1000:9.1f} ms",
+             f"{'module body':<24}{(_module_loaded - _imports_done) * 1000:9.1f} ms"]
+    lines += [f"{'import ' + name:<24}{seconds * 1000:9.1f} ms (lazy)" for name, seconds in _lazy_import_seconds.items()]
+    lines.append(f"{'total':<24}{(now - _startup_started + _startup_cpu_seconds) * 1000:9.1f} ms")
+    if __name__ == '__main__' and __spec__ is None:
+        # a script is compiled on every start, only imported modules are cached in __pycache__, compiling again shows what that cost
+        start = time.perf_counter()
+        compile(Path(__file__).read_bytes(), __file__, 'exec')
+        lines.insert(1, f"{'  of that compiling':<24}{(time.perf_counter() - start) * 1000:9.1f} ms")
+        lines.append("archive_tool.py was compiled at startup, run the archive-tool entry script or python -m archive_tool to use the bytecode cache")
+    print('\n'.join(lines), file=sys.stderr)
+
 def main():
+    global trust_checksum_cache, use_xattr_checksums, compact_stubs, hash_direct_io, extra_digests, HASH_READ_AHEAD, METRICS_PATH, PROMETHEUS_TEXTFILE_PATH
     parser = argparse.ArgumentParser(description='Archive system client utility')
+    parser.add_argument('--profile-startup', dest='profile_startup', action='store_true', help='print the time spent on imports and setup to stderr when exiting')
+    parser.add_argument('--metrics', type=str, default=METRICS_PATH, help='append the timings of every phase as json lines to this file')
+    parser.add_argument('--prometheus-textfile', dest='prometheus_textfile', type=str, default=PROMETHEUS_TEXTFILE_PATH,
+                        help='write the totals per phase to this file, for the prometheus node exporter textfile collector')
+    # checked before parsing, so it also profiles --help and usage errors
+    if '--profile-startup' in sys.argv[1:]:
+        atexit.register(print_startup_profile)
     subparsers = parser.add_subparsers(dest='command', required=True)
 
     # List command
-    list_parser = subparsers.add_parser('list', help='List all archived objects or all in the given paths')
+    list_parser = subparsers.add_parser('list', help='List all archived objects or all in the given paths, from the local catalog')
     list_parser.add_argument('path', type=str, nargs='*', help='multiple paths prefixes to list list archived objects of, empty lists all archived objects')
     list_parser.add_argument('--ignore-missing', dest='ignore_missing', action='store_true', help='continues listing, even if a path doesnt exist and errors occur')
+    list_parser.add_argument('--refresh', action='store_true', help='resync the local catalog from the archive server before listing')
+    list_parser.add_argument('--server', action='store_true', help='print the raw listing of the archive server instead of using the local catalog')
+    list_parser.add_argument('--min-size', dest='min_size', type=int, default=None, help='only objects of at least this many bytes')
+    list_parser.add_argument('--max-size', dest='max_size', type=int, default=None, help='only objects of at most this many bytes')
+    list_parser.add_argument('--since', type=str, default=None, help='only objects archived at or after this iso date')
+    list_parser.add_argument('--until', type=str, default=None, help='only objects archived before this iso date')
+    list_parser.add_argument('--checksum', type=str, default=None, help='only objects with this sha256 checksum')
 
     # Archive command
     archive_parser = subparsers.add_parser('archive', help='Migrate files to the archive system and creates a stubfile for it')
-    archive_parser.add_argument('object_path', nargs="+", type=str, help='Path to the file/folder to archive')
+    archive_parser.add_argument('object_path', nargs="*", type=str, help='Path to the file/folder to archive')
+    archive_parser.add_argument('--verify-cache', dest='verify_cache', action='store_true', help='hash all files again instead of reusing cached checksums of unchanged files')
+    archive_parser.add_argument('--xattr-cache', dest='xattr_cache', action='store_true', help=f'also store checksums in the {XATTR_CHECKSUM_NAME} extended attribute of the files and reuse them from there')
+    archive_parser.add_argument('--scan', action='append', default=[], help='archive the files found under this directory, instead of object paths, can be given multiple times')
+    archive_parser.add_argument('--min-size', dest='min_size', type=int, default=MIN_FILESIZE_BYTES, help=f'with --scan, only files of at least this many bytes (default and minimum: {MIN_FILESIZE_BYTES})')
+    archive_parser.add_argument('--min-age-days', dest='min_age_days', type=float, default=0, help='with --scan, only files not modified or accessed for this many days')
+    archive_parser.add_argument('--exclude', action='append', default=[], help='with --scan, skip paths or names matching this glob pattern, can be given multiple times')
+    archive_parser.add_argument('--compact-stubs', dest='compact_stubs', action='store_true', help='write stubfiles with a header holding the current state, that is read with a single read and updated in place')
+    archive_parser.add_argument('--resume', type=str, default=None, help='resume the interrupted batch of this journal file, instead of archiving object paths')
+    archive_parser.add_argument('--hash-workers', dest='hash_workers', type=int, default=None, help=f'number of files hashed in parallel (default: {HASH_WORKERS})')
+    archive_parser.add_argument('--direct-io', dest='direct_io', action='store_true', help='hash with O_DIRECT, without going through and evicting the page cache, not with --pipelined')
+    archive_parser.add_argument('--read-ahead', dest='read_ahead', type=int, default=HASH_READ_AHEAD, help=f'reads per file in flight while hashing (default: {HASH_READ_AHEAD})')
+    archive_parser.add_argument('--digests', type=lambda text: [a for a in text.split(',') if a and a != 'sha256'], default=None,
+                                help='comma separated digests to store besides sha256, like blake2b or xxh3_128, "sha256" for none (default: the fastest available, if faster than sha256)')
+    archive_parser.add_argument('--hash-processes', dest='hash_processes', action='store_true', help='hash in a process pool instead of a thread pool')
+    archive_parser.add_argument('--pipelined', action='store_true', help='hash and upload in page cache sized chunks, so dsmc reads the files from cache instead of from disk a second time')
+    archive_parser.add_argument('--sessions', type=int, default=1, help='number of concurrent dsmc sessions, the batch is split into this many partitions of about equal size')
+    archive_parser.add_argument('--max-batch-bytes', dest='max_batch_bytes', type=int, default=MAX_BATCH_BYTES, help=f'upper limit for the bytes uploaded by one dsmc session (default: {MAX_BATCH_BYTES})')
+    archive_parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='only print the planned sessions and batches with estimated durations')
+    archive_parser.add_argument('--cache-budget', dest='cache_budget', type=int, default=PAGECACHE_BUDGET_BYTES, help=f'bytes of page cache --pipelined may use (default: {PAGECACHE_BUDGET_BYTES})')
 
     # Retrieve command
     retrieve_parser = subparsers.add_parser('retrieve', help='Retrieve a copy of an archived object')
-    retrieve_parser.add_argument('object_name', type=str, help='Name of archived object (without extension)')
+    retrieve_parser.add_argument('object_name', nargs="+", type=str, help='Names of archived objects (without extension), multiple objects are retrieved in a single session')
     retrieve_parser.add_argument('--destination', '-d', type=str, default=None,
-                                help='Target directory for retrieval (default: current directory)')
+                                help='Target directory for retrieval (default: current directory), the target path when retrieving a single object')
+    retrieve_parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='only print the objects in tape order with the estimated tape mounts')
     # recall command
     recall_parser = subparsers.add_parser('recall', help='Migrate an archived object back to its original path and removes the stubfile')
-    recall_parser.add_argument('object_name', type=str, help='Name of archived object (without extension)')
+    recall_parser.add_argument('object_name', nargs="+", type=str, help='Names of archived objects (without extension), multiple objects are recalled in a single session')
+    recall_parser.add_argument('--dry-run', dest='dry_run', action='store_true', help='only print the objects in tape order with the estimated tape mounts')
 
     # Delete command
     delete_parser = subparsers.add_parser('delete', help='Remove an object from the archives')
-    delete_parser.add_argument('object_name', type=str, help='Name of the archived object to delete')
+    delete_parser.add_argument('object_name', nargs="*", type=str, help='Names of the archived objects to delete, all are deleted in a single session')
+    delete_parser.add_argument('--from-file', dest='from_file', type=str, default=None, help="read additional object names from a file, one per line, '-' for stdin")
+
+    # Scan command
+    scan_parser = subparsers.add_parser('scan', help='Index all stubfiles under a directory into the local catalog')
+    scan_parser.add_argument('directory', type=str, help='root of the tree to scan')
+    scan_parser.add_argument('--workers', type=int, default=SCAN_WORKERS, help=f'directories scanned in parallel (default: {SCAN_WORKERS})')
+    scan_parser.add_argument('--full', action='store_true', help='read all directories and stubfiles again, instead of only the changed directories')
+
+    # Convert stubs command
+    convert_parser = subparsers.add_parser('convert-stubs', help='Rewrite stubfiles into the compact format with a header holding the state')
+    convert_parser.add_argument('path', nargs='+', type=str, help='stubfiles, or directories to convert all stubfiles under')
+
+    # Jobs command
+    jobs_parser = subparsers.add_parser('jobs', help='Run many archive, resume, retrieve, recall and delete jobs concurrently')
+    jobs_parser.add_argument('jobs_file', type=str, help='''file with one json job per line, like {"kind": "recall", "names": ["/data/a.bin"]}, '-' for stdin''')
+    jobs_parser.add_argument('--max-jobs', dest='max_jobs', type=int, default=MAX_CONCURRENT_JOBS, help=f'jobs running at the same time (default: {MAX_CONCURRENT_JOBS})')
+    jobs_parser.add_argument('--max-sessions', dest='max_sessions', type=int, default=MAX_DSMC_SESSIONS, help=f'dsmc sessions open at the same time (default: {MAX_DSMC_SESSIONS})')
+    jobs_parser.add_argument('--timeout', type=float, default=None, help='seconds after which a job without its own timeout is cancelled')
+
+    # Daemon command
+    daemon_parser = subparsers.add_parser('daemon', help='Run in the background and take jobs on a unix socket, coalescing them into batched sessions')
+    daemon_parser.add_argument('--socket', type=str, default=None, help=f'socket path (default: {DAEMON_SOCKET_PATH})')
+    daemon_parser.add_argument('--coalesce-seconds', dest='coalesce_seconds', type=float, default=DAEMON_COALESCE_SECONDS, help=f'how long to wait for more jobs of the same kind (default: {DAEMON_COALESCE_SECONDS})')
+    daemon_parser.add_argument('--recall-window', dest='recall_window', type=float, default=RECALL_COALESCE_SECONDS, help=f'how long to collect recalls, to recall all objects of a tape with one mount (default: {RECALL_COALESCE_SECONDS})')
+    daemon_parser.add_argument('--max-jobs', dest='max_jobs', type=int, default=MAX_CONCURRENT_JOBS, help=f'jobs running at the same time (default: {MAX_CONCURRENT_JOBS})')
+    daemon_parser.add_argument('--max-sessions', dest='max_sessions', type=int, default=MAX_DSMC_SESSIONS, help=f'dsmc sessions open at the same time (default: {MAX_DSMC_SESSIONS})')
+
+    # Submit command
+    submit_parser = subparsers.add_parser('submit', help='Submit a job to the running daemon')
+    submit_parser.add_argument('kind', type=str, choices=list(JOB_KINDS) + ['status'], help='what to do, status prints the queue of the daemon')
+    submit_parser.add_argument('object_name', nargs='*', type=str, help='paths or names of the objects, the journal for resume')
+    submit_parser.add_argument('--destination', '-d', type=str, default=None, help='with retrieve, target directory (default: current directory)')
+    submit_parser.add_argument('--wait', action='store_true', help='wait until the job is done and exit with its result')
+    submit_parser.add_argument('--timeout', type=float, default=None, help='seconds after which the job is cancelled')
+    submit_parser.add_argument('--socket', type=str, default=None, help=f'socket path (default: {DAEMON_SOCKET_PATH})')
 
     # Info command
     info_parser = subparsers.add_parser('info', help='Print archive system information')
 
     args = parser.parse_args()
+    METRICS_PATH, PROMETHEUS_TEXTFILE_PATH = args.metrics, args.prometheus_textfile
+    # also when the command fails, the failed phases are counted
+    atexit.register(write_prometheus_textfile)
 
     if args.command == 'list':
-        list_archived_objects(args.path, args.ignore_missing)
+        if args.server:
+            list_archived_objects(args.path, args.ignore_missing)
+        else:
+            if args.refresh:
+                refresh_catalog(args.path, args.ignore_missing)
+            print_catalog(query_catalog(args.path, min_size=args.min_size, max_size=args.max_size,
+                                        since=args.since, until=args.until, checksum=args.checksum))
+            # the catalog only knows what this host archived, until it is synced
+            for prefix in unsynced_prefixes(args.path):
+                print(f"the local catalog was never synced with the server {f'for {prefix}' if prefix else 'at all'}, "
+                      f"it only has the objects archived from this host, run list --refresh to sync it")
     elif args.command == 'archive':
-        archive_objects(args.object_path)
-    elif args.command == 'retrieve':
-        if args.destination is None:
-            destination = str(Path(os.getcwd()) / Path(args.object_name).name)
+        trust_checksum_cache = not args.verify_cache
+        use_xattr_checksums = args.xattr_cache
+        hash_direct_io, HASH_READ_AHEAD = args.direct_io, args.read_ahead
+        extra_digests = args.digests
+        compact_stubs = args.compact_stubs
+        options = dict(hash_workers=args.hash_workers, hash_processes=args.hash_processes,
+                       pipelined=args.pipelined, cache_budget=args.cache_budget, sessions=args.sessions,
+                       max_batch_bytes=args.max_batch_bytes, dry_run=args.dry_run)
+        if args.resume:
+            if args.object_path:
+                parser.error('archive --resume takes no object paths, they are in the journal')
+            execute_job(Job('resume', [args.resume], options))
+        elif args.scan:
+            if args.object_path:
+                parser.error('archive --scan takes no object paths, they are discovered')
+            stats = discover_candidates(args.scan, min_size=args.min_size, min_age_days=args.min_age_days, excludes=args.exclude)
+            print(f"found {len(stats)} files to archive")
+            if stats:
+                execute_job(Job('archive', list(stats), dict(options, stats=stats)))
+        elif not args.object_path:
+            parser.error('archive needs at least one object path')
         else:
-            destination = args.destination
-        retrieve_object(args.object_name, destination)
+            execute_job(Job('archive', args.object_path, options))
+    elif args.command == 'retrieve':
+        execute_job(Job('retrieve', args.object_name, {'destination': args.destination, 'dry_run': args.dry_run}))
     elif args.command == 'recall':
-        recall(args.object_name)
+        execute_job(Job('recall', args.object_name, {'dry_run': args.dry_run}))
     elif args.command == 'delete':
-        delete_object(args.object_name)
+        names = args.object_name + (read_names_file(args.from_file) if args.from_file else [])
+        if not names:
+            parser.error('delete needs at least one object name')
+        job = Job('delete', names)
+        try:
+            validate_job(job)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+        execute_job(job)
+    elif args.command == 'convert-stubs':
+        converted, compact = convert_stubfiles(args.path)
+        print(f"converted {converted} stubfiles, {compact} were already compact")
+    elif args.command == 'jobs':
+        jobs = read_jobs_file(args.jobs_file, timeout=args.timeout)
+        results = execute_jobs(jobs, max_jobs=args.max_jobs, max_sessions=args.max_sessions)
+        failed = 0
+        for job, result in zip(jobs, results):
+            if isinstance(result, BaseException):
+                failed += 1
+                print(f"{job.kind} of {len(job.names)} objects failed: {result}")
+            else:
+                print(f"{job.kind} of {len(job.names)} objects done")
+        if failed:
+            sys.exit(1)
+    elif args.command == 'scan':
+        counts = scan_stubs(args.directory, workers=args.workers, full=args.full)
+        for state, count in sorted(counts.items()):
+            print(f"{count:>12} {state}")
+    elif args.command == 'daemon':
+        try:
+            asyncio.run(serve_daemon(args.socket, coalesce_seconds=args.coalesce_seconds, recall_window=args.recall_window,
+                                     max_jobs=args.max_jobs, max_sessions=args.max_sessions))
+        except KeyboardInterrupt:
+            pass
+    elif args.command == 'submit':
+        request = {'kind': args.kind}
+        if args.kind != 'status':
+            if not args.object_name:
+                parser.error('submit needs at least one object name')
+            # the daemon runs in another directory
+            names = args.object_name if args.kind == 'delete' else [os.path.abspath(name) for name in args.object_name]
+            request.update(names=names, wait=args.wait, timeout=args.timeout)
+            if args.kind == 'retrieve':
+                request['destination'] = os.path.abspath(args.destination or os.getcwd())
+        for answer in submit_to_daemon(request, args.socket):
+            print(json.dumps(answer))
+            if answer['state'] in ('failed', 'rejected'):
+                sys.exit(1)
     elif args.command == 'info':
         print_info()
     else:
         parser.print_help()
 
+_module_loaded = time.perf_counter()
+
 if __name__ == '__main__':
     main()
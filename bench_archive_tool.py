@@ -0,0 +1,407 @@
+#!/usr/bin/python3.12
+''' benchmark archive_tool against a simulated dsmc, to catch throughput and latency regressions
+
+the fake dsmc is this script itself, called as 'bench_archive_tool.py fake-dsmc ...' through a 'dsmc' wrapper on PATH,
+so archive_tool runs its real subprocess and output parsing code. it keeps the archived objects in a directory store
+and simulates session latency, bandwidth, tape mounts and failing sessions.
+'''
+import argparse
+import contextlib
+import fcntl
+import functools
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Iterable
+from pathlib import Path
+
+# scenarios, every batch size is run with every file size
+BATCH_SIZES = [1, 10, 100]
+FILE_SIZES = [1024**2, 16 * 1024**2]
+# the operations of a scenario, in the order they run
+OPERATIONS = ('archive', 'list', 'retrieve', 'recall', 'delete')
+# a result is a regression if it takes this much longer than in the baseline
+REGRESSION_TOLERANCE = 0.2
+# bytes the fake dsmc puts on one simulated tape volume before starting the next
+FAKE_VOLUME_BYTES = 64 * 1024**2
+# with --hash, the ways to hash a file that are compared, as keyword arguments of archive_tool.hash_file
+HASH_METHODS = {
+    'hash': dict(direct_io=False, read_ahead=0),
+    'hash_read_ahead': dict(direct_io=False),
+    'hash_direct_io': dict(direct_io=True),
+}
+
+# one line of the listing of the fake dsmc, formatted like dsmc query archive
+FAKE_ENTRY_FORMAT = '{size:>17,}  B  08/15/2025 10:12:33    {path} Never Archive Date: 08/15/2025'
+FAKE_QUERY_HEADER = ['IBM Storage Protect', '',
+                     '             Size  Archive Date - Time    File - Expires on - Description',
+                     '             ----  -------------------    -------------------------------']
+
+
+class FakeStore:
+    ''' the objects the fake dsmc archived, as files under objects/ and an index with their size and tape location '''
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.objects = self.root / 'objects'
+        self.index_path = self.root / 'index.json'
+
+    @contextlib.contextmanager
+    def locked(self):
+        ''' the index, locked against concurrent fake dsmc sessions, it is written back when the block ends '''
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / 'lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = json.loads(self.index_path.read_text()) if self.index_path.exists() else {'objects': {}, 'volume': 0, 'offset': 0}
+            yield index
+            tmp = self.index_path.with_suffix('.tmp')
+            tmp.write_text(json.dumps(index))
+            os.replace(tmp, self.index_path)
+
+    def object_path(self, path: str) -> Path:
+        return self.objects / path.lstrip('/')
+
+
+def _throttle(size: int, bandwidth: float):
+    if bandwidth > 0:
+        time.sleep(size / bandwidth)
+
+def _option(argv: list[str], name: str) -> str:
+    for arg in argv:
+        if arg.startswith(f'{name}='):
+            return arg.split('=', 1)[1]
+    return None
+
+def _restore_order(entry: dict) -> str:
+    return f"00000000-{entry['volume']:08X}-00000000-{entry['offset']:08X}"
+
+def fake_dsmc_main(argv: list[str]) -> int:
+    ''' a dsmc that understands the commands archive_tool runs, configured by FAKE_DSMC_* environment variables '''
+    store = FakeStore(os.environ['FAKE_DSMC_STORE'])
+    latency = float(os.environ.get('FAKE_DSMC_LATENCY', 0))
+    bandwidth = float(os.environ.get('FAKE_DSMC_BANDWIDTH', 0))
+    mount_delay = float(os.environ.get('FAKE_DSMC_MOUNT_DELAY', 0))
+    fail_rate = float(os.environ.get('FAKE_DSMC_FAIL_RATE', 0))
+    volume_bytes = int(os.environ.get('FAKE_DSMC_VOLUME_BYTES', FAKE_VOLUME_BYTES))
+
+    # session setup
+    time.sleep(latency)
+    if fail_rate and random.random() < fail_rate:
+        print('ANS1017E Session rejected: TCP/IP connection failure (injected)', file=sys.stderr)
+        return 12
+    args = [arg for arg in argv if not arg.startswith('-')]
+    filelist = _option(argv, '-filelist')
+    names = Path(filelist).read_text().splitlines() if filelist else []
+
+    if args[:1] == ['archive']:
+        with store.locked() as index:
+            for path in names:
+                size = os.path.getsize(path)
+                _throttle(size, bandwidth)
+                store.object_path(path).parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(path, store.object_path(path))
+                if index['offset'] + size > volume_bytes and index['offset'] > 0:
+                    index['volume'], index['offset'] = index['volume'] + 1, 0
+                index['objects'][path] = {'size': size, 'volume': index['volume'], 'offset': index['offset']}
+                index['offset'] += size
+                print(f"Normal File-->{size:>20,} {path} [Sent]", flush=True)
+        return 0
+
+    if args[:2] == ['query', 'archive']:
+        with store.locked() as index:
+            objects = index['objects']
+        if filelist:
+            found = [path for path in names if path in objects]
+        else:
+            pattern = args[2]
+            if pattern.endswith('*') or pattern.endswith('/'):
+                found = sorted(path for path in objects if path.startswith(pattern.removesuffix('*')))
+            else:
+                found = [pattern] if pattern in objects else []
+        for line in FAKE_QUERY_HEADER:
+            print(line)
+        for path in found:
+            print(FAKE_ENTRY_FORMAT.format(size=objects[path]['size'], path=path))
+            if '-detail' in argv:
+                print(f"  Media Class: Library  Volume ID: VOL{objects[path]['volume']:04d}  Restore Order: {_restore_order(objects[path])}")
+        if not found:
+            print('ANS1092W No files matching search criteria were found')
+            return 8
+        return 0
+
+    if args[:1] == ['retrieve']:
+        with store.locked() as index:
+            objects = index['objects']
+        if filelist:
+            destination_dir = args[1] if len(args) > 1 else None
+            transfers = [(path, os.path.join(destination_dir, os.path.basename(path)) if destination_dir else path) for path in names]
+        else:
+            transfers = [(args[1], args[2])]
+        volume = None
+        for path, destination in transfers:
+            if path not in objects:
+                print(f"ANS1302E No objects on server match query: {path}")
+                return 8
+            if objects[path]['volume'] != volume:
+                volume = objects[path]['volume']
+                time.sleep(mount_delay)
+            _throttle(objects[path]['size'], bandwidth)
+            shutil.copyfile(store.object_path(path), destination)
+            print(f"Retrieving{objects[path]['size']:>20,} {path} --> {destination} [Done]", flush=True)
+        return 0
+
+    if args[:2] == ['delete', 'archive']:
+        failed = False
+        with store.locked() as index:
+            for path in names:
+                if index['objects'].pop(path, None) is None:
+                    print(f"ANS1345E No objects on server match '{path}'")
+                    failed = True
+                    continue
+                store.object_path(path).unlink(missing_ok=True)
+                print(f"Deleting {path} [Done]")
+        return 8 if failed else 0
+
+    if args[:2] == ['query', 'systeminfo']:
+        Path(_option(argv, '-filename')).write_text('fake dsmc for benchmarks\n')
+        return 0
+
+    print(f"ANS1138E The 'fake-dsmc' command cannot be executed: {' '.join(argv)}", file=sys.stderr)
+    return 12
+
+
+def install_fake_dsmc(bin_dir: str, store_dir: str, latency: float = 0, bandwidth: float = 0,
+                      mount_delay: float = 0, fail_rate: float = 0, volume_bytes: int = FAKE_VOLUME_BYTES):
+    ''' put a 'dsmc' wrapper calling the fake dsmc first on PATH, for this process and the ones it starts '''
+    Path(bin_dir).mkdir(parents=True, exist_ok=True)
+    wrapper = Path(bin_dir) / 'dsmc'
+    wrapper.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" fake-dsmc "$@"\n')
+    wrapper.chmod(0o755)
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ.update(FAKE_DSMC_STORE=str(store_dir), FAKE_DSMC_LATENCY=str(latency), FAKE_DSMC_BANDWIDTH=str(bandwidth),
+                      FAKE_DSMC_MOUNT_DELAY=str(mount_delay), FAKE_DSMC_FAIL_RATE=str(fail_rate),
+                      FAKE_DSMC_VOLUME_BYTES=str(volume_bytes))
+
+
+def _write_files(directory: Path, count: int, size: int) -> list[str]:
+    ''' files of random content, a random block is repeated, generating the data would dominate larger scenarios '''
+    directory.mkdir(parents=True)
+    block = os.urandom(min(size, 1024**2))
+    paths = []
+    for i in range(count):
+        path = directory / f'file_{i:05d}.bin'
+        with open(path, 'wb') as f:
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(block[:size % len(block)])
+        paths.append(str(path))
+    return paths
+
+def run_scenario(workdir: Path, count: int, size: int) -> list[dict]:
+    ''' archive, list, retrieve, recall and delete count files of size bytes, returns one result per operation '''
+    import archive_tool
+    data_dir = workdir / 'data'
+    retrieve_dir = workdir / 'retrieved'
+    retrieve_dir.mkdir(parents=True)
+    paths = _write_files(data_dir, count, size)
+
+    def delete():
+        # delete needs archived objects, archive them again first, thats not part of the measurement
+        _write_files(workdir / 'data_again', count, size)
+        again = sorted(str(p) for p in (workdir / 'data_again').iterdir())
+        archive_tool.archive_objects(again)
+        start = time.perf_counter()
+        archive_tool.delete_objects(again + [archive_tool.stubname(p) for p in again])
+        return time.perf_counter() - start
+
+    steps = {
+        'archive': lambda: archive_tool.archive_objects(paths),
+        'list': lambda: (archive_tool.refresh_catalog([str(data_dir) + '/']), archive_tool.query_catalog([str(data_dir) + '/'])),
+        'retrieve': lambda: archive_tool.retrieve_objects(paths, str(retrieve_dir)),
+        'recall': lambda: archive_tool.recall_objects(paths),
+        'delete': delete,
+    }
+    results, failed = [], None
+    for operation in OPERATIONS:
+        result = {'operation': operation, 'files': count, 'file_size': size, 'bytes': 0 if operation == 'list' else count * size,
+                  'seconds': None, 'files_per_sec': None, 'gb_per_sec': None, 'phases': {}, 'error': None}
+        if failed:
+            result['error'] = f'skipped, {failed} failed'
+            results.append(result)
+            continue
+        before = {name: phase['seconds'] for name, phase in archive_tool._span_totals.items()}
+        start = time.perf_counter()
+        try:
+            measured = steps[operation]()
+        except Exception as e:
+            failed = operation
+            result['error'] = f'{type(e).__name__}: {e}'
+            results.append(result)
+            continue
+        seconds = measured if isinstance(measured, float) else time.perf_counter() - start
+        # seconds spent in every instrumented phase of the operation, nested phases overlap their parents
+        phases = {name: phase['seconds'] - before.get(name, 0.0) for name, phase in archive_tool._span_totals.items()}
+        result.update(seconds=seconds, files_per_sec=count / seconds if seconds > 0 else None,
+                      gb_per_sec=result['bytes'] / 1e9 / seconds if seconds > 0 else None,
+                      phases={name: round(seconds, 6) for name, seconds in sorted(phases.items()) if seconds > 0})
+        results.append(result)
+    return results
+
+def run_hash_benchmark(file_sizes: list[int] = FILE_SIZES, workdir: str = None, buffer_size: int = None) -> dict:
+    ''' hash one file of every size with the sha256sum subprocess and every in-process method, from a cold page cache
+
+    the page cache of the file is dropped before every run, so run it on the filesystem to benchmark with files larger than its cache
+    '''
+    import archive_tool
+    buffer_size = buffer_size or archive_tool.HASH_BUFFER_SIZE
+    methods = {'sha256sum': archive_tool.sha256sum}
+    methods.update({name: functools.partial(archive_tool.hash_file, buffer_size=buffer_size, **options) for name, options in HASH_METHODS.items()})
+    results = []
+    with tempfile.TemporaryDirectory(prefix='archive_tool_bench_', dir=workdir) as tmp:
+        for size in file_sizes:
+            path, = _write_files(Path(tmp) / f'hash_{size}', 1, size)
+            digests = set()
+            for operation, method in methods.items():
+                result = {'operation': operation, 'files': 1, 'file_size': size, 'bytes': size,
+                          'seconds': None, 'files_per_sec': None, 'gb_per_sec': None, 'phases': {}, 'error': None}
+                archive_tool.evict_from_page_cache([path])
+                start = time.perf_counter()
+                try:
+                    digests.add(method(path))
+                except RuntimeError as e:
+                    result['error'] = str(e)
+                else:
+                    seconds = time.perf_counter() - start
+                    result.update(seconds=seconds, files_per_sec=1 / seconds, gb_per_sec=size / 1e9 / seconds)
+                results.append(result)
+                print(_format_result(result), flush=True)
+            if len(digests) > 1:
+                raise RuntimeError(f"the hash methods disagree on {path}: {sorted(digests)}")
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'buffer_size': buffer_size,
+        'results': results,
+    }
+
+# globals of archive_tool the benchmark points at its scratch directory
+SCRATCH_SETTINGS = ('CATALOG_PATH', 'JOURNAL_DIR', 'CHECKSUM_CACHE_PATH', 'MIN_FILESIZE_BYTES', 'METRICS_PATH', 'print_progress')
+
+@contextlib.contextmanager
+def _restored_settings(module, names: Iterable[str]):
+    ''' put the globals of module and the environment back as they were afterwards '''
+    saved = {name: getattr(module, name) for name in names}
+    environ = dict(os.environ)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+        os.environ.clear()
+        os.environ.update(environ)
+
+def run_benchmark(batch_sizes: list[int] = BATCH_SIZES, file_sizes: list[int] = FILE_SIZES, workdir: str = None,
+                  verbose=False, **fake_dsmc_options) -> dict:
+    ''' run every scenario in a fresh directory with the fake dsmc, returns the results as a json serializable dict '''
+    # imported here, the fake dsmc sessions started from this script dont need it and shouldnt pay for importing it
+    import archive_tool
+    with _restored_settings(archive_tool, SCRATCH_SETTINGS), \
+         tempfile.TemporaryDirectory(prefix='archive_tool_bench_', dir=workdir) as tmp:
+        tmp = Path(tmp)
+        install_fake_dsmc(str(tmp / 'bin'), str(tmp / 'store'), **fake_dsmc_options)
+        # scratch state of archive_tool, and files small enough for a benchmark
+        archive_tool.CATALOG_PATH = str(tmp / 'catalog.sqlite3')
+        archive_tool.JOURNAL_DIR = str(tmp / 'journals')
+        archive_tool.CHECKSUM_CACHE_PATH = str(tmp / 'checksums.sqlite3')
+        archive_tool.MIN_FILESIZE_BYTES = 1
+        archive_tool.METRICS_PATH = str(tmp / 'metrics.jsonl')
+        archive_tool.print_progress = False
+        results = []
+        for size in file_sizes:
+            for count in batch_sizes:
+                log = io.StringIO()
+                with contextlib.redirect_stdout(sys.stdout if verbose else log):
+                    scenario = run_scenario(tmp / f'scenario_{count}x{size}', count, size)
+                results += scenario
+                for result in scenario:
+                    print(_format_result(result), flush=True)
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'fake_dsmc': fake_dsmc_options,
+        'results': results,
+    }
+
+def _format_result(result: dict) -> str:
+    scenario = f"{result['operation']:<15} {result['files']:>6} x {result['file_size'] / 1024**2:>8.2f} MiB"
+    if result['error']:
+        return f"{scenario}  {result['error']}"
+    rates = f"{result['files_per_sec']:>10.1f} files/s"
+    if result['bytes']:
+        rates += f" {result['gb_per_sec']:>8.3f} GB/s"
+    return f"{scenario} {result['seconds']:>9.3f}s {rates}"
+
+def find_regressions(results: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> list[str]:
+    ''' the operations that took more than tolerance longer than in the baseline, or failed when they didnt before '''
+    def key(result):
+        return result['operation'], result['files'], result['file_size']
+    known = {key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results['results']:
+        old = known.get(key(result))
+        if old is None or old['seconds'] is None:
+            continue
+        if result['seconds'] is None:
+            regressions.append(f"{_format_result(result)}, took {old['seconds']:.3f}s in the baseline")
+        elif result['seconds'] > old['seconds'] * (1 + tolerance):
+            regressions.append(f"{_format_result(result)}, {result['seconds'] / old['seconds'] - 1:+.0%} against {old['seconds']:.3f}s in the baseline")
+    return regressions
+
+
+def _sizes(text: str) -> list[int]:
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    return [int(float(s[:-1]) * units[s[-1].upper()]) if s[-1].upper() in units else int(s) for s in text.split(',')]
+
+def main():
+    if sys.argv[1:2] == ['fake-dsmc']:
+        sys.exit(fake_dsmc_main(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Benchmark archive_tool against a simulated dsmc')
+    parser.add_argument('--batch-sizes', dest='batch_sizes', type=_sizes, default=BATCH_SIZES, help=f'comma separated numbers of files per scenario (default: {",".join(map(str, BATCH_SIZES))})')
+    parser.add_argument('--file-sizes', dest='file_sizes', type=_sizes, default=FILE_SIZES, help='comma separated file sizes, with K, M or G suffixes (default: 1M,16M)')
+    parser.add_argument('--latency', type=float, default=0, help='seconds every dsmc session takes to start')
+    parser.add_argument('--bandwidth', type=float, default=0, help='bytes per second dsmc transfers, 0 is unlimited')
+    parser.add_argument('--mount-delay', dest='mount_delay', type=float, default=0, help='seconds a retrieve waits for every tape volume it reads')
+    parser.add_argument('--fail-rate', dest='fail_rate', type=float, default=0, help='probability of a dsmc session to fail')
+    parser.add_argument('--workdir', type=str, default=None, help='directory for the scenario files, on the filesystem to benchmark (default: the temp dir)')
+    parser.add_argument('--output', type=str, default=None, help='write the results as json to this file')
+    parser.add_argument('--compare', type=str, default=None, help='json results of an earlier run, exit with 1 if an operation regressed')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE, help=f'slowdown against --compare that counts as regression (default: {REGRESSION_TOLERANCE})')
+    parser.add_argument('--verbose', action='store_true', help='show the output of archive_tool')
+    parser.add_argument('--hash', action='store_true', help='instead of the scenarios, compare hashing files of --file-sizes with the sha256sum subprocess and in-process')
+    parser.add_argument('--buffer-size', dest='buffer_size', type=lambda text: _sizes(text)[0], default=None, help='with --hash, bytes read at once (default: HASH_BUFFER_SIZE of archive_tool)')
+    args = parser.parse_args()
+
+    if args.hash:
+        results = run_hash_benchmark(args.file_sizes, workdir=args.workdir, buffer_size=args.buffer_size)
+    else:
+        results = run_benchmark(args.batch_sizes, args.file_sizes, workdir=args.workdir, verbose=args.verbose,
+                                latency=args.latency, bandwidth=args.bandwidth, mount_delay=args.mount_delay, fail_rate=args.fail_rate)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + '\n')
+    if args.compare:
+        regressions = find_regressions(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,11 @@ import time
 import subprocess
 import json
 import os
+import contextvars
+import asyncio
+import threading
+from concurrent import futures
+import sys
 
 import random
 import re
@@ -42,6 +47,34 @@ Session established with server XXXXXXX: XXX
 '''
 DSMC_SPY = []
 DSMC_SPY_STORAGE = []
+# path -> size of everything the fake dsmc archived
+FAKE_ARCHIVE = {}
+# path -> (volume, restore order) the fake dsmc reports with -detail
+FAKE_LOCATIONS = {}
+
+def fake_query_archive_output(pattern, names=None):
+    ''' the archived objects matching pattern, or with names, the ones of a filelist '''
+    prefix = pattern.removesuffix('*')
+    lines = ['IBM Storage Protect', '',
+             '             Size  Archive Date - Time    File - Expires on - Description',
+             '             ----  -------------------    -------------------------------']
+    for path, size in sorted(FAKE_ARCHIVE.items()):
+        if path in names if names is not None else path.startswith(prefix):
+            lines.append(f'{size:>17,}  B  08/15/2025 10:12:33    {path} Never Archive Date: 08/15/2025')
+    return '\n'.join(lines) + '\n'
+
+def fake_query_archive_detail_output(names):
+    lines = ['IBM Storage Protect', '',
+             '             Size  Archive Date - Time    File - Expires on - Description',
+             '             ----  -------------------    -------------------------------']
+    for path in names:
+        if path in FAKE_ARCHIVE:
+            lines.append(f'{FAKE_ARCHIVE[path]:>17,}  B  08/15/2025 10:12:33    {path} Never Archive Date: 08/15/2025')
+            lines.append('  RetInit:STARTED   ObjHeld:NO')
+            if path in FAKE_LOCATIONS:
+                volume, order = FAKE_LOCATIONS[path]
+                lines.append(f'  Compressed: NO  Media Class: Library  Volume ID: {volume}  Restore Order: {order}')
+    return '\n'.join(lines) + '\n'
 
 def read_file(f):
     with open(f,'rt') as f:
@@ -66,12 +99,37 @@ def fake_dsmc(cmd, **kwargs):
         DSMC_SPY_STORAGE += [objnames]
         for obj in objnames:
             shutil.copy(obj, str(dsmc_spy_storepath / (Path(obj).name)))
+            FAKE_ARCHIVE[obj] = Path(obj).stat().st_size
 
         class FakeRes:
             stdout = ""
             stderr = ""
         return FakeRes()
+    elif cmd[:4] == ['dsmc', 'query', 'archive', '-detail']:
+        class FakeRes:
+            stdout = fake_query_archive_detail_output(read_file(cmd[-1].removeprefix('-filelist=')).splitlines())
+            stderr = ""
+        return FakeRes()
+    elif cmd[:3] == ['dsmc', 'query', 'archive'] and cmd[-1].startswith('-filelist='):
+        names = set(read_file(cmd[-1].removeprefix('-filelist=')).splitlines())
+        class FakeRes:
+            stdout = fake_query_archive_output('', names)
+            stderr = ""
+        return FakeRes()
     elif cmd[:3] == ['dsmc', 'query', 'archive']:
+        class FakeRes:
+            stdout = fake_query_archive_output(cmd[-1])
+            stderr = ""
+        return FakeRes()
+    elif cmd[:2] == ['dsmc', 'retrieve'] and any(c.startswith('-filelist=') for c in cmd):
+        filelist = [c for c in cmd if c.startswith('-filelist=')][0]
+        objnames = read_file(filelist.removeprefix('-filelist=')).splitlines()
+        DSMC_SPY_STORAGE += [objnames]
+        dest_dir = None if cmd[-1].startswith('-') else cmd[-1]
+        for obj in objnames:
+            dest = str(Path(dest_dir) / Path(obj).name) if dest_dir else obj
+            shutil.copy(str(dsmc_spy_storepath / (Path(obj).name)), dest)
+
         class FakeRes:
             stdout = ""
             stderr = ""
@@ -86,6 +144,9 @@ def fake_dsmc(cmd, **kwargs):
             stderr = ""
         return FakeRes()
     elif cmd[:2] == ['dsmc', 'delete']:
+        for obj in read_file(cmd[-1].removeprefix('-filelist=')).splitlines():
+            FAKE_ARCHIVE.pop(obj, None)
+
         class FakeRes:
             stdout = ""
             stderr = ""
@@ -112,9 +173,19 @@ def fake_dsmc(cmd, **kwargs):
     # should not reach here
     assert False, "unexpected dmsc command invoked during testing"
 
+def fake_dsmc_lines(cmd, **kwargs):
+    ''' streaming variant of fake_dsmc, for archive_tool.subproc_lines '''
+    yield from fake_dsmc(cmd, **kwargs).stdout.splitlines(keepends=True)
+
 @pytest.fixture
-def spy_dsmc(monkeypatch):
+def spy_dsmc(monkeypatch, tmp_path):
     monkeypatch.setattr(archive_tool, "subproc", fake_dsmc)
+    monkeypatch.setattr(archive_tool, "subproc_lines", fake_dsmc_lines)
+    monkeypatch.setattr(archive_tool, "CATALOG_PATH", str(tmp_path / 'catalog.sqlite3'))
+    monkeypatch.setattr(archive_tool, "JOURNAL_DIR", str(tmp_path / 'journals'))
+    monkeypatch.setattr(archive_tool, "CHECKSUM_CACHE_PATH", str(tmp_path / 'checksums.sqlite3'))
+    FAKE_ARCHIVE.clear()
+    FAKE_LOCATIONS.clear()
     dsmc_spy_storepath.mkdir(exist_ok=True, parents=True)
     yield
     shutil.rmtree(dsmc_spy_storepath)
@@ -388,7 +459,8 @@ def test_stress_archive_retrieval(tmp_path):
     print(f"{NUM_FILES} files archived and retrieved successfully")
 
 
-def test_full_lifecycle_two_files():
+@pytest.mark.skipif(shutil.which('dsmc') is None, reason="needs a real dsmc client")
+def test_full_lifecycle_two_files(monkeypatch, tmp_path):
     """ tests the full file lifecycle
     the file can transfer from local to archive,
     migrate back
@@ -400,6 +472,8 @@ def test_full_lifecycle_two_files():
 
     # IDEA: use 2 files to test combinations
 
+    # the random files are generated under the working directory
+    monkeypatch.chdir(tmp_path)
     testfile1 = str(gen_random_file())
     testfile2 = str(gen_random_file())
     checksum1 = get_file_checksum(testfile1)
@@ -473,18 +547,20 @@ def test_full_lifecycle_two_files():
 
 
 
-def test_small_with_spy(spy_dsmc):
+def test_small_with_spy(spy_dsmc, monkeypatch, tmp_path):
     global DSMC_SPY
     global DSMC_SPY_STORAGE
 
+    # the random files are generated under the working directory
+    monkeypatch.chdir(tmp_path)
+
     archive_tool.list_archived_objects([], ignore_missing=True)
     assert DSMC_SPY[0] == ['dsmc', 'query', 'filespace'], DSMC_SPY
     assert DSMC_SPY[1][:2] == ['dsmc', 'query'], DSMC_SPY
     DSMC_SPY = []
     testfile = str(gen_random_file())
     archive_tool.archive_objects([testfile])
-    assert DSMC_SPY[0][:3] == ['sha256sum', '--', testfile], DSMC_SPY
-    assert DSMC_SPY[1][:2] == ['dsmc', 'archive'], DSMC_SPY
+    assert DSMC_SPY[0][:2] == ['dsmc', 'archive'], DSMC_SPY
     DSMC_SPY = []
     retrieve_target_filename = _generate_filename(True, MAX_FILENAME_LEN)
     archive_tool.retrieve_object(testfile, retrieve_target_filename)
@@ -500,3 +576,979 @@ def test_small_with_spy(spy_dsmc):
     assert DSMC_SPY[0][:3] == ['dsmc', 'query', 'systeminfo'], DSMC_SPY
     DSMC_SPY = []
 
+
+
+def test_hash_files_matches_sha256sum(tmp_path):
+    paths = []
+    for i, size in enumerate([0, 1, 4097, 3 * 1024 * 1024 + 17]):
+        path = tmp_path / f'file_{i}'
+        _write_random_file_iterative(path, size)
+        paths.append(str(path))
+
+    checksums = archive_tool.hash_files(paths, workers=3, buffer_size=1024 * 1024)
+    for path in paths:
+        assert checksums[path] == archive_tool.sha256sum(path)
+        assert checksums[path] == calculate_hash(path)
+
+    assert archive_tool.hash_files([]) == {}
+    with pytest.raises(RuntimeError):
+        archive_tool.hash_files([str(tmp_path / 'nonexistent')])
+
+
+def test_hash_file_direct_io_and_read_ahead(tmp_path):
+    # tmp_path may be on tmpfs, which refuses O_DIRECT, then hashing falls back to the page cache
+    for size in [0, 1, 4096, 4097, 5 * 4096, 200_001]:
+        path = tmp_path / f'file_{size}'
+        _write_random_file_iterative(path, size)
+        expected = calculate_hash(path)
+        for direct_io in (False, True):
+            for read_ahead in (0, 1, 3):
+                assert archive_tool.hash_file(str(path), buffer_size=4096, direct_io=direct_io, read_ahead=read_ahead) == expected
+
+    import bench_archive_tool
+    results = bench_archive_tool.run_hash_benchmark([300_000], workdir=str(tmp_path), buffer_size=64 * 1024)
+    assert [r['operation'] for r in results['results']] == ['sha256sum'] + list(bench_archive_tool.HASH_METHODS)
+    assert all(r['error'] is None and r['gb_per_sec'] > 0 for r in results['results']), results
+
+
+def _make_archivable_files(tmp_path, monkeypatch, sizes):
+    ''' create small files and lower the size limit, so archiving tests dont need GBs of data '''
+    monkeypatch.setattr(archive_tool, 'MIN_FILESIZE_BYTES', 1000)
+    paths = []
+    for i, size in enumerate(sizes):
+        path = tmp_path / f'file_{i}.bin'
+        _write_random_file_iterative(path, size)
+        paths.append(str(path))
+    return paths
+
+
+def test_archive_pipelined_chunks(spy_dsmc, tmp_path, monkeypatch):
+    global DSMC_SPY
+    DSMC_SPY = []
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000, 2000])
+    checksums = {p: calculate_hash(p) for p in paths}
+
+    assert archive_tool.plan_cache_chunks(paths, {p: 4000 for p in paths}, 8000) == [paths[:2], paths[2:]]
+
+    archive_tool.archive_objects(paths, pipelined=True, cache_budget=16000)
+    sessions = [cmd for cmd in DSMC_SPY if cmd[:2] == ['dsmc', 'archive']]
+    assert len(sessions) == 2, DSMC_SPY
+    for path in paths:
+        assert not Path(path).exists()
+        records = archive_tool.parse_stubfile(archive_tool.stubname(path))
+        assert records[0]['sha256checksum'] == checksums[path]
+        assert records[-1]['state'] == 'successfully_archived'
+
+
+def test_pipelined_falls_back_for_oversize_files(spy_dsmc, tmp_path, monkeypatch, capsys):
+    global DSMC_SPY
+    DSMC_SPY = []
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000, 2000])
+
+    # a 5000 byte file cant stay cached with half of the budget, so no session per file but the normal batches
+    plan = archive_tool.archive_objects(paths, pipelined=True, cache_budget=8000, dry_run=True)
+    assert plan == [[sorted(paths)]]
+    assert 'archiving without --pipelined' in capsys.readouterr().out
+
+    archive_tool.archive_objects(paths, pipelined=True, cache_budget=8000)
+    assert len([cmd for cmd in DSMC_SPY if cmd[:2] == ['dsmc', 'archive']]) == 1, DSMC_SPY
+    assert not any(Path(path).exists() for path in paths)
+
+
+def test_hash_growing_file(tmp_path):
+    path = tmp_path / 'growing'
+    data = os.urandom(3 * 1024 * 1024)
+    writer_done = archive_tool.threading.Event()
+
+    def writer():
+        time.sleep(0.05)
+        with open(path, 'wb') as f:
+            for i in range(0, len(data), 512 * 1024):
+                f.write(data[i:i + 512 * 1024])
+                f.flush()
+                time.sleep(0.01)
+        writer_done.set()
+
+    thread = archive_tool.threading.Thread(target=writer)
+    thread.start()
+    checksum = archive_tool.hash_growing_file(str(path), writer_done, poll_interval=0.005, buffer_size=64 * 1024)
+    thread.join()
+    assert checksum == hashlib.sha256(data).hexdigest()
+
+    writer_done = archive_tool.threading.Event()
+    writer_done.set()
+    with pytest.raises(RuntimeError):
+        archive_tool.hash_growing_file(str(tmp_path / 'never_written'), writer_done)
+
+
+def test_retrieve_detects_corruption(spy_dsmc, tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000])
+    archive_tool.archive_objects(paths)
+    stored = dsmc_spy_storepath / Path(paths[0]).name
+    with open(stored, 'r+b') as f:
+        f.write(b'corrupted')
+
+    with pytest.raises(RuntimeError, match='checksum verification failed'):
+        archive_tool.retrieve_object(paths[0], str(tmp_path / 'retrieved.bin'))
+
+
+def test_extra_digests(spy_dsmc, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_tool, 'extra_digests', ['blake2b'])
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 200_000])
+    archive_tool.archive_objects(paths, hash_workers=2)
+    for path in paths:
+        digests = archive_tool.get_original_digests(path)
+        assert set(digests) == {'sha256', 'blake2b'}
+        assert digests['sha256'] == hashlib.sha256((dsmc_spy_storepath / Path(path).name).read_bytes()).hexdigest()
+        assert digests['blake2b'] == hashlib.blake2b((dsmc_spy_storepath / Path(path).name).read_bytes()).hexdigest()
+    stored = str(dsmc_spy_storepath / Path(paths[2]).name)
+    assert archive_tool.hash_file_digests(stored, ['sha256', 'blake2b'], buffer_size=4096) == archive_tool.get_original_digests(paths[2])
+
+    # verify with blake2b, as if this host computed it faster
+    speeds = {'sha256': 1.0, 'blake2b': 2.0}
+    monkeypatch.setattr(archive_tool, 'digest_speed', lambda algorithm: speeds[algorithm])
+    verified = []
+    hash_files = archive_tool.hash_files
+    monkeypatch.setattr(archive_tool, 'hash_files', lambda p, **kw: verified.append(kw.get('algorithms')) or hash_files(p, **kw))
+    (tmp_path / 'retrieved').mkdir()
+    archive_tool.retrieve_objects(paths[:2], str(tmp_path / 'retrieved'))
+    assert verified == [['blake2b']]
+    archive_tool.retrieve_object(paths[2], str(tmp_path / 'single.bin'))
+
+    # objects archived before, with only sha256, are still verified
+    monkeypatch.setattr(archive_tool, 'extra_digests', [])
+    old = [str(tmp_path / 'old.bin')]
+    _write_random_file_iterative(old[0], 5000)
+    archive_tool.archive_objects(old)
+    assert archive_tool.get_original_digests(old[0]).keys() == {'sha256'}
+    stored = dsmc_spy_storepath / Path(paths[0]).name
+    with open(stored, 'r+b') as f:
+        f.write(b'corrupted')
+    (tmp_path / 'again').mkdir()
+    with pytest.raises(RuntimeError, match=f'checksum verification failed for: {paths[0]}$'):
+        archive_tool.retrieve_objects([paths[0], old[0]], str(tmp_path / 'again'))
+
+
+def test_batch_retrieve_and_recall(spy_dsmc, tmp_path, monkeypatch):
+    global DSMC_SPY
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000])
+    checksums = {p: calculate_hash(p) for p in paths}
+    archive_tool.archive_objects(paths)
+
+    DSMC_SPY = []
+    retrieve_dir = tmp_path / 'retrieved'
+    retrieve_dir.mkdir()
+    archive_tool.retrieve_objects(paths, str(retrieve_dir))
+    assert [cmd[:2] for cmd in DSMC_SPY].count(['dsmc', 'retrieve']) == 1, DSMC_SPY
+    for path in paths:
+        assert calculate_hash(retrieve_dir / Path(path).name) == checksums[path]
+    with pytest.raises(RuntimeError):
+        archive_tool.retrieve_objects(paths, str(retrieve_dir))
+
+    DSMC_SPY = []
+    archive_tool.recall_objects(paths)
+    assert [cmd[:2] for cmd in DSMC_SPY].count(['dsmc', 'retrieve']) == 1, DSMC_SPY
+    for path in paths:
+        assert calculate_hash(path) == checksums[path]
+        assert not Path(archive_tool.stubname(path)).exists()
+
+
+def test_delete_objects_batched(spy_dsmc):
+    global DSMC_SPY
+    DSMC_SPY = []
+    names = ['/a/one.bin', '/a/two.bin', '/b/three.bin']
+    results = archive_tool.delete_objects(names)
+    assert len(DSMC_SPY) == 1 and DSMC_SPY[0][:4] == ['dsmc', 'delete', 'archive', '-noprompt'], DSMC_SPY
+    assert results == {name: 'deleted' for name in names}
+
+
+def test_parse_delete_output():
+    names = ['/a/one.bin', '/a/two.bin', '/b/three.bin']
+    output = """Archive Delete function invoked.
+Deleting /a/one.bin [Done]
+ANS1345E No objects on server match '/a/two.bin'
+"""
+    results = archive_tool.parse_delete_output(output, names, succeeded=False)
+    assert results == {'/a/one.bin': 'deleted', '/a/two.bin': 'failed', '/b/three.bin': 'failed'}
+    results = archive_tool.parse_delete_output('', names, succeeded=True)
+    assert set(results.values()) == {'deleted'}
+
+
+def test_parse_archive_query():
+    output = """IBM Storage Protect
+Command Line Backup-Archive Client Interface
+
+             Size  Archive Date - Time    File - Expires on - Description
+             ----  -------------------    -------------------------------
+    1,073,741,824  B  08/15/2025 10:12:33    /a/big file.bin Never Archive Date: 08/15/2025
+              576  B  01/02/2024 09:00:00    /a/big file.bin.archive_stub 01/02/2034 
+"""
+    entries = archive_tool.parse_archive_query(output)
+    assert entries[0] == archive_tool.ArchiveEntry(size=1073741824, archive_date='2025-08-15T10:12:33', path='/a/big file.bin',
+                                                   expires='Never', description='Archive Date: 08/15/2025')
+    assert entries[1].expires == '2034-01-02T00:00:00'
+    with pytest.raises(ValueError):
+        archive_tool.parse_archive_query(output + 'garbage\n')
+    with pytest.raises(ValueError):
+        archive_tool.parse_archive_query('no listing here\n')
+
+    # entries are yielded before the rest of the output is read
+    def lines():
+        yield from output.splitlines(keepends=True)[:6]
+        raise AssertionError('read too far')
+    assert next(archive_tool.iter_archive_entries(lines())).path == '/a/big file.bin'
+
+
+def test_subproc_lines(tmp_path):
+    script = 'import sys\nfor i in range(3): print(i)\nsys.exit(int(sys.argv[1]))\n'
+    assert list(archive_tool.subproc_lines(['python3', '-c', script, '0'])) == ['0\n', '1\n', '2\n']
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        list(archive_tool.subproc_lines(['python3', '-c', script, '8']))
+    assert e.value.output == '0\n1\n2\n'
+
+
+def test_catalog(spy_dsmc, tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000])
+    checksums = {p: calculate_hash(p) for p in paths}
+    archive_tool.archive_objects(paths)
+
+    rows = archive_tool.query_catalog([str(tmp_path) + '/'])
+    assert [row['path'] for row in rows] == sorted(paths)
+    assert all(row['sha256checksum'] == checksums[row['path']] for row in rows)
+    assert [row['path'] for row in archive_tool.query_catalog(min_size=4000)] == [paths[0], paths[2]]
+    assert [row['path'] for row in archive_tool.query_catalog(checksum=checksums[paths[1]])] == [paths[1]]
+    assert archive_tool.query_catalog(since='2999-01-01') == []
+
+    archive_tool.delete_objects([paths[0]])
+    assert [row['path'] for row in archive_tool.query_catalog()] == [paths[1], paths[2]]
+
+    assert archive_tool.unsynced_prefixes() == [''] and archive_tool.unsynced_prefixes(['/elsewhere/']) == ['/elsewhere/']
+
+    # the server is the source of truth on refresh, the known checksums are kept, committed in chunks
+    monkeypatch.setattr(archive_tool, 'CATALOG_COMMIT_ROWS', 1)
+    FAKE_ARCHIVE['/elsewhere/other.bin'] = 7000
+    FAKE_ARCHIVE['/elsewhere/more.bin'] = 8000
+    del FAKE_ARCHIVE[paths[1]]
+    archive_tool.refresh_catalog([str(tmp_path) + '/*', '/elsewhere/*'])
+    rows = archive_tool.query_catalog()
+    assert [row['path'] for row in rows] == ['/elsewhere/more.bin', '/elsewhere/other.bin', paths[2]]
+    assert rows[2]['sha256checksum'] == checksums[paths[2]]
+    assert rows[2]['archive_date'] == '2025-08-15T10:12:33'
+    assert archive_tool.unsynced_prefixes() == [] and archive_tool.unsynced_prefixes(['/elsewhere/sub/', '/other/']) == ['/other/']
+
+
+def test_run_dsmc_with_progress(monkeypatch):
+    output = [
+        'Archive function invoked.\n',
+        'Normal File-->     1,000 /a/one.bin [Sent]\n',
+        'Normal File-->       500 /a/one.bin.archive_stub [Sent]\n',
+        'Retrieving     2,000 /a/two.bin --> /tmp/two.bin [Done]\n',
+        'Network data transfer rate:        1,024.00 KB/sec\n',
+    ]
+    monkeypatch.setattr(archive_tool, 'subproc_lines', lambda cmd: iter(output))
+    events = []
+    archive_tool.run_dsmc_with_progress(['dsmc', 'archive'], total_bytes=7000, callback=events.append)
+    files = [e for e in events if e.kind == 'file']
+    assert [(e.path, e.size, e.status) for e in files] == [
+        ('/a/one.bin', 1000, 'Sent'), ('/a/one.bin.archive_stub', 500, 'Sent'), ('/a/two.bin', 2000, 'Done')]
+    assert files[-1].done_bytes == 3500 and files[-1].total_bytes == 7000
+    assert events[-1].kind == 'rate' and events[-1].reported_rate == 1024 * 1024
+
+
+def test_archive_concurrent_sessions(spy_dsmc, tmp_path, monkeypatch):
+    global DSMC_SPY
+    DSMC_SPY = []
+    paths = _make_archivable_files(tmp_path, monkeypatch, [9000, 5000, 4000, 3000, 1000])
+    sizes = {p: Path(p).stat().st_size for p in paths}
+    partitions = archive_tool.partition_by_size(paths, sizes, 2)
+    assert sorted(sum(partitions, [])) == sorted(paths)
+    assert sorted(sum(sizes[p] for p in part) for part in partitions) == [10000, 12000]
+
+    # a failing session only affects the files of its own partition
+    def failing_partition_lines(cmd, **kwargs):
+        if cmd[:2] == ['dsmc', 'archive'] and paths[0] in read_file(cmd[2].removeprefix('-filelist=')).splitlines():
+            raise subprocess.CalledProcessError(12, cmd)
+        yield from fake_dsmc_lines(cmd, **kwargs)
+    monkeypatch.setattr(archive_tool, 'subproc_lines', failing_partition_lines)
+
+    with pytest.raises(RuntimeError, match='archiving failed'):
+        archive_tool.archive_objects(paths, sessions=2)
+    failed_partition = [part for part in partitions if paths[0] in part][0]
+    for path in paths:
+        records = archive_tool.parse_stubfile(archive_tool.stubname(path))
+        if path in failed_partition:
+            assert Path(path).exists()
+            assert records[-1]['state'] == 'archive_session_failed'
+        else:
+            assert not Path(path).exists()
+            assert records[-1]['state'] == 'successfully_archived'
+
+
+def test_plan_archive_batches(spy_dsmc, tmp_path, monkeypatch, capsys):
+    global DSMC_SPY
+    DSMC_SPY = []
+    paths = _make_archivable_files(tmp_path, monkeypatch, [9000, 5000, 4000, 3000, 1000, 6000])
+    sizes = {p: Path(p).stat().st_size for p in paths}
+
+    plan = archive_tool.plan_archive_batches(paths, sizes, sessions=2, max_batch_bytes=8000)
+    assert sorted(p for batches in plan for batch in batches for p in batch) == sorted(paths)
+    assert sorted(sum(sizes[p] for batch in batches for p in batch) for batches in plan) == [14000, 14000]
+    for batches in plan:
+        for batch in batches:
+            assert batch == sorted(batch)
+            assert len(batch) == 1 or sum(sizes[p] for p in batch) <= 8000
+
+    assert archive_tool.archive_objects(paths, sessions=2, max_batch_bytes=8000, dry_run=True) == plan
+    assert DSMC_SPY == []
+    assert 'estimated total duration' in capsys.readouterr().out
+    assert all(Path(p).exists() and not Path(archive_tool.stubname(p)).exists() for p in paths)
+
+    global DSMC_SPY_STORAGE
+    DSMC_SPY_STORAGE = []
+    archive_tool.archive_objects(paths, max_batch_bytes=8000)
+    assert len(DSMC_SPY_STORAGE) == 4
+    for filelist in DSMC_SPY_STORAGE:
+        # every stubfile directly follows its object
+        assert filelist[1::2] == [archive_tool.stubname(p) for p in filelist[0::2]]
+
+
+def test_resume_archive(spy_dsmc, tmp_path, monkeypatch):
+    global DSMC_SPY
+    paths = _make_archivable_files(tmp_path, monkeypatch, [3000, 3000, 3000])
+
+    def failing_lines(cmd, **kwargs):
+        if cmd[:2] == ['dsmc', 'archive'] and paths[1] in read_file(cmd[2].removeprefix('-filelist=')).splitlines():
+            raise subprocess.CalledProcessError(12, cmd)
+        yield from fake_dsmc_lines(cmd, **kwargs)
+    monkeypatch.setattr(archive_tool, 'subproc_lines', failing_lines)
+    with pytest.raises(RuntimeError, match='--resume'):
+        archive_tool.archive_objects(paths, max_batch_bytes=3000)
+    assert not Path(paths[0]).exists() and Path(paths[1]).exists() and not Path(paths[2]).exists()
+    journals = list((tmp_path / 'journals').iterdir())
+    assert len(journals) == 1
+
+    # without the journal, the leftover stubfile blocks archiving again
+    monkeypatch.setattr(archive_tool, 'subproc_lines', fake_dsmc_lines)
+    with pytest.raises(RuntimeError):
+        archive_tool.archive_objects([paths[1]])
+
+    hashed = []
+    hash_files = archive_tool.hash_files
+    monkeypatch.setattr(archive_tool, 'hash_files', lambda p, **kw: hashed.extend(p) or hash_files(p, **kw))
+    DSMC_SPY = []
+    archive_tool.resume_archive(str(journals[0]))
+    assert hashed == []
+    assert [cmd[:2] for cmd in DSMC_SPY].count(['dsmc', 'archive']) == 1
+    assert not Path(paths[1]).exists()
+    records = archive_tool.parse_stubfile(archive_tool.stubname(paths[1]))
+    assert records[0]['sha256checksum'] == archive_tool.get_original_checksum(paths[1])
+    assert records[-1]['state'] == 'successfully_archived'
+    assert not journals[0].exists()
+
+
+def test_resume_after_crash_during_unlink(spy_dsmc, tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [3000, 3000, 3000])
+
+    # dies right after removing the second file, before journaling it
+    unlink = Path.unlink
+    def crashing_unlink(self, missing_ok=False):
+        unlink(self, missing_ok=missing_ok)
+        if str(self) == paths[1]:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(Path, 'unlink', crashing_unlink)
+    with pytest.raises(KeyboardInterrupt):
+        archive_tool.archive_objects(paths)
+    monkeypatch.setattr(Path, 'unlink', unlink)
+    assert not Path(paths[0]).exists() and not Path(paths[1]).exists() and Path(paths[2]).exists()
+
+    journal = list((tmp_path / 'journals').iterdir())[0]
+    _, phases = archive_tool.ArchiveJournal(str(journal)).read()
+    assert [phases[path]['phase'] for path in paths] == ['unlinked', 'verified', 'verified']
+    archive_tool.resume_archive(str(journal))
+    assert not any(Path(path).exists() for path in paths)
+    assert not journal.exists()
+
+
+def test_resume_skips_completed_upload(spy_dsmc, tmp_path, monkeypatch):
+    global DSMC_SPY
+    paths = _make_archivable_files(tmp_path, monkeypatch, [3000, 3000, 3000])
+
+    # dsmc archived the files, but the tool was interrupted before noticing
+    def interrupted_lines(cmd, **kwargs):
+        yield from fake_dsmc_lines(cmd, **kwargs)
+        if cmd[:2] == ['dsmc', 'archive']:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(archive_tool, 'subproc_lines', interrupted_lines)
+    with pytest.raises(KeyboardInterrupt):
+        archive_tool.archive_objects(paths)
+    monkeypatch.setattr(archive_tool, 'subproc_lines', fake_dsmc_lines)
+
+    DSMC_SPY = []
+    journal = list((tmp_path / 'journals').iterdir())[0]
+    archive_tool.resume_archive(str(journal))
+    # one query for all files
+    assert [cmd[:3] for cmd in DSMC_SPY] == [['dsmc', 'query', 'archive']] and DSMC_SPY[0][-1].startswith('-filelist=')
+    for path in paths:
+        assert not Path(path).exists()
+        assert archive_tool.parse_stubfile(archive_tool.stubname(path))[-1]['state'] == 'successfully_archived'
+
+
+def test_checksum_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_tool, "CHECKSUM_CACHE_PATH", str(tmp_path / 'checksums.sqlite3'))
+    paths = []
+    for i in range(3):
+        path = tmp_path / f'file_{i}'
+        _write_random_file_iterative(path, 4096)
+        paths.append(str(path))
+    hashed = []
+    hash_files = archive_tool.hash_files
+    monkeypatch.setattr(archive_tool, 'hash_files', lambda p, **kw: hashed.extend(p) or hash_files(p, **kw))
+
+    checksums = archive_tool.cached_hash_files(paths)
+    assert checksums == {p: calculate_hash(p) for p in paths}
+    assert sorted(hashed) == sorted(paths)
+
+    hashed.clear()
+    assert archive_tool.cached_hash_files(paths) == checksums
+    assert hashed == []
+
+    # a changed file is hashed again
+    with open(paths[0], 'ab') as f:
+        f.write(b'more')
+    hashed.clear()
+    assert archive_tool.cached_hash_files(paths)[paths[0]] == calculate_hash(paths[0])
+    assert hashed == [paths[0]]
+
+    monkeypatch.setattr(archive_tool, 'trust_checksum_cache', False)
+    hashed.clear()
+    archive_tool.cached_hash_files(paths)
+    assert sorted(hashed) == sorted(paths)
+
+    monkeypatch.setattr(archive_tool, 'CHECKSUM_CACHE_MAX_ENTRIES', 2)
+    archive_tool.cached_hash_files(paths[:1])
+    with archive_tool.closing(archive_tool.open_checksum_cache()) as conn:
+        assert conn.execute("SELECT count(*) FROM checksums").fetchone()[0] == 2
+
+
+def test_xattr_checksum_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_tool, "CHECKSUM_CACHE_PATH", str(tmp_path / 'checksums.sqlite3'))
+    monkeypatch.setattr(archive_tool, 'use_xattr_checksums', True)
+    path = tmp_path / 'file'
+    _write_random_file_iterative(path, 4096)
+    try:
+        os.setxattr(path, 'user.test', b'1')
+    except OSError:
+        pytest.skip('filesystem without user extended attributes')
+
+    checksum = archive_tool.cached_hash_files([str(path)])[str(path)]
+    assert json.loads(os.getxattr(path, archive_tool.XATTR_CHECKSUM_NAME))['sha256'] == checksum
+    # the attribute is found even without the cache database
+    Path(archive_tool.CHECKSUM_CACHE_PATH).unlink()
+    monkeypatch.setattr(archive_tool, 'hash_files', lambda p, **kw: pytest.fail('hashed again'))
+    assert archive_tool.cached_hash_files([str(path)]) == {str(path): checksum}
+
+
+def _write_stub(path, state=None, size=5000):
+    with open(archive_tool.stubname(str(path)), 'wt') as f:
+        f.write(json.dumps({"entry_type": "pre_archive_check", "path": str(path), "sha256checksum": "ab" * 32, "size": size, "metadata": {}}) + '\n')
+        if state:
+            f.write(json.dumps({"entry_type": "state", "state": state, "path": str(path)}) + '\n')
+
+
+def test_read_stub_ends(tmp_path, monkeypatch):
+    path = tmp_path / 'file.bin'
+    _write_stub(path)
+    first, last = archive_tool.read_stub_ends(archive_tool.stubname(str(path)))
+    assert first == last and first['size'] == 5000
+
+    monkeypatch.setattr(archive_tool, 'STUB_TAIL_READ_SIZE', 8)
+    with open(archive_tool.stubname(str(path)), 'at') as f:
+        for state in ['successfully_archived', 'started_recalling', 'x' * 100]:
+            f.write(json.dumps({"entry_type": "state", "state": state, "path": str(path)}) + '\n')
+    first, last = archive_tool.read_stub_ends(archive_tool.stubname(str(path)))
+    assert first['entry_type'] == 'pre_archive_check' and last['state'] == 'x' * 100
+    assert (first, last) == (archive_tool.parse_stubfile(archive_tool.stubname(str(path)))[0],
+                             archive_tool.parse_stubfile(archive_tool.stubname(str(path)))[-1])
+
+
+def test_scan_stubs(tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_tool, "CATALOG_PATH", str(tmp_path / 'catalog.sqlite3'))
+    root = tmp_path / 'tree'
+    for d in ['a/b/c', 'a/d', 'e']:
+        (root / d).mkdir(parents=True)
+    _write_stub(root / 'a' / 'one.bin', 'successfully_archived')
+    _write_stub(root / 'a' / 'b' / 'c' / 'two.bin', 'successfully_archived')
+    _write_stub(root / 'e' / 'three.bin')
+    (root / 'a' / 'd' / 'not_a_stub.txt').write_text('x')
+
+    assert archive_tool.scan_stubs(str(root), workers=4) == {'successfully_archived': 2, 'pre_archive_check': 1}
+    with archive_tool.closing(archive_tool.open_catalog()) as conn:
+        row = conn.execute("SELECT * FROM stubs WHERE path = ?", (str(root / 'e' / 'three.bin'),)).fetchone()
+    assert row['size'] == 5000 and row['sha256checksum'] == 'ab' * 32
+
+    # only the changed directory is read again
+    read = []
+    read_stub_ends = archive_tool.read_stub_ends
+    monkeypatch.setattr(archive_tool, 'read_stub_ends', lambda p: read.append(p) or read_stub_ends(p))
+    _write_stub(root / 'a' / 'd' / 'four.bin', 'successfully_archived')
+    shutil.rmtree(root / 'e')
+    assert archive_tool.scan_stubs(str(root), workers=4) == {'successfully_archived': 3}
+    assert read == [archive_tool.stubname(str(root / 'a' / 'd' / 'four.bin'))]
+
+    read.clear()
+    archive_tool.scan_stubs(str(root), full=True)
+    assert len(read) == 3
+
+
+def test_discover_candidates(spy_dsmc, tmp_path, monkeypatch):
+    monkeypatch.setattr(archive_tool, 'MIN_FILESIZE_BYTES', 1000)
+    root = tmp_path / 'tree'
+    for d in ['a/b', 'a/skip', 'c']:
+        (root / d).mkdir(parents=True)
+    for name, size in [('a/big.bin', 3000), ('a/small.bin', 10), ('a/b/big.bin', 2000), ('a/skip/big.bin', 2000),
+                       ('c/big.tmp', 2000), ('c/recent.bin', 2000), ('c/archived.bin', 2000)]:
+        _write_random_file_iterative(root / name, size)
+    _write_stub(root / 'c' / 'archived.bin')
+    os.symlink(root / 'a' / 'big.bin', root / 'c' / 'link.bin')
+    old = time.time() - 3 * 86400
+    for name in ['a/big.bin', 'a/b/big.bin', 'a/skip/big.bin', 'c/big.tmp', 'c/archived.bin']:
+        os.utime(root / name, (old, old))
+
+    stats = archive_tool.discover_candidates([str(root)], min_age_days=2, excludes=['*/skip', '*.tmp'])
+    assert list(stats) == [str(root / 'a' / 'b' / 'big.bin'), str(root / 'a' / 'big.bin')]
+    assert stats[str(root / 'a' / 'big.bin')].st_size == 3000
+    assert len(archive_tool.discover_candidates([str(root)], min_size=2500)) == 1
+
+    archive_tool.archive_objects(list(stats), stats=stats)
+    assert all(not Path(p).exists() and Path(archive_tool.stubname(p)).exists() for p in stats)
+
+
+def test_preflight_reports_all_failures(tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [3000, 10, 3000, 3000])
+    _write_stub(paths[2])
+    link = tmp_path / 'link.bin'
+    os.symlink(paths[0], link)
+    fifo = tmp_path / 'fifo.bin'
+    os.mkfifo(fifo)
+    directory = tmp_path / 'dir.bin'
+    directory.mkdir()
+    bad_name = tmp_path / '-bad name'
+    _write_random_file_iterative(bad_name, 3000)
+    candidates = paths + [paths[3], str(link), str(fifo), str(directory), str(bad_name), str(tmp_path / 'missing.bin')]
+
+    report = archive_tool.preflight_check(candidates)
+    assert list(report.stats) == [paths[0], paths[3]]
+    failed = {path: reason for path, reason in report.failures}
+    assert set(failed) == {paths[1], paths[2], paths[3], str(link), str(fifo), str(directory), str(bad_name), str(tmp_path / 'missing.bin')}
+    assert 'small' in failed[paths[1]] and 'already exists' in failed[paths[2]] and 'once' in failed[paths[3]]
+    assert 'special' in failed[str(link)] and 'special' in failed[str(fifo)] and 'not a file' in failed[str(directory)]
+
+    with pytest.raises(RuntimeError, match='8 of 10 files'):
+        archive_tool.archiving_pre_check(candidates)
+    assert archive_tool.preflight_check([paths[2]], own_stubs={paths[2]}).failures == []
+    # device nodes are refused without opening them
+    assert 'special' in archive_tool.preflight_check(['/dev/null']).failures[0][1]
+
+    # a file replaced after it was discovered fails
+    st = os.lstat(paths[0])
+    _write_random_file_iterative(paths[0] + '.new', 3000)
+    os.replace(paths[0] + '.new', paths[0])
+    assert archive_tool.preflight_check([paths[0]], stats={paths[0]: st}).stats == {}
+
+
+def test_replaced_files_arent_hashed_or_removed(spy_dsmc, tmp_path, monkeypatch, capsys):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [3000, 3000])
+    st = os.lstat(paths[0])
+    with pytest.raises(RuntimeError, match='replaced'):
+        archive_tool.hash_file_digests(paths[0], inode=(st.st_dev, st.st_ino + 1))
+
+    # replaced while its batch uploads, after it was hashed
+    upload_batch = archive_tool._upload_batch
+    def replacing_upload(batch, stubfiles):
+        upload_batch(batch, stubfiles)
+        _write_random_file_iterative(paths[0] + '.new', 3000)
+        os.replace(paths[0] + '.new', paths[0])
+    monkeypatch.setattr(archive_tool, '_upload_batch', replacing_upload)
+    archive_tool.archive_objects(paths)
+    assert Path(paths[0]).exists() and not Path(paths[1]).exists()
+    assert f'not removing {paths[0]}' in capsys.readouterr().out
+    # the journal is kept, resuming doesnt remove the replacement either
+    journal = list((tmp_path / 'journals').iterdir())[0]
+    archive_tool.resume_archive(str(journal))
+    assert Path(paths[0]).exists()
+
+
+def test_execute_mixed_jobs(spy_dsmc, tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000, 6000])
+    checksums = {p: calculate_hash(p) for p in paths}
+    archive_tool.execute_job(archive_tool.Job('archive', paths[:2]))
+
+    retrieve_dir = tmp_path / 'retrieved'
+    retrieve_dir.mkdir()
+    jobs_file = tmp_path / 'jobs.jsonl'
+    jobs_file.write_text(json.dumps({'kind': 'retrieve', 'names': paths[:2], 'destination': str(retrieve_dir)}) + '\n' +
+                         json.dumps({'kind': 'archive', 'names': paths[2:], 'timeout': 60}) + '\n' +
+                         json.dumps({'kind': 'recall', 'names': ['/not/archived.bin']}) + '\n')
+    jobs = archive_tool.read_jobs_file(str(jobs_file))
+    assert jobs[1].timeout == 60 and jobs[0].options == {'destination': str(retrieve_dir)}
+    retrieved, archived, recalled = archive_tool.execute_jobs(jobs)
+    assert set(retrieved) == set(paths[:2]) and len(archived) == 1
+    assert isinstance(recalled, Exception)
+    for path in paths[:2]:
+        assert calculate_hash(retrieve_dir / Path(path).name) == checksums[path]
+    for path in paths[2:]:
+        assert not Path(path).exists() and Path(archive_tool.stubname(path)).exists()
+
+
+def test_job_timeout_stops_its_processes(monkeypatch):
+    monkeypatch.setitem(archive_tool.JOB_KINDS, 'sleep', lambda names: archive_tool.subproc(['sleep'] + names))
+    start = time.monotonic()
+    timed_out, done = archive_tool.execute_jobs([archive_tool.Job('sleep', ['30'], timeout=0.5),
+                                                 archive_tool.Job('sleep', ['0.1'], timeout=10)])
+    assert time.monotonic() - start < 10
+    assert isinstance(timed_out, RuntimeError) and 'timed out' in str(timed_out)
+    assert done.returncode == 0
+
+    control = archive_tool.JobControl()
+    control.cancel()
+    monkeypatch.setattr(archive_tool, '_current_job', contextvars.ContextVar('current_job', default=control))
+    with pytest.raises(RuntimeError, match='cancelled'):
+        archive_tool.subproc(['true'])
+
+
+def test_job_timeout_while_waiting_for_a_session(tmp_path, monkeypatch):
+    # a dsmc that holds its session for a while
+    fake_dsmc = tmp_path / 'bin' / 'dsmc'
+    fake_dsmc.parent.mkdir()
+    fake_dsmc.write_text('#!/bin/sh\nexec sleep 5\n')
+    fake_dsmc.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{fake_dsmc.parent}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setitem(archive_tool.JOB_KINDS, 'session', lambda names: archive_tool.subproc(['dsmc'] + names))
+
+    async def contended():
+        sessions = threading.BoundedSemaphore(1)
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            holder = asyncio.create_task(archive_tool.run_job(archive_tool.Job('session', ['a']), archive_tool.JobControl(sessions), executor))
+            await asyncio.sleep(0.3)
+            start = time.monotonic()
+            with pytest.raises(RuntimeError, match='timed out'):
+                await archive_tool.run_job(archive_tool.Job('session', ['b'], timeout=0.5), archive_tool.JobControl(sessions), executor)
+            waited = time.monotonic() - start
+            holder.cancel()
+            await asyncio.gather(holder, return_exceptions=True)
+        return waited
+    assert asyncio.run(contended()) < 1.5
+
+    # hashing stops at the next block once its job is cancelled
+    path = tmp_path / 'big.bin'
+    path.write_bytes(os.urandom(64 * 1024))
+    control = archive_tool.JobControl()
+    control.cancel()
+    monkeypatch.setattr(archive_tool, '_current_job', contextvars.ContextVar('current_job', default=control))
+    with pytest.raises(RuntimeError, match='cancelled'):
+        archive_tool.hash_file(str(path), buffer_size=4096)
+
+
+def _start_daemon(tmp_path, **options):
+    socket_path = str(tmp_path / 'daemon.sock')
+    loop = asyncio.new_event_loop()
+    daemon = loop.create_task(archive_tool.serve_daemon(socket_path, **options))
+    thread = threading.Thread(target=loop.run_until_complete, args=(asyncio.wait([daemon]),))
+    thread.start()
+    for _ in range(100):
+        if Path(socket_path).exists():
+            break
+        time.sleep(0.05)
+
+    def stop():
+        loop.call_soon_threadsafe(daemon.cancel)
+        thread.join()
+        loop.close()
+    return socket_path, stop
+
+
+def test_daemon_coalesces_recalls(spy_dsmc, tmp_path, monkeypatch):
+    global DSMC_SPY
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000])
+    checksums = {p: calculate_hash(p) for p in paths}
+    archive_tool.archive_objects(paths)
+
+    socket_path, stop = _start_daemon(tmp_path, coalesce_seconds=10, recall_window=0.5)
+    try:
+        DSMC_SPY = []
+        start = time.monotonic()
+        queued = list(archive_tool.submit_to_daemon({'kind': 'recall', 'names': paths[:2]}, socket_path))
+        assert queued == [{'job_id': 1, 'state': 'queued'}] and time.monotonic() - start < 0.5
+        answers = list(archive_tool.submit_to_daemon({'kind': 'recall', 'names': paths[1:], 'wait': True}, socket_path))
+        assert answers[-1] == {'job_id': 2, 'state': 'done', 'error': None}
+        assert [cmd[:2] for cmd in DSMC_SPY].count(['dsmc', 'retrieve']) == 1, DSMC_SPY
+        for path in paths:
+            assert calculate_hash(path) == checksums[path]
+
+        rejected = list(archive_tool.submit_to_daemon({'kind': 'format', 'names': paths}, socket_path))
+        assert rejected[0]['state'] == 'rejected'
+        rejected = list(archive_tool.submit_to_daemon({'kind': 'delete', 'names': ['/data/dir/']}, socket_path))
+        assert rejected[0]['state'] == 'rejected' and 'directory' in rejected[0]['error']
+        with pytest.raises(RuntimeError, match='directory'):
+            archive_tool.delete_objects(['/data/dir/'])
+        status, = archive_tool.submit_to_daemon({'kind': 'status'}, socket_path)
+        assert status == {'state': 'status', 'queued': {}, 'running': 0}
+    finally:
+        stop()
+    assert not Path(socket_path).exists()
+
+
+def test_daemon_windows_overlap(spy_dsmc, tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000])
+    archive_tool.archive_objects(paths)
+    socket_path, stop = _start_daemon(tmp_path, coalesce_seconds=0.1, recall_window=3)
+    try:
+        queued, = archive_tool.submit_to_daemon({'kind': 'recall', 'names': paths[:1]}, socket_path)
+        # the open recall window doesnt hold back other jobs
+        start = time.monotonic()
+        answers = list(archive_tool.submit_to_daemon({'kind': 'delete', 'names': [paths[1]], 'wait': True}, socket_path))
+        assert answers[-1]['state'] == 'done' and time.monotonic() - start < 2
+        assert not Path(paths[0]).exists()
+        status, = archive_tool.submit_to_daemon({'kind': 'status'}, socket_path)
+        assert status['queued'] == {'recall': 1}
+        answers = list(archive_tool.submit_to_daemon({'kind': 'recall', 'names': paths[:1], 'wait': True}, socket_path))
+        assert answers[-1]['state'] == 'done'
+        assert Path(paths[0]).exists()
+    finally:
+        stop()
+
+
+def test_daemon_answers_while_jobs_run(tmp_path, monkeypatch):
+    release = threading.Event()
+    monkeypatch.setitem(archive_tool.JOB_KINDS, 'delete', lambda names, **options: release.wait(10))
+    socket_path, stop = _start_daemon(tmp_path, coalesce_seconds=0, max_jobs=1)
+    try:
+        list(archive_tool.submit_to_daemon({'kind': 'delete', 'names': ['/data/a.bin']}, socket_path))
+        time.sleep(0.2)
+        # the only job slot is taken, submissions are still answered right away
+        start = time.monotonic()
+        queued, = archive_tool.submit_to_daemon({'kind': 'delete', 'names': ['/data/b.bin']}, socket_path)
+        rejected, = archive_tool.submit_to_daemon({'kind': 'delete', 'names': ['/data/dir/']}, socket_path)
+        assert queued['state'] == 'queued' and rejected['state'] == 'rejected'
+        assert time.monotonic() - start < 1
+    finally:
+        release.set()
+        stop()
+
+
+def test_daemon_takes_large_jobs(tmp_path, monkeypatch):
+    deleted = []
+    monkeypatch.setitem(archive_tool.JOB_KINDS, 'delete', lambda names, **options: deleted.extend(names))
+    names = [f'/data/project/some/deeper/directory/file_{i:06d}.bin' for i in range(20000)]
+    socket_path, stop = _start_daemon(tmp_path, coalesce_seconds=0)
+    try:
+        answers = list(archive_tool.submit_to_daemon({'kind': 'delete', 'names': names, 'wait': True}, socket_path))
+        assert answers[-1]['state'] == 'done', answers
+        assert deleted == names
+    finally:
+        stop()
+
+
+def test_daemon_fails_submitters_only_for_their_names(spy_dsmc, tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000])
+    checksums = {p: calculate_hash(p) for p in paths}
+    archive_tool.archive_objects(paths)
+    socket_path, stop = _start_daemon(tmp_path, coalesce_seconds=10, recall_window=1)
+    try:
+        # rejected alone, instead of failing the recall it would have been coalesced with
+        rejected, = archive_tool.submit_to_daemon({'kind': 'recall', 'names': [str(tmp_path / 'missing.bin')]}, socket_path)
+        assert rejected['state'] == 'rejected' and 'not found' in rejected['error']
+
+        with open(dsmc_spy_storepath / Path(paths[0]).name, 'r+b') as f:
+            f.write(b'corrupted')
+        queued, = archive_tool.submit_to_daemon({'kind': 'recall', 'names': paths[:2]}, socket_path)
+        with futures.ThreadPoolExecutor() as executor:
+            first = executor.submit(lambda: list(archive_tool.submit_to_daemon({'kind': 'recall', 'names': paths[:1], 'wait': True}, socket_path)))
+            second = archive_tool.submit_to_daemon({'kind': 'recall', 'names': paths[2:], 'wait': True}, socket_path)
+            assert list(second)[-1]['state'] == 'done'
+            answer = first.result()[-1]
+        assert answer['state'] == 'failed' and answer['error'] == f'recall failed for: {paths[0]}'
+        for path in paths[1:]:
+            assert calculate_hash(path) == checksums[path]
+            assert not Path(archive_tool.stubname(path)).exists()
+        assert Path(archive_tool.stubname(paths[0])).exists()
+    finally:
+        stop()
+
+
+def test_daemon_queue_runs_recalls_first():
+    async def order():
+        queue = archive_tool.DaemonQueue()
+        for kind in ['archive', 'delete', 'recall', 'archive']:
+            queue.put(archive_tool.Job(kind, [f'/{kind}.bin']), None)
+        first, _ = await queue.get()
+        second, _ = await queue.get()
+        return first.kind, second.kind, len(queue.take_matching(archive_tool.Job('archive', []))), queue.summary()
+    assert asyncio.run(order()) == ('recall', 'delete', 2, {})
+
+
+def test_recall_groups_by_volume(spy_dsmc, tmp_path, monkeypatch):
+    global DSMC_SPY
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000, 6000, 2000])
+    checksums = {p: calculate_hash(p) for p in paths}
+    archive_tool.archive_objects(paths)
+    FAKE_LOCATIONS.update({paths[0]: ('VOL002', '00000000-00000022-00000000-00000010'),
+                           paths[1]: ('VOL001', '00000000-00000021-00000000-00000200'),
+                           paths[2]: ('VOL002', '00000000-00000022-00000000-00000001'),
+                           paths[3]: ('VOL001', '00000000-00000021-00000000-00000100')})
+
+    locations = archive_tool.query_tape_locations(paths)
+    assert set(locations) == set(paths[:4]) and locations[paths[0]].volume == 'VOL002'
+    assert archive_tool.group_by_volume(paths, locations) == [[paths[3], paths[1]], [paths[2], paths[0]], [paths[4]]]
+    # known locations come from the catalog
+    DSMC_SPY = []
+    assert archive_tool.query_tape_locations(paths[:4]) == {p: locations[p] for p in paths[:4]}
+    assert DSMC_SPY == []
+
+    DSMC_SPY_STORAGE.clear()
+    archive_tool.recall_objects(paths)
+    # one retrieve per volume, front to back
+    assert DSMC_SPY_STORAGE == [[paths[3], paths[1]], [paths[2], paths[0]], [paths[4]]]
+    for path in paths:
+        assert calculate_hash(path) == checksums[path]
+    # deleted objects are forgotten
+    assert archive_tool.query_tape_locations(paths[:1]) == {}
+
+
+def test_plan_retrieve_in_tape_order(spy_dsmc, tmp_path, monkeypatch, capsys):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000, 5000, 6000])
+    archive_tool.archive_objects(paths)
+    # in name order, the volumes alternate
+    FAKE_LOCATIONS.update({paths[0]: ('VOL001', '00000000-00000021-00000000-00000300'),
+                           paths[1]: ('VOL002', '00000000-00000022-00000000-00000001'),
+                           paths[2]: ('VOL001', '00000000-00000021-00000000-00000100')})
+
+    plan = archive_tool.plan_retrieve(paths)
+    assert plan.order == [paths[2], paths[0], paths[1], paths[3]]
+    assert (plan.mounts, plan.unsorted_mounts) == (2, 3)
+    archive_tool.print_retrieve_plan(plan)
+    assert 'estimated tape mounts: 2, instead of 3 in name order, plus up to 1' in capsys.readouterr().out
+
+    retrieve_dir = tmp_path / 'retrieved'
+    retrieve_dir.mkdir()
+    DSMC_SPY_STORAGE.clear()
+    archive_tool.execute_job(archive_tool.Job('retrieve', paths, {'destination': str(retrieve_dir), 'dry_run': True}))
+    assert DSMC_SPY_STORAGE == [] and list(retrieve_dir.iterdir()) == []
+    archive_tool.retrieve_objects(paths, str(retrieve_dir))
+    assert DSMC_SPY_STORAGE == [plan.order]
+
+
+def test_compact_stubs(spy_dsmc, tmp_path, monkeypatch):
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000])
+    checksums = {p: calculate_hash(p) for p in paths}
+    monkeypatch.setattr(archive_tool, 'compact_stubs', True)
+    archive_tool.archive_objects(paths[:1])
+
+    stub = archive_tool.stubname(paths[0])
+    with open(stub, 'rb') as f:
+        header_line = f.readline()
+    header = archive_tool.read_stub_header(stub)
+    assert header['state'] == 'successfully_archived' and header['sha256checksum'] == checksums[paths[0]]
+    # only padded for the longest state
+    assert len(header_line) - len(header_line.rstrip()) == archive_tool.STUB_STATE_WIDTH - len(header['state']) + 1
+    # readers of the json lines format still work
+    records = archive_tool.parse_stubfile(stub)
+    assert records[0]['entry_type'] == 'pre_archive_check' and records[-1]['state'] == 'successfully_archived'
+    assert archive_tool.read_stub_ends(stub)[1]['state'] == 'successfully_archived'
+    assert archive_tool.get_original_checksum(paths[0]) == checksums[paths[0]]
+    # every state is rewritten in place
+    archive_tool.append_stub_state(paths[0], 'verifieingrecalled_object_now_deleting')
+    archive_tool.append_stub_state(paths[0], 'successfully_archived')
+    with open(stub, 'rb') as f:
+        assert len(f.readline()) == len(header_line)
+    assert archive_tool.read_stub_header(stub)['state'] == 'successfully_archived'
+
+    monkeypatch.setattr(archive_tool, 'compact_stubs', False)
+    archive_tool.archive_objects(paths[1:])
+    old_stub = archive_tool.stubname(paths[1])
+    old_records = archive_tool.parse_stubfile(old_stub)
+    if os.geteuid() == 0:
+        # root converts the stubfiles of other users
+        os.chown(old_stub, 1234, 1234)
+    owner = (os.stat(old_stub).st_uid, os.stat(old_stub).st_gid)
+    assert archive_tool.convert_stubfiles([str(tmp_path)]) == (1, 1)
+    assert (os.stat(old_stub).st_uid, os.stat(old_stub).st_gid) == owner
+    converted = archive_tool.parse_stubfile(old_stub)
+    assert converted[1:] == old_records[1:] and converted[0]['stub_version'] == archive_tool.STUB_VERSION
+    assert archive_tool.read_stub_header(old_stub)['state'] == 'successfully_archived'
+
+    archive_tool.recall_objects(paths)
+    for path in paths:
+        assert calculate_hash(path) == checksums[path]
+
+
+def test_benchmark_with_fake_dsmc(tmp_path):
+    import bench_archive_tool
+    settings = {name: getattr(archive_tool, name) for name in bench_archive_tool.SCRATCH_SETTINGS}
+    environ = dict(os.environ)
+
+    results = bench_archive_tool.run_benchmark([2], [64 * 1024], workdir=str(tmp_path), volume_bytes=64 * 1024)
+    assert [r['operation'] for r in results['results']] == list(bench_archive_tool.OPERATIONS)
+    assert all(r['error'] is None and r['seconds'] > 0 for r in results['results']), results
+    assert {'hash', 'upload', 'stub_write', 'unlink'} <= set(results['results'][0]['phases'])
+    assert bench_archive_tool.find_regressions(results, results) == []
+    slower = json.loads(json.dumps(results))
+    slower['results'][0]['seconds'] *= 2
+    assert len(bench_archive_tool.find_regressions(slower, results)) == 1
+
+    failing = bench_archive_tool.run_benchmark([1], [64 * 1024], workdir=str(tmp_path), fail_rate=1)
+    assert 'archiving failed' in failing['results'][0]['error']
+    assert all(r['error'].startswith('skipped') for r in failing['results'][1:])
+    # the scratch settings of the benchmark dont outlive it
+    assert {name: getattr(archive_tool, name) for name in settings} == settings
+    assert dict(os.environ) == environ
+
+
+def test_metrics_spans(spy_dsmc, tmp_path, monkeypatch):
+    metrics = tmp_path / 'metrics.jsonl'
+    textfile = tmp_path / 'archive_tool.prom'
+    monkeypatch.setattr(archive_tool, 'METRICS_PATH', str(metrics))
+    monkeypatch.setattr(archive_tool, 'PROMETHEUS_TEXTFILE_PATH', str(textfile))
+    monkeypatch.setattr(archive_tool, '_span_totals', {})
+    paths = _make_archivable_files(tmp_path, monkeypatch, [4000, 3000])
+    archive_tool.archive_objects(paths)
+    with pytest.raises(RuntimeError):
+        archive_tool.archive_objects([str(tmp_path / 'missing.bin')])
+
+    spans = [json.loads(line) for line in metrics.read_text().splitlines()]
+    by_name = {}
+    for record in spans:
+        by_name.setdefault(record['span'], []).append(record)
+    assert {'preflight', 'hash', 'hash_file', 'stub_write', 'upload', 'archive_batch', 'stub_state', 'unlink', 'archive'} <= set(by_name)
+    assert sorted(r['bytes'] for r in by_name['hash_file']) == [3000, 4000]
+    archived, = by_name['archive']
+    assert archived['files'] == 2 and archived['bytes'] == 7000 and archived['status'] == 'ok' and archived['bytes_per_sec'] > 0
+    assert by_name['preflight'][-1]['failures'] == 1
+
+    archive_tool.write_prometheus_textfile()
+    text = textfile.read_text()
+    assert 'archive_tool_phase_runs_total{phase="hash_file"} 2' in text
+    assert 'archive_tool_phase_bytes_total{phase="archive"} 7000' in text
+    assert '# TYPE archive_tool_phase_seconds_total counter' in text
+
+
+def test_lazy_startup():
+    # a fresh interpreter, the test process already imported everything
+    script = ("import sys, archive_tool; "
+              "print(sorted(m for m in ('asyncio', 'sqlite3', 'socket', 'subprocess', 'concurrent.futures') if m in sys.modules))")
+    result = subprocess.run([sys.executable, '-c', script], cwd=Path(archive_tool.__file__).parent,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == '[]'
+
+    result = subprocess.run([sys.executable, archive_tool.__file__, '--profile-startup', '--help'],
+                            capture_output=True, text=True, check=True)
+    assert 'usage:' in result.stdout
+    assert 'eager imports' in result.stderr and 'total' in result.stderr
+    assert 'compiling' in result.stderr and 'bytecode cache' in result.stderr
+    # the entry script imports the module, which is compiled only once into __pycache__
+    result = subprocess.run([sys.executable, str(Path(archive_tool.__file__).parent / 'archive-tool'), '--profile-startup', '--help'],
+                            capture_output=True, text=True, check=True)
+    assert 'usage:' in result.stdout and 'total' in result.stderr and 'compiling' not in result.stderr
+
+    assert archive_tool.session_uuid == archive_tool.session_id()
+    assert archive_tool.session_hostname == socket.getfqdn()